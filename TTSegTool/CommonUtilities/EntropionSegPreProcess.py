@@ -4,8 +4,13 @@ from pathlib import Path
 import numpy as np
 
 from CommonUtilities import utility
+from CommonUtilities import buildmanifest
+from CommonUtilities import nrrdio
+from CommonUtilities import volumeio
 import vtk, qt, ctk, slicer
 
+SEGMENT_LABEL_NAMES = {1:'EyeBall', 2:'Cornea', 3:'EyeLid', 4:'Entropion'}
+SEGMENT_LABEL_COLORS = {1:(0.5, 0.68, 0.5), 2:(0.5, 0, 0), 3:(0.5, 0.45, 0), 4:(0.9, 0.5, 0.5)}
 
 
 def setSegmentationLabelNames(segmentation_node):
@@ -14,7 +19,7 @@ def setSegmentationLabelNames(segmentation_node):
 
     current_segmentation = segmentation_node.GetSegmentation()
     number_of_segments = current_segmentation.GetNumberOfSegments()
-    segment_label_names = {1:'EyeBall', 2:'Cornea', 3:'EyeLid', 4:'Entropion'}
+    segment_label_names = SEGMENT_LABEL_NAMES
     for segment_number in range(number_of_segments):
         label = current_segmentation.GetNthSegment(segment_number).GetLabelValue()
         name = current_segmentation.GetNthSegment(segment_number).GetName()
@@ -22,7 +27,15 @@ def setSegmentationLabelNames(segmentation_node):
             current_segmentation.GetNthSegment(segment_number).SetName(segment_label_names[label])
 
 
-def createEntropionSegment(segmentation_node, ref_img_path, out_segmentation_path):
+def processingParams(compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
+    # Anything that changes the output, bump the version when the processing changes
+    # 2: segmentations written by nrrdio, with their segment metadata
+    return {'segment': 'Entropion', 'compression': compression, 'crop': bool(crop), 'version': 2}
+
+def manifestPath(out_dir):
+    return Path(out_dir) / '.entropion_manifest.json'
+
+def createEntropionSegment(segmentation_node, ref_img_path, out_segmentation_path, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
     if segmentation_node is None or not ref_img_path.exists():
         print('Could not find: {}'.format(ref_img_path))
         return
@@ -33,16 +46,42 @@ def createEntropionSegment(segmentation_node, ref_img_path, out_segmentation_pat
         # Most probably has an entropion already, return
         return
 
-    # Export segment as vtkImageData (via temporary labelmap volume node)
-    image_node = slicer.util.loadVolume(str(ref_img_path), {'singleFile':True})
+    # The reference image is not needed to add an empty segment, don't load it into the scene
     segmentIds = vtk.vtkStringArray()
     current_segmentation.GetSegmentIDs(segmentIds)
     segmentIds.InsertNextValue('Entropion')
     segmentation_node.GetSegmentation().AddEmptySegment('Entropion')
     
-    # Save this label to image
-    slicer.util.saveNode(segmentation_node, str(out_segmentation_path))
-    
+    # Save this label to image, the empty segment is kept in the metadata
+    snapshot = utility.MRMLUtility.snapshotSegmentationNode(segmentation_node, out_segmentation_path)
+    volumeio.writeVolume(volumeio.cropToContent(snapshot) if crop else snapshot, out_segmentation_path, compression)
+
+def createEntropionSegmentFile(segpath, out_segmentation_path):
+    '''
+    Metadata only version of createEntropionSegment: adds the empty segment to the .seg.nrrd
+    header and copies the voxel payload as it is. Returns True if the file was written, False
+    if it already has an entropion segment and None if the file needs the scene based path.
+    '''
+    header = nrrdio.readHeaderFile(segpath)
+    if header.isDetached():
+        return None
+    if nrrdio.numberOfSegments(header) == 0:
+        # Plain labelmap, the segments are the labels present in it
+        labelmap = volumeio.readVolume(segpath)
+        if labelmap.isVector():
+            return None
+        nrrdio.addSegmentationHeader(header, labelmap.array, SEGMENT_LABEL_NAMES, SEGMENT_LABEL_COLORS)
+    labels = nrrdio.segmentLabelValues(header)
+    if len(labels) > 3:
+        # Most probably has an entropion already, return
+        return False
+    if any(layer != 0 for layer, _ in labels):
+        return None
+    label_value = max([label for _, label in labels] + [0]) + 1
+    nrrdio.appendSegment(header, 'Entropion', 'Entropion', SEGMENT_LABEL_COLORS[4], label_value)
+    nrrdio.rewriteHeader(segpath, out_segmentation_path, header)
+    return True
+
 def writeToCsv(out_path, fieldnames, row=None):
     mode = 'w' if row is None else 'a+'
     with open(out_path, mode, newline='') as fh:
@@ -52,7 +91,7 @@ def writeToCsv(out_path, fieldnames, row=None):
         else:
             dictwriter.writerow(row)
 
-def main(input_csv, out_dir, server_path):
+def main(input_csv, out_dir, server_path, metadata_only=True, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
     try:
         with open( Path(input_csv), 'r') as fh:
             reader = DictReader(fh)
@@ -65,8 +104,9 @@ def main(input_csv, out_dir, server_path):
     fieldnames = all_rows[0].keys()
     writeToCsv(out_csv_file, fieldnames)
 
-    segmentation_node = None
     image_node = None
+    manifest = buildmanifest.ProcessingManifest(manifestPath(out_dir))
+    params = processingParams(compression, crop)
 
     slicer.progressWindow = qt.QProgressDialog("Ploughing throug segmentations", "Abort Load", 0, len(all_rows), slicer.util.mainWindow())
     slicer.progressWindow.setWindowModality(qt.Qt.WindowModal)
@@ -87,27 +127,44 @@ def main(input_csv, out_dir, server_path):
             print('Either {} or {} does not exists'.format(imgpath, segpath))
             continue
         out_segmentation_path = Path(out_dir) / segpath.name
+        input_paths = [segpath]
+        # Manifest keys are the csv paths, relative to the server
+        original_segpath = row['segmentation path']
+        # Every node loaded for this row, with its display and storage nodes, goes when the row is done
+        scope = utility.ResourceScope().open()
         try:
-            if segmentation_node is not None:
-                slicer.mrmlScene.RemoveNode(segmentation_node)
-                segmentation_node = None
-            
-            if not out_segmentation_path.exists():
-                segmentation_node = slicer.util.loadSegmentation(str(segpath))
-                # Deal with segment names:
-                current_segmentation = segmentation_node.GetSegmentation()
-                number_of_segments = current_segmentation.GetNumberOfSegments()
-                
-                if number_of_segments < 4:
-                    createEntropionSegment(segmentation_node, imgpath, out_segmentation_path)
+            entry = buildmanifest.checkEntry(manifest.entry(original_segpath), input_paths, params, out_segmentation_path)
+            if entry is None:
+                written = None
+                if metadata_only:
+                    written = createEntropionSegmentFile(segpath, out_segmentation_path)
+                if written is None:
+                    segmentation_node = utility.MRMLUtility.loadSegmentationFile(segpath)
+                    # Deal with segment names:
+                    current_segmentation = segmentation_node.GetSegmentation()
+                    number_of_segments = current_segmentation.GetNumberOfSegments()
+                    
+                    written = number_of_segments < 4
+                    if written:
+                        createEntropionSegment(segmentation_node, imgpath, out_segmentation_path, compression, crop)
+                if written:
                     row['segmentation path'] = out_segmentation_path.relative_to(server_path)
+                    entry = buildmanifest.createEntry(input_paths, params, out_segmentation_path)
+                else:
+                    entry = buildmanifest.createEntry(input_paths, params)
             else:
-                print('{} already exists, skipping processing'.format(out_segmentation_path))
-                row['segmentation path'] = out_segmentation_path.relative_to(server_path)
+                print('{} is up to date, skipping processing'.format(out_segmentation_path))
+                if entry['output'] is not None:
+                    row['segmentation path'] = out_segmentation_path.relative_to(server_path)
+            manifest.update(original_segpath, entry)
+            if num_id % 100 == 0:
+                manifest.save()
             writeToCsv(out_csv_file, fieldnames, row=row)
         except Exception as e:
             print("Couldn't load segmentation: {}\n ERROR: {}".format(segpath, e))
-            segmentation_node = None
+        finally:
+            scope.release()
+    manifest.save()
     slicer.progressWindow.close()
 
 if __name__=="__main__":
@@ -1,12 +1,24 @@
 from argparse import ArgumentParser
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from csv import DictReader, DictWriter
 from pathlib import Path
 import numpy as np
 
-from CommonUtilities import utility
-import vtk, qt, ctk, slicer
+from CommonUtilities import eyelid
+from CommonUtilities import volumeio
+from CommonUtilities import buildmanifest
+from CommonUtilities import nrrdio
+try:
+    from CommonUtilities import utility
+    import vtk, qt, ctk, slicer
+except ImportError:
+    # Headless mode (headlessMain) runs in plain Python processes, without Slicer
+    slicer = None
 
+SEGMENT_LABEL_NAMES = {1:'EyeBall', 2:'Cornea', 3:'EyeLid'}
+SEGMENT_LABEL_COLORS = {1:(0.5, 0.68, 0.5), 2:(0.5, 0, 0), 3:(0.5, 0.45, 0)}
 
 
 def setSegmentationLabelNames(segmentation_node):
@@ -15,7 +27,7 @@ def setSegmentationLabelNames(segmentation_node):
 
     current_segmentation = segmentation_node.GetSegmentation()
     number_of_segments = current_segmentation.GetNumberOfSegments()
-    segment_label_names = {1:'EyeBall', 2:'Cornea', 3:'EyeLid'}
+    segment_label_names = SEGMENT_LABEL_NAMES
     for segment_number in range(number_of_segments):
         label = current_segmentation.GetNthSegment(segment_number).GetLabelValue()
         name = current_segmentation.GetNthSegment(segment_number).GetName()
@@ -23,7 +35,15 @@ def setSegmentationLabelNames(segmentation_node):
             current_segmentation.GetNthSegment(segment_number).SetName(segment_label_names[label])
 
 
-def createEyelidSegment(segmentation_node, ref_img_path, out_segmentation_path):
+def processingParams(kernel_size=eyelid.EYELID_KERNEL_SIZE, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
+    # Anything that changes the output, bump the version when the algorithm changes
+    # 2: segmentations written by nrrdio, with their segment metadata
+    return {'kernel_size': [int(k) for k in kernel_size], 'compression': compression, 'crop': bool(crop), 'version': 2}
+
+def manifestPath(out_dir):
+    return Path(out_dir) / '.eyelid_manifest.json'
+
+def createEyelidSegment(segmentation_node, ref_img_path, out_segmentation_path, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
     if segmentation_node is None or not ref_img_path.exists():
         print('Could not find: {}'.format(ref_img_path))
         return
@@ -35,43 +55,26 @@ def createEyelidSegment(segmentation_node, ref_img_path, out_segmentation_path):
         return
 
     # Export segment as vtkImageData (via temporary labelmap volume node)
-    image_node = slicer.util.loadVolume(str(ref_img_path), {'singleFile':True})
-    segmentIds = vtk.vtkStringArray()
-    current_segmentation.GetSegmentIDs(segmentIds)
-    labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-    slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentation_node, segmentIds, labelmapVolumeNode, image_node, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY )
-    # Manipulate the mask values to add the third label
-    mask = slicer.util.arrayFromVolume(labelmapVolumeNode)
-    newmask = mask.copy()
-    newmask[newmask > 0] = mask.max() + 1
-    clone = slicer.modules.volumes.logic().CloneVolume(labelmapVolumeNode, "CloneLabelMap")
-    slicer.util.updateVolumeFromArray(clone, newmask)
-    segmentImageData = clone.GetImageData()
-    kernelSize = [20, 200, 1]
-    erodeDilate = vtk.vtkImageDilateErode3D()
-    erodeDilate.SetInputData(segmentImageData)
-    erodeDilate.SetDilateValue(mask.max() + 1)
-    erodeDilate.SetErodeValue(0)
-    erodeDilate.SetKernelSize(*kernelSize)
-    erodeDilate.Update()
-    segmentImageData.DeepCopy(erodeDilate.GetOutput())
-    newmask = slicer.util.arrayFromVolume(clone)
-    # Combine both the masks together to add the new labelmap.
-    newmask[mask > 0] = 0
-    newmask = newmask + mask
-    slicer.util.updateVolumeFromArray(clone, newmask)
-    segmentIds.InsertNextValue('EyeLid')
-    segmentation_node.GetSegmentation().AddEmptySegment('EyeLid')
-    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(clone, segmentation_node, segmentIds)
-    setSegmentationLabelNames(segmentation_node)
-    
-    # Save this label to image
-    slicer.util.saveNode(clone, str(out_segmentation_path))
-    slicer.mrmlScene.RemoveNode(labelmapVolumeNode.GetDisplayNode().GetColorNode())
-    slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-    slicer.mrmlScene.RemoveNode(clone.GetDisplayNode().GetColorNode())
-    slicer.mrmlScene.RemoveNode(clone)
-    slicer.mrmlScene.RemoveNode(image_node)
+    # The reference image and the labelmap, with their display, storage and color nodes, go with the scope
+    with utility.ResourceScope():
+        image_node = slicer.util.loadVolume(str(ref_img_path), {'singleFile':True})
+        segmentIds = vtk.vtkStringArray()
+        current_segmentation.GetSegmentIDs(segmentIds)
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentation_node, segmentIds, labelmapVolumeNode, image_node, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY )
+        # Add the third label around the existing ones, in place on the exported labelmap
+        mask = slicer.util.arrayFromVolume(labelmapVolumeNode)
+        eyelid.createEyelidLabelmap(mask, out=mask)
+        slicer.util.arrayFromVolumeModified(labelmapVolumeNode)
+        segmentIds.InsertNextValue('EyeLid')
+        segmentation_node.GetSegmentation().AddEmptySegment('EyeLid')
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, segmentation_node, segmentIds)
+        setSegmentationLabelNames(segmentation_node)
+
+        # Save this label to image, with the segment names and colors
+        labelmap = utility.MRMLUtility.snapshotVolumeNode(labelmapVolumeNode, out_segmentation_path)
+        labelmap.metadata = utility.MRMLUtility.exportedSegmentMetadata(segmentation_node, labelmapVolumeNode, labelmap.array)
+        volumeio.writeVolume(volumeio.cropToContent(labelmap) if crop else labelmap, out_segmentation_path, compression)
 
 def writeToCsv(out_path, fieldnames, row=None):
     mode = 'w' if row is None else 'a+'
@@ -82,7 +85,7 @@ def writeToCsv(out_path, fieldnames, row=None):
         else:
             dictwriter.writerow(row)
 
-def main(input_csv, out_dir, server_path):
+def main(input_csv, out_dir, server_path, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
     try:
         with open( Path(input_csv), 'r') as fh:
             reader = DictReader(fh)
@@ -95,8 +98,9 @@ def main(input_csv, out_dir, server_path):
     fieldnames = all_rows[0].keys()
     writeToCsv(out_csv_file, fieldnames)
 
-    segmentation_node = None
     image_node = None
+    manifest = buildmanifest.ProcessingManifest(manifestPath(out_dir))
+    params = processingParams(compression=compression, crop=crop)
 
     slicer.progressWindow = qt.QProgressDialog("Ploughing throug segmentations", "Abort Load", 0, len(all_rows), slicer.util.mainWindow())
     slicer.progressWindow.setWindowModality(qt.Qt.WindowModal)
@@ -117,41 +121,125 @@ def main(input_csv, out_dir, server_path):
             print('Either {} or {} does not exists'.format(imgpath, segpath))
             continue
         out_segmentation_path = Path(out_dir) / segpath.name
+        input_paths = [segpath, imgpath]
+        # Manifest keys are the csv paths, relative to the server
+        original_segpath = row['segmentation path']
+        # Every node loaded for this row, with its display and storage nodes, goes when the row is done
+        scope = utility.ResourceScope().open()
         try:
-            if segmentation_node is not None:
-                slicer.mrmlScene.RemoveNode(segmentation_node)
-                segmentation_node = None
-            
-            if not out_segmentation_path.exists():
-                segmentation_node = slicer.util.loadSegmentation(str(segpath))
+            entry = buildmanifest.checkEntry(manifest.entry(row['segmentation path']), input_paths, params, out_segmentation_path)
+            if entry is None:
+                segmentation_node = utility.MRMLUtility.loadSegmentationFile(segpath)
                 # Deal with segment names:
                 current_segmentation = segmentation_node.GetSegmentation()
                 number_of_segments = current_segmentation.GetNumberOfSegments()
                 
                 if number_of_segments < 3:
-                    createEyelidSegment(segmentation_node, imgpath, out_segmentation_path)
+                    createEyelidSegment(segmentation_node, imgpath, out_segmentation_path, compression, crop)
                     current_segmentation = segmentation_node.GetSegmentation()
                     number_of_segments = current_segmentation.GetNumberOfSegments()
                     row['segmentation path'] = out_segmentation_path.relative_to(server_path)
+                    entry = buildmanifest.createEntry(input_paths, params, out_segmentation_path)
+                else:
+                    entry = buildmanifest.createEntry(input_paths, params)
             else:
-                print('{} already exists, skipping processing'.format(out_segmentation_path))
-                row['segmentation path'] = out_segmentation_path.relative_to(server_path)
+                print('{} is up to date, skipping processing'.format(out_segmentation_path))
+                if entry['output'] is not None:
+                    row['segmentation path'] = out_segmentation_path.relative_to(server_path)
+            manifest.update(original_segpath, entry)
+            if num_id % 100 == 0:
+                manifest.save()
             writeToCsv(out_csv_file, fieldnames, row=row)
         except Exception as e:
             print("Couldn't load segmentation: {}\n ERROR: {}".format(segpath, e))
-            segmentation_node = None
+        finally:
+            scope.release()
+    manifest.save()
     slicer.progressWindow.close()
 
+def createEyelidSegmentFile(segpath, imgpath, out_segmentation_path, kernel_size=eyelid.EYELID_KERNEL_SIZE, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
+    # Scene free version of createEyelidSegment, reads and writes the labelmaps directly
+    segmentation = volumeio.readVolume(segpath)
+    if segmentation.numberOfSegments() > 2:
+        # Most probably has an eyelid already, return
+        return False
+    shape, ijk_to_ras = volumeio.readImageGeometry(imgpath)
+    labelmap = volumeio.resampleToReferenceGeometry(segmentation, shape, ijk_to_ras)
+    eyelid.createEyelidLabelmap(labelmap.array, kernel_size, out=labelmap.array)
+    # Segment metadata for the labels now in the labelmap, the input's colors where it had them
+    descriptions = segmentation.segmentDescriptions() or {}
+    colors = dict(SEGMENT_LABEL_COLORS)
+    colors.update((label, d['color']) for label, d in descriptions.items())
+    labelmap.metadata = nrrdio.addSegmentationHeader(nrrdio.NrrdHeader(), labelmap.array, SEGMENT_LABEL_NAMES, colors).keyvalues
+    volumeio.writeVolume(volumeio.cropToContent(labelmap) if crop else labelmap, out_segmentation_path, compression)
+    return True
+
+def processRow(task):
+    # Runs in the worker processes, returns the output csv row (None to leave the row out),
+    # a message and the new manifest entry for the row
+    row, server_path, out_dir, kernel_size, compression, crop, entry = task
+    imgpath = Path(server_path)/Path(row['image path'])
+    segpath = Path(server_path)/Path(row['segmentation path'])
+    if not segpath.exists() or not imgpath.exists():
+        return None, 'Either {} or {} does not exists'.format(imgpath, segpath), None
+    out_segmentation_path = Path(out_dir) / segpath.name
+    input_paths = [segpath, imgpath]
+    params = processingParams(kernel_size, compression, crop)
+    try:
+        current = buildmanifest.checkEntry(entry, input_paths, params, out_segmentation_path)
+        if current is not None:
+            if current['output'] is not None:
+                row['segmentation path'] = str(out_segmentation_path.relative_to(server_path))
+            return row, '{} is up to date, skipping processing'.format(out_segmentation_path), current
+        if createEyelidSegmentFile(segpath, imgpath, out_segmentation_path, kernel_size, compression, crop):
+            row['segmentation path'] = str(out_segmentation_path.relative_to(server_path))
+            return row, None, buildmanifest.createEntry(input_paths, params, out_segmentation_path)
+        return row, None, buildmanifest.createEntry(input_paths, params)
+    except Exception as e:
+        return None, "Couldn't process segmentation: {}\n ERROR: {}".format(segpath, e), None
+
+def headlessMain(input_csv, out_dir, server_path, num_workers=None, kernel_size=eyelid.EYELID_KERNEL_SIZE, compression=nrrdio.DEFAULT_COMPRESSION, crop=False):
+    try:
+        with open( Path(input_csv), 'r') as fh:
+            reader = DictReader(fh)
+            all_rows = [row for row in reader]
+    except Exception as e:
+        print('error reading the master dict file, return: {}'.format(e))
+        return
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    manifest = buildmanifest.ProcessingManifest(manifestPath(out_dir))
+    out_csv_file = Path(str(input_csv).replace('.csv', '_eyelid.csv'))
+    fieldnames = all_rows[0].keys()
+    num_workers = num_workers or os.cpu_count()
+    # Manifest keys are the csv paths, relative to the server
+    tasks = [(row, server_path, out_dir, kernel_size, compression, crop, manifest.entry(row['segmentation path'])) for row in all_rows]
+    chunksize = max(1, len(tasks) // (num_workers * 16))
+    with open(out_csv_file, 'w', newline='') as fh, ProcessPoolExecutor(max_workers=num_workers) as pool:
+        dictwriter = DictWriter(fh, fieldnames)
+        dictwriter.writeheader()
+        # map hands the results back in input order
+        for num_id, (row, message, entry) in enumerate(pool.map(processRow, tasks, chunksize=chunksize)):
+            if message is not None:
+                print(message)
+            if row is not None:
+                dictwriter.writerow(row)
+            manifest.update(all_rows[num_id]['segmentation path'], entry)
+            if num_id % 100 == 0:
+                print('Processed {}/{} rows'.format(num_id, len(tasks)))
+                manifest.save()
+    manifest.save()
+
 if __name__=="__main__":
-# /Users/hinashah/famli/Groups/Restricted_access_data/Clinical_Data/EPIC/Dataset_B
-    # parser = ArgumentParser()
-    # parser.add_argument('--input_dir', type=str, help='Input directory with all segmentations')
-    # parser.add_arguemtn('--ref_img_dir', type=str, help = 'Input directory for reference images')
-    # parser.add_argument('--out_dir', type=str, help='Output directory to save the new segmentations to')
-    # args = parser.parse_args()
-    
-    # print('Trying something')
-    input_csv = "P:/hashiya/trachoma_sev3_epi0_patcheslist_Hashiya.csv"
-    out_dir = "P:/hashiya/Segmentations_Hashiya"
-    server_path = "P:/"
-    main(input_csv, out_dir, server_path)
\ No newline at end of file
+    # Run from the TTSegTool folder so that CommonUtilities is importable, e.g.
+    # python -m CommonUtilities.EyelidSegPreProcess --input_csv P:/hashiya/list.csv --server_path P:/ --out_dir P:/hashiya/Segmentations_Hashiya --workers 8
+    parser = ArgumentParser(description='Adds the eyelid label to the segmentations of a master csv, without Slicer')
+    parser.add_argument('--input_csv', type=str, required=True, help='Master csv with image and segmentation paths')
+    parser.add_argument('--server_path', type=str, required=True, help='Root the csv paths are relative to')
+    parser.add_argument('--out_dir', type=str, required=True, help='Output directory to save the new segmentations to')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, all cores by default')
+    parser.add_argument('--kernel_size', type=int, nargs=3, default=list(eyelid.EYELID_KERNEL_SIZE), help='Eyelid dilation kernel in columns, rows, slices')
+    parser.add_argument('--compression', choices=list(nrrdio.COMPRESSION_LEVELS), default=nrrdio.DEFAULT_COMPRESSION, help='gzip level of the written segmentations')
+    parser.add_argument('--crop', action='store_true', help='Write only the box around the labels instead of the whole photo extent')
+    args = parser.parse_args()
+    headlessMain(args.input_csv, args.out_dir, args.server_path, args.workers, args.kernel_size, args.compression, args.crop)
@@ -0,0 +1,104 @@
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import qt
+
+#
+# AutosaveScheduler
+#
+'''
+Collects dirty items (patch table, segmentation, master row, master csv) and saves them once
+the user paused for delay_ms, or at the latest max_delay_ms after the first change. Every
+dirty item is a callable run on the main thread at flush time, which takes a snapshot of
+the state and hands the file writes to submit(). Writes run in order on one worker thread,
+their completion callbacks run back on the main thread from a polling timer.
+'''
+class AutosaveScheduler(object):
+
+    def __init__(self, delay_ms=2000, max_delay_ms=10000, poll_ms=250):
+        self.delay_ms = delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.dirty = OrderedDict()
+        self.first_dirty = None
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.flushTimer = qt.QTimer()
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.connect('timeout()', self.flush)
+        self.pollTimer = qt.QTimer()
+        self.pollTimer.setInterval(poll_ms)
+        self.pollTimer.connect('timeout()', self.poll)
+        self.pollTimer.start()
+
+    def markDirty(self, key, snapshot):
+        # A later snapshot for the same key replaces the earlier one
+        self.dirty[key] = snapshot
+        now = time.monotonic()
+        if self.first_dirty is None:
+            self.first_dirty = now
+        remaining_ms = self.max_delay_ms - (now - self.first_dirty) * 1000
+        self.flushTimer.start(int(max(0, min(self.delay_ms, remaining_ms))))
+
+    def discard(self, key):
+        self.dirty.pop(key, None)
+
+    def clear(self):
+        # Drops what was not flushed yet, e.g. when another master csv is loaded
+        self.flushTimer.stop()
+        self.first_dirty = None
+        self.dirty = OrderedDict()
+
+    def hasDirty(self):
+        return len(self.dirty) > 0
+
+    def flush(self, keys=None):
+        # Takes the snapshots now, the writes they submit go on in the background. With keys
+        # only those are taken, the rest keep waiting for the timer
+        if keys is None:
+            dirty = self.dirty
+            self.dirty = OrderedDict()
+        else:
+            dirty = OrderedDict((key, self.dirty.pop(key)) for key in list(self.dirty) if key in keys)
+        if len(self.dirty) == 0:
+            self.flushTimer.stop()
+            self.first_dirty = None
+        for key, snapshot in dirty.items():
+            try:
+                snapshot()
+            except Exception as e:
+                logging.error('Autosave of {} failed: {}'.format(key, e))
+
+    def submit(self, key, write, done=None):
+        '''
+        Runs write() on the worker thread, then done(error) on the main thread, error is
+        None on success.
+        '''
+        self.pending.append((key, self.executor.submit(write), done))
+
+    def poll(self):
+        still_pending = []
+        for key, future, done in self.pending:
+            if not future.done():
+                still_pending.append((key, future, done))
+                continue
+            error = future.exception()
+            if error is not None:
+                logging.error('Autosave write of {} failed: {}'.format(key, error))
+            if done is not None:
+                done(error)
+        self.pending = still_pending
+
+    def waitForWrites(self):
+        # Blocks until every submitted write finished and ran its callback
+        while len(self.pending) > 0:
+            for key, future, done in self.pending:
+                future.exception()
+            self.poll()
+
+    def close(self):
+        self.flush()
+        self.waitForWrites()
+        self.flushTimer.stop()
+        self.pollTimer.stop()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,60 @@
+import logging
+from collections import OrderedDict
+
+#
+# UpdateBatch
+#
+'''
+Context manager grouping a series of widget and MRML changes into one update. While it is
+open the signals of the given Qt objects are blocked and the given MRML nodes are in a
+StartModify/EndModify block, so their observers fire once at the end. Follow up updates
+are registered with defer() instead of being run right away, only the last one registered
+per key runs when the outermost block closes. Blocks can be nested.
+'''
+class UpdateBatch(object):
+
+    def __init__(self, qt_objects=(), mrml_nodes=(), on_close=None):
+        self.qt_objects = list(qt_objects)
+        self.mrml_nodes = list(mrml_nodes)
+        self.on_close = on_close
+        self.depth = 0
+        self.blocked = []
+        self.modifying = []
+        self.deferred = OrderedDict()
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.blocked = [(obj, obj.blockSignals(True)) for obj in self.qt_objects]
+            self.modifying = [(node, node.StartModify()) for node in self.mrml_nodes]
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth > 0:
+            return False
+        for obj, was_blocked in reversed(self.blocked):
+            obj.blockSignals(was_blocked)
+        for node, was_modifying in reversed(self.modifying):
+            node.EndModify(was_modifying)
+        self.blocked = []
+        self.modifying = []
+        if self.on_close is not None:
+            self.on_close()
+        deferred = self.deferred
+        self.deferred = OrderedDict()
+        if exc_type is None:
+            for key, callback in deferred.items():
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error('Batched update {} failed: {}'.format(key, e))
+        return False
+
+    def isOpen(self):
+        return self.depth > 0
+
+    def defer(self, key, callback):
+        # Moves the key to the end, so updates run in the order they were last requested
+        self.deferred.pop(key, None)
+        self.deferred[key] = callback
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+#
+# ProcessingManifest
+#
+'''
+Sidecar manifest for the preprocessing scripts, so that reruns only process rows whose
+inputs or parameters changed. Each entry records a fingerprint (size, mtime and content
+hash) of the input files, the processing parameters and a fingerprint of the output.
+Fingerprints are verified with a stat first, files are only hashed again when the stat
+does not match anymore. The helper functions are plain functions so they can run in the
+worker processes, only the main process loads and saves the manifest itself.
+'''
+class ProcessingManifest(object):
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self.entries = {}
+        if self.manifest_path.exists():
+            try:
+                with open(self.manifest_path, 'r') as fh:
+                    self.entries = json.load(fh)
+            except (IOError, ValueError) as e:
+                logging.warning('Could not read the manifest {}, rebuilding everything: {}'.format(self.manifest_path, e))
+                self.entries = {}
+
+    def entry(self, key):
+        return self.entries.get(str(key))
+
+    def update(self, key, entry):
+        if entry is None:
+            self.entries.pop(str(key), None)
+        else:
+            self.entries[str(key)] = entry
+
+    def save(self):
+        # Replace atomically, a crash leaves the previous manifest behind
+        tmp_path = self.manifest_path.with_name('.~' + self.manifest_path.name)
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.entries, fh)
+        os.replace(str(tmp_path), str(self.manifest_path))
+
+
+def fileHash(file_path, chunk_size=1 << 20):
+    content = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            content.update(chunk)
+    return content.hexdigest()
+
+
+def fileFingerprint(file_path, previous=None):
+    # Reuses the previous hash when size and mtime did not change
+    stat = os.stat(str(file_path))
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': fileHash(file_path)}
+
+
+def fingerprintMatches(file_path, previous):
+    # Returns the (possibly refreshed) fingerprint if the content is unchanged, None otherwise
+    if previous is None or not Path(file_path).exists():
+        return None
+    current = fileFingerprint(file_path, previous)
+    return current if current['hash'] == previous['hash'] else None
+
+
+def createEntry(input_paths, params, output_path=None):
+    # output_path None records that the row did not need an output file
+    return {
+        'inputs': [fileFingerprint(p) for p in input_paths],
+        'params': params,
+        'output': fileFingerprint(output_path) if output_path is not None else None,
+    }
+
+
+def checkEntry(entry, input_paths, params, output_path):
+    '''
+    Returns the refreshed entry if the row is up to date, None if it needs processing.
+    '''
+    if entry is None or entry.get('params') != params or len(entry['inputs']) != len(input_paths):
+        return None
+    inputs = []
+    # Inputs are stored in order, not by path, so the manifest survives a different server mount
+    for input_path, previous in zip(input_paths, entry['inputs']):
+        fingerprint = fingerprintMatches(input_path, previous)
+        if fingerprint is None:
+            return None
+        inputs.append(fingerprint)
+    output = None
+    if entry['output'] is not None:
+        # Catches outputs that are missing, half written or edited after the run
+        output = fingerprintMatches(output_path, entry['output'])
+        if output is None:
+            return None
+    return {'inputs': inputs, 'params': params, 'output': output}
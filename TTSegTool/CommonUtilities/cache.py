@@ -0,0 +1,64 @@
+import logging
+import os
+from collections import OrderedDict
+
+#
+# DecodedVolumeCache
+#
+'''
+Least recently used cache of decoded images and segmentations (volumeio.DecodedVolume),
+keyed by file path and modification time, and bounded by a total byte budget.
+Main thread only, the prefetch workers hand their results over through ImagePrefetcher.take.
+'''
+class DecodedVolumeCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict() # file path -> DecodedVolume, oldest first
+
+    @staticmethod
+    def fileModifiedTime(file_path):
+        try:
+            return os.stat(str(file_path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def contains(self, file_path):
+        decoded = self.entries.get(str(file_path))
+        return decoded is not None and decoded.mtime_ns == self.fileModifiedTime(file_path)
+
+    def get(self, file_path):
+        key = str(file_path)
+        decoded = self.entries.get(key)
+        if decoded is None:
+            return None
+        if decoded.mtime_ns != self.fileModifiedTime(file_path):
+            # File changed on disk since it was decoded
+            self.discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return decoded
+
+    def put(self, decoded):
+        if decoded is None or decoded.mtime_ns is None:
+            return
+        key = str(decoded.file_path)
+        self.discard(key)
+        if decoded.nbytes > self.max_bytes:
+            logging.debug('{} is larger than the whole cache, not caching it'.format(key))
+            return
+        self.entries[key] = decoded
+        self.total_bytes += decoded.nbytes
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+
+    def discard(self, file_path):
+        decoded = self.entries.pop(str(file_path), None)
+        if decoded is not None:
+            self.total_bytes -= decoded.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from pathlib import Path
+
+#
+# LocalFileCache
+#
+'''
+Local copies of the images and segmentations on the server share, under the user's profile.
+Files are stored by content hash, a file referenced under two names is stored once. The
+index maps each server path to its copy and to the size and mtime the server file had when
+it was copied, a copy is only served while the server file still has that size and mtime.
+A background thread copies the files handed to pull() in that order, the least recently
+used copies are removed beyond max_bytes. The index is kept in a json file next to the copies.
+'''
+class LocalFileCache(object):
+
+    def __init__(self, cache_dir, max_bytes, chunk_size=1 << 20):
+        self.cache_dir = Path(cache_dir)
+        self.blob_dir = self.cache_dir / 'blobs'
+        self.index_path = self.cache_dir / 'index.json'
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.lock = threading.Condition()
+        # server path key -> {'blob', 'size', 'mtime_ns'}, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.queue = deque()
+        self.index_dirty = False
+        self.closed = False
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.loadIndex()
+        self.thread = threading.Thread(target=self.run, name='TTSegToolLocalCache', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def sourceKey(file_path):
+        return os.path.normcase(os.path.normpath(str(file_path)))
+
+    @staticmethod
+    def blobSuffix(file_path):
+        # Readers pick the format from the extension, keep the double one of segmentations
+        name = Path(file_path).name.lower()
+        return '.seg.nrrd' if name.endswith('.seg.nrrd') else Path(file_path).suffix.lower()
+
+    def loadIndex(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as fh:
+                index = json.load(fh)
+        except FileNotFoundError:
+            index = []
+        except (IOError, ValueError) as e:
+            logging.warning('Could not read the local cache index {}, starting empty: {}'.format(self.index_path, e))
+            index = []
+        blobs = {}
+        for key, entry in index:
+            if (self.blob_dir / entry['blob']).exists():
+                self.entries[key] = entry
+                blobs[entry['blob']] = entry['size']
+        self.total_bytes = sum(blobs.values())
+        # The size cap may have been lowered since the last session
+        self.evict()
+        # Copies the index does not know about, e.g. left behind by a crash
+        for path in self.blob_dir.iterdir():
+            if path.name not in blobs:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def saveIndex(self):
+        with self.lock:
+            if not self.index_dirty:
+                return
+            index = [[key, entry] for key, entry in self.entries.items()]
+            self.index_dirty = False
+        tmp_path = self.index_path.with_name('.~' + self.index_path.name)
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fh:
+                json.dump(index, fh)
+            os.replace(str(tmp_path), str(self.index_path))
+        except (IOError, OSError) as e:
+            logging.warning('Could not write the local cache index {}: {}'.format(self.index_path, e))
+
+    def localPath(self, file_path, info):
+        '''
+        Path of a fresh local copy of file_path, None if there is none. info is the current
+        FileInfo (size, mtime_ns) of the server file, e.g. from the dataset file index.
+        '''
+        if info is None:
+            return None
+        key = self.sourceKey(file_path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['size'] != info.size or entry['mtime_ns'] != info.mtime_ns:
+                return None
+            self.entries.move_to_end(key)
+            self.index_dirty = True
+            local_path = self.blob_dir / entry['blob']
+        return local_path if local_path.exists() else None
+
+    def pull(self, file_paths):
+        # Replaces what is still waiting to be copied, files are copied in the given order
+        with self.lock:
+            self.queue = deque(str(p) for p in file_paths if p is not None and len(str(p)) > 0)
+            self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while len(self.queue) == 0 and not self.closed:
+                    if self.index_dirty:
+                        break
+                    self.lock.wait()
+                if self.closed:
+                    return
+                file_path = self.queue.popleft() if len(self.queue) > 0 else None
+            if file_path is None:
+                # Nothing left to copy, a good time to write the index
+                self.saveIndex()
+                continue
+            try:
+                self.copy(file_path)
+            except Exception as e:
+                logging.warning('Could not copy {} to the local cache: {}'.format(file_path, e))
+
+    def copy(self, file_path):
+        stat = os.stat(file_path)
+        key = self.sourceKey(file_path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                return
+        if stat.st_size > self.max_bytes:
+            return
+
+        tmp_path = self.blob_dir / '.~{}'.format(threading.get_ident())
+        digest = hashlib.sha256()
+        try:
+            with open(file_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                for chunk in iter(lambda: src.read(self.chunk_size), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            after = os.stat(file_path)
+            if after.st_size != stat.st_size or after.st_mtime_ns != stat.st_mtime_ns:
+                # Rewritten while copying, the next pull tries again
+                raise IOError('{} changed while copying'.format(file_path))
+        except Exception:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+        blob = digest.hexdigest() + self.blobSuffix(file_path)
+        with self.lock:
+            blob_path = self.blob_dir / blob
+            if blob_path.exists():
+                tmp_path.unlink()
+            else:
+                os.replace(str(tmp_path), str(blob_path))
+                self.total_bytes += stat.st_size
+            previous = self.entries.pop(key, None)
+            self.entries[key] = {'blob': blob, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if previous is not None:
+                self.releaseBlob(previous)
+            self.evict()
+            self.index_dirty = True
+
+    def evict(self):
+        # Called with the lock held, keeps at least the most recent copy
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.releaseBlob(evicted)
+            self.index_dirty = True
+
+    def releaseBlob(self, entry):
+        # Called with the lock held, removes the copy once no entry refers to it
+        if any(other['blob'] == entry['blob'] for other in self.entries.values()):
+            return
+        try:
+            (self.blob_dir / entry['blob']).unlink()
+        except OSError as e:
+            logging.debug('Could not remove {} from the local cache: {}'.format(entry['blob'], e))
+        self.total_bytes -= entry['size']
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.queue.clear()
+            self.lock.notify()
+        # A copy from an unresponsive share may never finish, the thread is a daemon
+        self.thread.join(timeout=5.0)
+        self.saveIndex()
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Kernel used so far with vtkImageDilateErode3D, in VTK (i, j, k) order: 20 columns x 200 rows
+EYELID_KERNEL_SIZE = (20, 200, 1)
+
+#
+# Eyelid synthesis
+#
+'''
+NumPy replacement for the vtkImageDilateErode3D based eyelid creation shared by the
+segmentation tool and the EyelidSegPreProcess batch script.
+
+vtkImageDilateErode3D dilates with the ellipsoid that fits in the kernel box. The
+ellipse is split into one vertical run of rows per kernel column, each run is a 1D
+window that is evaluated in constant time per pixel with a cumulative sum, so the
+cost no longer depends on the 200 rows of the kernel. Output is identical to VTK.
+'''
+
+def kernelRuns(kernel_size):
+    # Same footprint as vtkImageEllipsoidSource, centered the same way as vtkImageDilateErode3D.
+    # Returns {(first row offset, last row offset): [column offsets]}
+    size_i, size_j = kernel_size[0], kernel_size[1]
+    middle_i, middle_j = size_i // 2, size_j // 2
+    center_i, center_j = (size_i - 1) * 0.5, (size_j - 1) * 0.5
+    radius_i, radius_j = size_i * 0.5, size_j * 0.5
+    runs = {}
+    hood_j = np.arange(size_j)
+    for hood_i in range(size_i):
+        s_i = ((hood_i - center_i) / radius_i) ** 2
+        inside = s_i + ((hood_j - center_j) / radius_j) ** 2 <= 1.0
+        if not inside.any():
+            continue
+        rows = hood_j[inside]
+        run = (int(rows[0]) - middle_j, int(rows[-1]) - middle_j)
+        runs.setdefault(run, []).append(hood_i - middle_i)
+    return runs
+
+
+def dilateMask(mask, kernel_size=EYELID_KERNEL_SIZE):
+    # Binary dilation of a 2D (rows, columns) mask, pixels outside of the image are ignored
+    num_rows, num_columns = mask.shape
+    # counts[r] = number of set pixels in rows [0, r) for every column
+    count_type = np.int16 if num_rows < np.iinfo(np.int16).max else np.int32
+    counts = np.zeros((num_rows + 1, num_columns), dtype=count_type)
+    np.cumsum(mask, axis=0, dtype=count_type, out=counts[1:])
+    rows = np.arange(num_rows)
+    dilated = np.zeros(mask.shape, dtype=bool)
+    for (first, last), column_offsets in kernelRuns(kernel_size).items():
+        top = np.clip(rows + first, 0, num_rows)
+        bottom = np.clip(rows + last + 1, 0, num_rows)
+        # Any set pixel within the vertical run of this pixel
+        vertical = counts[bottom] > counts[top]
+        for offset in column_offsets:
+            if offset >= 0:
+                if offset < num_columns:
+                    dilated[:, :num_columns - offset] |= vertical[:, offset:]
+            elif -offset < num_columns:
+                dilated[:, -offset:] |= vertical[:, :num_columns + offset]
+    return dilated
+
+
+def createEyelidLabelmap(mask, kernel_size=EYELID_KERNEL_SIZE, out=None):
+    '''
+    Adds the eyelid label (max label + 1) around the existing labels of mask, which can be
+    a 2D image or a (slices, rows, columns) volume as returned by slicer.util.arrayFromVolume.
+    Existing labels are kept as they are. Pass out=mask to update the labelmap in place.
+    '''
+    if kernel_size[2] != 1:
+        raise ValueError('Only single slice kernels are supported, got: {}'.format(kernel_size))
+    if out is None:
+        out = mask.copy()
+    elif out is not mask:
+        out[...] = mask
+    eyelid_label = mask.max() + 1
+    slices = [(mask, out)] if mask.ndim == 2 else zip(mask, out)
+    for slice_in, slice_out in slices:
+        labelled = slice_in > 0
+        eyelid = dilateMask(labelled, kernel_size)
+        eyelid &= ~labelled
+        slice_out[eyelid] = eyelid_label
+    return out
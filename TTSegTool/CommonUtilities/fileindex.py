@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+FileInfo = namedtuple('FileInfo', ['size', 'mtime_ns'])
+
+#
+# DatasetFileIndex
+#
+'''
+In memory index of the files referenced by the master csv. Every referenced directory is
+listed once with os.scandir, directories are listed in parallel threads since most of the
+time goes into round trips to the network share. Lookups then never touch the share, the
+tool refreshes single entries whenever it writes or removes a file itself, or finds one
+changed. Lookups may come from the prefetch worker threads as well.
+'''
+class DatasetFileIndex(object):
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        # normalized directory -> {normalized file name: FileInfo}, None if the directory is missing
+        self.directories = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def directoryKey(directory):
+        return os.path.normcase(os.path.normpath(str(directory)))
+
+    @staticmethod
+    def listDirectory(directory):
+        files = {}
+        try:
+            with os.scandir(str(directory)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            files[os.path.normcase(entry.name)] = FileInfo(stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        # Entry vanished while listing, or is not accessible
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except OSError as e:
+            logging.warning('Could not list {}: {}'.format(directory, e))
+            return None
+        return files
+
+    def clear(self):
+        with self.lock:
+            self.directories = {}
+
+    def scan(self, file_paths, directories=()):
+        '''
+        Lists the parent directory of every path in file_paths (empty paths are skipped)
+        and the extra directories, directories that were already listed are not listed again.
+        '''
+        to_list = {}
+        parents = [Path(p).parent for p in file_paths if len(str(p)) > 0]
+        with self.lock:
+            for directory in parents + [Path(d) for d in directories]:
+                key = self.directoryKey(directory)
+                if key not in self.directories:
+                    to_list[key] = directory
+        if len(to_list) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            listed = list(pool.map(self.listDirectory, to_list.values()))
+        with self.lock:
+            for key, files in zip(to_list.keys(), listed):
+                self.directories[key] = files
+        logging.debug('Indexed {} directories'.format(len(to_list)))
+
+    def stat(self, file_path):
+        # FileInfo of file_path, None if it does not exist
+        if len(str(file_path)) == 0:
+            return None
+        file_path = Path(file_path)
+        key = self.directoryKey(file_path.parent)
+        with self.lock:
+            listed = key in self.directories
+            files = self.directories.get(key)
+        if not listed:
+            # Listed outside the lock, a directory listed twice by two threads is harmless
+            files = self.listDirectory(file_path.parent)
+            with self.lock:
+                files = self.directories.setdefault(key, files)
+        if files is None:
+            return None
+        with self.lock:
+            return files.get(os.path.normcase(file_path.name))
+
+    def exists(self, file_path):
+        return self.stat(file_path) is not None
+
+    def refresh(self, file_path):
+        # Re-stats a single file after the tool wrote or removed it
+        file_path = Path(file_path)
+        key = self.directoryKey(file_path.parent)
+        with self.lock:
+            files = self.directories.get(key)
+        if files is None:
+            # Unknown or previously missing directory, it may have been created since
+            files = self.listDirectory(file_path.parent)
+            with self.lock:
+                self.directories[key] = files
+            return self.stat(file_path)
+        try:
+            stat = os.stat(str(file_path))
+            info = FileInfo(stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            info = None
+        with self.lock:
+            if info is None:
+                files.pop(os.path.normcase(file_path.name), None)
+            else:
+                files[os.path.normcase(file_path.name)] = info
+        return info
@@ -0,0 +1,86 @@
+import numpy as np
+
+#
+# GradingState
+#
+'''
+Packed per row flags (graded, blurry, eye-angle-wrong, ...) of the master csv, one bit per
+flag in a uint8 array. Counts are kept up to date on every change, so they are O(1).
+Searches for the next/previous row matching a set of flags run vectorized over growing
+chunks starting next to the current row, so a nearby hit only looks at a few rows and a
+search over 100k+ rows stays well under a millisecond.
+'''
+class GradingState(object):
+
+    def __init__(self, keys):
+        if len(keys) > 8:
+            raise ValueError('At most 8 flags are supported, got: {}'.format(keys))
+        self.keys = list(keys)
+        self.bits = {key: np.uint8(1 << i) for i, key in enumerate(self.keys)}
+        self.flags = np.zeros(0, dtype=np.uint8)
+        self.counts = {key: 0 for key in self.keys}
+
+    def __len__(self):
+        return len(self.flags)
+
+    def reset(self, rows):
+        # rows are the image_list dicts, missing keys count as 0
+        self.flags = np.zeros(len(rows), dtype=np.uint8)
+        for key, bit in self.bits.items():
+            column = np.fromiter((int(row.get(key, 0)) != 0 for row in rows), dtype=bool, count=len(rows))
+            self.flags[column] |= bit
+            self.counts[key] = int(np.count_nonzero(column))
+
+    def get(self, row_id, key):
+        return 1 if self.flags[row_id] & self.bits[key] else 0
+
+    def set(self, row_id, key, value):
+        bit = self.bits[key]
+        was_set = bool(self.flags[row_id] & bit)
+        if bool(value) == was_set:
+            return
+        if value:
+            self.flags[row_id] |= bit
+            self.counts[key] += 1
+        else:
+            self.flags[row_id] &= ~bit
+            self.counts[key] -= 1
+
+    def updateRow(self, row_id, row):
+        for key in self.keys:
+            if key in row:
+                self.set(row_id, key, int(row[key]) != 0)
+
+    def count(self, key):
+        return self.counts[key]
+
+    def findNext(self, start, match, forward=True, chunk_size=1024):
+        '''
+        Returns the first row after (forward) or before start whose flags equal match, a dict
+        {key: 0 or 1} of the flags to check (others are ignored), None if there is none.
+        '''
+        mask = np.uint8(0)
+        value = np.uint8(0)
+        for key, flag in match.items():
+            mask |= self.bits[key]
+            if flag:
+                value |= self.bits[key]
+        if forward:
+            begin = start + 1
+            while begin < len(self.flags):
+                end = min(begin + chunk_size, len(self.flags))
+                hits = np.flatnonzero((self.flags[begin:end] & mask) == value)
+                if len(hits) > 0:
+                    return begin + int(hits[0])
+                begin = end
+                chunk_size *= 2
+        else:
+            end = min(start, len(self.flags))
+            while end > 0:
+                begin = max(end - chunk_size, 0)
+                hits = np.flatnonzero((self.flags[begin:end] & mask) == value)
+                if len(hits) > 0:
+                    return begin + int(hits[-1])
+                end = begin
+                chunk_size *= 2
+        return None
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+#
+# SessionJournal
+#
+'''
+Append-only journal of the master csv edits made since the last full write of the master
+file. Every record is one JSON line holding only the fields that changed for one row,
+rows are identified by their image path. Lines are flushed to the OS right away, which
+survives a crash of Slicer itself, fsync (surviving a crash of the machine) is batched to
+at most one every fsync_interval seconds. Once closed, records and truncates are ignored.
+'''
+class SessionJournal(object):
+
+    def __init__(self, journal_path, fsync_interval=2.0):
+        self.journal_path = Path(journal_path)
+        self.fsync_interval = fsync_interval
+        self.last_sync = time.monotonic()
+        self.records = 0
+        self.fh = open(self.journal_path, 'a', encoding='utf-8', newline='\n')
+        if self.fh.tell() > 0:
+            with open(self.journal_path, 'rb') as previous:
+                previous.seek(-1, os.SEEK_END)
+                if previous.read(1) != b'\n':
+                    # Close off a line cut short by a crash, so it does not swallow the next record
+                    self.fh.write('\n')
+
+    def record(self, image_key, fields):
+        if len(fields) == 0 or self.fh is None:
+            return
+        self.fh.write(json.dumps({'image': image_key, 'fields': fields}, separators=(',', ':')) + '\n')
+        self.fh.flush()
+        self.records += 1
+        if time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.fh is None:
+            return
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.last_sync = time.monotonic()
+
+    def truncate(self):
+        # The master file now holds everything journaled so far
+        if self.fh is None:
+            return
+        self.fh.seek(0)
+        self.fh.truncate()
+        self.sync()
+
+    def close(self):
+        if self.fh is not None:
+            self.sync()
+            self.fh.close()
+            self.fh = None
+
+
+def replayJournal(journal_path):
+    '''
+    Reads a journal back into {image key: {field: value}}, later records win. A last line
+    cut short by a crash is skipped.
+    '''
+    changes = {}
+    journal_path = Path(journal_path)
+    if not journal_path.exists():
+        return changes
+    with open(journal_path, 'r', encoding='utf-8') as fh:
+        for line_number, line in enumerate(fh):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('Skipping unreadable journal line {} in {}'.format(line_number + 1, journal_path))
+                continue
+            changes.setdefault(record['image'], {}).update(record['fields'])
+    return changes
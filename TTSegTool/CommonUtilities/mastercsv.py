@@ -0,0 +1,65 @@
+import io
+import os
+from csv import DictWriter
+from pathlib import Path
+
+#
+# MasterCSVWriter
+#
+'''
+Keeps every row of the master csv serialized, so that saving only serializes the rows
+marked dirty since the last save and writes out the joined lines. Files are written next
+to the target and renamed over it, a crash leaves either the old or the new file behind.
+'''
+class MasterCSVWriter(object):
+
+    def __init__(self):
+        self.lines = []
+        self.fieldnames = None
+
+    def reset(self, num_rows, fieldnames=None):
+        self.lines = [None] * num_rows
+        self.fieldnames = list(fieldnames) if fieldnames is not None else None
+
+    def markDirty(self, row_id):
+        if row_id in range(len(self.lines)):
+            self.lines[row_id] = None
+
+    def numDirty(self):
+        return sum(1 for line in self.lines if line is None)
+
+    def serialize(self, rows, to_csv_row):
+        '''
+        Returns the csv text of rows, to_csv_row(row) gives the dict that goes in the file.
+        Raises KeyError (like DictWriter) if a row has keys that are not in the header.
+        '''
+        if len(self.lines) != len(rows):
+            self.reset(len(rows), self.fieldnames)
+        if self.fieldnames is None:
+            self.fieldnames = list(rows[0].keys()) if len(rows) > 0 else []
+        buffer = io.StringIO()
+        writer = DictWriter(buffer, fieldnames=self.fieldnames)
+        writer.writeheader()
+        header = buffer.getvalue()
+        for row_id, line in enumerate(self.lines):
+            if line is None:
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(to_csv_row(rows[row_id]))
+                self.lines[row_id] = buffer.getvalue()
+        return header + ''.join(self.lines)
+
+
+def atomicWrite(file_path, text):
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name('.~' + file_path.name)
+    try:
+        with open(tmp_path, 'w', newline='') as fh:
+            fh.write(text)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(str(tmp_path), str(file_path))
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
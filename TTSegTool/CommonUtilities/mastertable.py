@@ -0,0 +1,83 @@
+import qt
+
+#
+# MasterTableModel
+#
+'''
+Table model over the rows of the master csv (the widget's image_list). The view only asks
+for the cells that are visible, so no item is created per cell anymore. Checkbox columns
+and the comments column are edited in place, edits are written straight into the rows.
+'''
+class MasterTableModel(qt.QAbstractTableModel):
+
+    def __init__(self, checkbox_keys, editable_keys=('comments',), parent=None):
+        qt.QAbstractTableModel.__init__(self, parent)
+        self.checkbox_keys = list(checkbox_keys)
+        self.editable_keys = list(editable_keys)
+        self.rows = []
+        self.keys = []
+
+    def setRows(self, rows, keys):
+        # rows is shared with the caller, not copied
+        self.beginResetModel()
+        self.rows = rows
+        self.keys = list(keys)
+        self.endResetModel()
+
+    def rowChanged(self, row):
+        # Call after changing image_list[row] outside of the view
+        if row in range(len(self.rows)) and len(self.keys) > 0:
+            self.dataChanged(self.index(row, 0), self.index(row, len(self.keys) - 1))
+
+    def rowCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(self.keys)
+
+    def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+        if role != qt.Qt.DisplayRole:
+            return None
+        if orientation == qt.Qt.Horizontal:
+            return self.keys[section] if section in range(len(self.keys)) else None
+        return str(section + 1)
+
+    def data(self, index, role=qt.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        key = self.keys[index.column()]
+        value = self.rows[index.row()][key]
+        if key in self.checkbox_keys:
+            if role == qt.Qt.CheckStateRole:
+                return qt.Qt.Unchecked if value == 0 else qt.Qt.Checked
+            return None
+        if role in (qt.Qt.DisplayRole, qt.Qt.EditRole):
+            return "{}".format(value)
+        if role == qt.Qt.TextAlignmentRole:
+            return qt.Qt.AlignCenter
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return qt.Qt.NoItemFlags
+        flags = qt.Qt.ItemIsEnabled | qt.Qt.ItemIsSelectable
+        key = self.keys[index.column()]
+        if key in self.checkbox_keys:
+            flags |= qt.Qt.ItemIsUserCheckable
+        elif key in self.editable_keys:
+            flags |= qt.Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=qt.Qt.EditRole):
+        if not index.isValid():
+            return False
+        key = self.keys[index.column()]
+        row = self.rows[index.row()]
+        if key in self.checkbox_keys and role == qt.Qt.CheckStateRole:
+            row[key] = 0 if int(value) == qt.Qt.Unchecked else 1
+        elif key in self.editable_keys and role == qt.Qt.EditRole:
+            row[key] = "{}".format(value)
+        else:
+            return False
+        self.dataChanged(index, index)
+        return True
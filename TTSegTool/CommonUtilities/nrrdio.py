@@ -0,0 +1,326 @@
+import os
+import re
+import shutil
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+#
+# NRRD header handling
+#
+'''
+Minimal NRRD header reader/writer. Fields ("field: value") and key/value pairs
+("key:=value") are kept in file order, the voxel payload of attached NRRD files can be
+streamed from one file to another without decoding it.
+'''
+class NrrdHeader(object):
+
+    def __init__(self, magic=b'NRRD0004', fields=None, keyvalues=None):
+        self.magic = magic
+        self.fields = fields if fields is not None else OrderedDict()
+        self.keyvalues = keyvalues if keyvalues is not None else OrderedDict()
+
+    def isDetached(self):
+        return 'data file' in self.fields or 'datafile' in self.fields
+
+    def tobytes(self):
+        lines = [self.magic]
+        for key, value in self.fields.items():
+            lines.append('{}: {}'.format(key, value).encode('latin-1'))
+        for key, value in self.keyvalues.items():
+            lines.append('{}:={}'.format(key, value).encode('latin-1'))
+        # Blank line ends the header, the payload follows
+        return b'\n'.join(lines) + b'\n\n'
+
+
+def readHeader(fh):
+    # Leaves fh positioned at the start of the payload
+    magic = fh.readline().rstrip(b'\r\n')
+    if not magic.startswith(b'NRRD'):
+        raise IOError('Not a NRRD file: {}'.format(getattr(fh, 'name', fh)))
+    header = NrrdHeader(magic)
+    for line in iter(fh.readline, b''):
+        line = line.rstrip(b'\r\n').decode('latin-1')
+        if len(line) == 0:
+            break
+        if line.startswith('#'):
+            continue
+        if ':=' in line:
+            key, value = line.split(':=', 1)
+            header.keyvalues[key] = value
+        else:
+            key, value = line.split(':', 1)
+            header.fields[key.strip()] = value.strip()
+    return header
+
+
+def readHeaderFile(file_path):
+    with open(file_path, 'rb') as fh:
+        return readHeader(fh)
+
+
+def rewriteHeader(in_path, out_path, header, chunk_size=1 << 20):
+    '''
+    Writes header followed by the payload of in_path, copied byte for byte. The header
+    must describe the same payload (type, sizes, encoding), only metadata may differ.
+    '''
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name('.~' + out_path.name)
+    with open(in_path, 'rb') as src:
+        original = readHeader(src)
+        if original.isDetached():
+            raise UnsupportedNrrdError('Detached NRRD headers are not supported: {}'.format(in_path))
+        with open(tmp_path, 'wb') as dst:
+            dst.write(header.tobytes())
+            shutil.copyfileobj(src, dst, chunk_size)
+    os.replace(str(tmp_path), str(out_path))
+
+
+#
+# Segmentation (.seg.nrrd) metadata
+#
+SEGMENT_KEY_ORDER = ['Color', 'ColorAutoGenerated', 'Extent', 'ID', 'LabelValue', 'Layer', 'Name', 'NameAutoGenerated', 'Tags']
+EMPTY_EXTENT = '0 -1 0 -1 0 -1'
+
+
+def numberOfSegments(header):
+    count = 0
+    while 'Segment{}_ID'.format(count) in header.keyvalues:
+        count += 1
+    return count
+
+
+def segmentLabelValues(header):
+    labels = []
+    for segment_number in range(numberOfSegments(header)):
+        layer = int(header.keyvalues.get('Segment{}_Layer'.format(segment_number), 0))
+        label = int(header.keyvalues.get('Segment{}_LabelValue'.format(segment_number), 1))
+        labels.append((layer, label))
+    return labels
+
+
+def appendSegment(header, segment_id, name, color, label_value, layer=0, extent=EMPTY_EXTENT):
+    segment_number = numberOfSegments(header)
+    values = {
+        'Color': ' '.join('{:g}'.format(c) for c in color),
+        'ColorAutoGenerated': '0',
+        'Extent': extent,
+        'ID': segment_id,
+        'LabelValue': str(label_value),
+        'Layer': str(layer),
+        'Name': name,
+        'NameAutoGenerated': '0',
+        'Tags': '|',
+    }
+    for key in SEGMENT_KEY_ORDER:
+        header.keyvalues['Segment{}_{}'.format(segment_number, key)] = values[key]
+    return segment_number
+
+
+def addSegmentationHeader(header, labelmap, names, colors):
+    '''
+    Turns the header of a plain labelmap NRRD into a single layer .seg.nrrd header,
+    one segment per label present in labelmap (the decoded (k, j, i) payload).
+    '''
+    segments = []
+    for label in np.unique(labelmap):
+        if label == 0:
+            continue
+        label = int(label)
+        segments.append(('Segment_{}'.format(label), names.get(label, 'Segment_{}'.format(label)), colors.get(label, (0.5, 0.5, 0.5)), label))
+    return addSegments(header, labelmap, segments)
+
+
+def addSegments(header, labelmap, segments):
+    '''
+    Single layer .seg.nrrd header with the given (segment id, name, color, label value)
+    segments of labelmap, segments without voxels are kept with an empty extent.
+    '''
+    header.keyvalues['Segmentation_ContainedRepresentationNames'] = 'Binary labelmap|'
+    header.keyvalues['Segmentation_MasterRepresentation'] = 'Binary labelmap'
+    header.keyvalues['Segmentation_ReferenceImageExtentOffset'] = '0 0 0'
+    for segment_id, name, color, label in segments:
+        appendSegment(header, segment_id, name, color, label, extent=labelExtent(labelmap, label))
+    return header
+
+
+def labelExtent(labelmap, label):
+    # Extent in i, j, k order like Slicer writes it, EMPTY_EXTENT if the label is not there
+    inside = labelmap == label
+    if not inside.any():
+        return EMPTY_EXTENT
+    extent = []
+    for axis in (2, 1, 0):
+        present = np.flatnonzero(inside.any(axis=tuple(a for a in range(3) if a != axis)))
+        extent.extend([present[0], present[-1]])
+    return ' '.join(str(e) for e in extent)
+
+
+#
+# Voxel payload
+#
+'''
+Reads and writes attached, scalar NRRD files straight to and from numpy arrays in the
+Slicer (k, j, i) layout, without SimpleITK or the scene. Covers the label maps and the
+single layer .seg.nrrd files of the tool, anything else (detached headers, multi layer
+segmentations, other encodings, voxel types) raises UnsupportedNrrdError so callers can
+fall back.
+'''
+NRRD_TYPES = {
+    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+    'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+    'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8', 'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+    'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+    'float': 'f4', 'double': 'f8',
+}
+TYPE_NAMES = {'u1': 'unsigned char', 'i1': 'signed char', 'u2': 'unsigned short', 'i2': 'short', 'u4': 'unsigned int',
+              'i4': 'int', 'u8': 'unsigned long long int', 'i8': 'long long int', 'f4': 'float', 'f8': 'double'}
+# gzip level and strategy of each compression setting, None writes the voxels as they are.
+# Run length matching is about as fast as level 1 on label maps and close to level 9 in size
+COMPRESSION_LEVELS = OrderedDict([('raw', None), ('fast', (1, zlib.Z_RLE)), ('full', (9, zlib.Z_DEFAULT_STRATEGY))])
+# What the tool and the scripts write unless told otherwise
+DEFAULT_COMPRESSION = 'fast'
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+RAS_SPACES = ['right-anterior-superior', 'RAS']
+LPS_SPACES = ['left-posterior-superior', 'LPS']
+
+
+class UnsupportedNrrdError(ValueError):
+    # A file or array outside what this module covers, SimpleITK or Slicer can handle it
+    pass
+
+
+def isNrrdPath(file_path):
+    return str(file_path).lower().endswith('.nrrd')
+
+
+def parseVectors(text):
+    # "(1,0,0) (0,1,0) none" -> [[1, 0, 0], [0, 1, 0], None]
+    vectors = []
+    for vector, none in re.findall(r'\(([^)]*)\)|(none)', text):
+        vectors.append(None if none else [float(v) for v in vector.split(',')])
+    return vectors
+
+
+def formatVector(vector):
+    # + 0.0 turns -0 into 0
+    return '(' + ','.join('{:.17g}'.format(v + 0.0) for v in vector) + ')'
+
+
+def ijkToRAS(header):
+    # IJK to RAS matrix of a 2 or 3 dimensional scalar NRRD, ITK's LPS when no space is given
+    dimension = int(header.fields['dimension'])
+    ijk_to_space = np.eye(4)
+    if 'space directions' in header.fields:
+        directions = parseVectors(header.fields['space directions'])
+        if len(directions) != dimension or any(d is None or len(d) > 3 for d in directions):
+            raise UnsupportedNrrdError('Unsupported space directions: {}'.format(header.fields['space directions']))
+        for axis, direction in enumerate(directions):
+            ijk_to_space[:len(direction), axis] = direction
+        if 'space origin' in header.fields:
+            origin = parseVectors(header.fields['space origin'])[0]
+            ijk_to_space[:len(origin), 3] = origin
+    elif 'spacings' in header.fields:
+        for axis, spacing in enumerate(header.fields['spacings'].split()):
+            ijk_to_space[axis, axis] = float(spacing) if spacing.lower() != 'nan' else 1.0
+    space = header.fields.get('space', 'left-posterior-superior')
+    if space in RAS_SPACES:
+        return ijk_to_space
+    if space not in LPS_SPACES:
+        raise UnsupportedNrrdError('Unsupported NRRD space: {}'.format(space))
+    ijk_to_ras = ijk_to_space.copy()
+    ijk_to_ras[:3] = LPS_TO_RAS.dot(ijk_to_space[:3])
+    return ijk_to_ras
+
+
+def readNrrd(file_path):
+    '''
+    Returns the header and the voxels as a (k, j, i) array, 2D files as a single slice.
+    '''
+    with open(file_path, 'rb') as fh:
+        header = readHeader(fh)
+        fields = header.fields
+        if header.isDetached():
+            raise UnsupportedNrrdError('Detached NRRD headers are not supported: {}'.format(file_path))
+        dimension = int(fields['dimension'])
+        if dimension not in (2, 3) or any(kind not in ('domain', 'space') for kind in fields.get('kinds', 'domain').split()):
+            raise UnsupportedNrrdError('Only scalar 2D and 3D NRRD files are supported: {}'.format(file_path))
+        if int(fields.get('line skip', fields.get('lineskip', 0))) != 0 or int(fields.get('byte skip', fields.get('byteskip', 0))) != 0:
+            raise UnsupportedNrrdError('Skipped lines or bytes are not supported: {}'.format(file_path))
+        type_code = NRRD_TYPES.get(fields['type'])
+        encoding = fields['encoding']
+        if type_code is None or encoding not in ('raw', 'gzip', 'gz'):
+            raise UnsupportedNrrdError('Unsupported NRRD type or encoding: {} {}'.format(fields['type'], encoding))
+        payload = fh.read()
+    if encoding != 'raw':
+        # 47: gzip or zlib stream, whichever the header says
+        payload = zlib.decompress(payload, 47)
+    dtype = np.dtype(('>' if fields.get('endian', 'little') == 'big' else '<') + type_code)
+    sizes = [int(s) for s in fields['sizes'].split()]
+    count = int(np.prod(sizes))
+    if len(payload) < count * dtype.itemsize:
+        raise IOError('Truncated NRRD payload: {}'.format(file_path))
+    array = np.frombuffer(payload, dtype=dtype, count=count).reshape(sizes[::-1])
+    # Native byte order and writable, like the arrays SimpleITK returns
+    array = array.astype(dtype.newbyteorder('='))
+    if dimension == 2:
+        array = array[np.newaxis, ...]
+    return header, array
+
+
+def writeNrrd(file_path, array, ijk_to_ras, keyvalues=None, compression=DEFAULT_COMPRESSION, chunk_size=1 << 20):
+    '''
+    Writes a scalar (k, j, i) array as an attached NRRD file in LPS space, the way ITK
+    writes it. keyvalues go into the header as is (e.g. the .seg.nrrd segment metadata).
+    compression is one of COMPRESSION_LEVELS. The file is written next to the target and
+    renamed, readers never see a half written file. A failed write leaves nothing behind.
+    '''
+    if compression not in COMPRESSION_LEVELS:
+        raise ValueError('Unknown compression {}, use one of {}'.format(compression, list(COMPRESSION_LEVELS)))
+    if array.ndim != 3:
+        raise UnsupportedNrrdError('Expected a scalar (k, j, i) array, got shape {}'.format(array.shape))
+    type_code = array.dtype.kind + str(array.dtype.itemsize)
+    if type_code not in TYPE_NAMES:
+        raise UnsupportedNrrdError('Unsupported voxel type: {}'.format(array.dtype))
+    level = COMPRESSION_LEVELS[compression]
+    ijk_to_lps = LPS_TO_RAS.dot(np.asarray(ijk_to_ras)[:3])
+
+    header = NrrdHeader()
+    header.fields['type'] = TYPE_NAMES[type_code]
+    header.fields['dimension'] = '3'
+    header.fields['space'] = 'left-posterior-superior'
+    header.fields['sizes'] = ' '.join(str(s) for s in array.shape[::-1])
+    header.fields['space directions'] = ' '.join(formatVector(ijk_to_lps[:, axis]) for axis in range(3))
+    header.fields['kinds'] = 'domain domain domain'
+    if array.dtype.itemsize > 1:
+        header.fields['endian'] = 'little'
+    header.fields['encoding'] = 'raw' if level is None else 'gzip'
+    header.fields['space origin'] = formatVector(ijk_to_lps[:, 3])
+    if keyvalues is not None:
+        header.keyvalues.update(keyvalues)
+
+    data = memoryview(np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))).cast('B')
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name('.~' + file_path.name)
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(header.tobytes())
+            if level is None:
+                fh.write(data)
+            else:
+                # 31: gzip container, what NRRD readers expect for the gzip encoding
+                compressor = zlib.compressobj(level[0], zlib.DEFLATED, 31, 9, level[1])
+                for start in range(0, len(data), chunk_size):
+                    fh.write(compressor.compress(data[start:start + chunk_size]))
+                fh.write(compressor.flush())
+        os.replace(str(tmp_path), str(file_path))
+    except BaseException:
+        # e.g. a full share, the next write to the same file would find the partial one
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
@@ -0,0 +1,113 @@
+import logging
+import sqlite3
+import threading
+from csv import DictReader, DictWriter
+from pathlib import Path
+
+PATCH_FIELDS = ['x', 'y', 'label']
+
+#
+# PatchStore
+#
+'''
+Single per user SQLite file holding the patches of every image (image, x, y, label),
+indexed by image. All patches are loaded in one query at session start and kept in
+memory, saving an image replaces its rows in one transaction. Images changed since the
+last export are tracked, so the former one csv per image layout can still be written
+out for the tools that read it. The connection is shared with the autosave worker
+thread, a lock keeps the statements apart.
+'''
+class PatchStore(object):
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.lock = threading.Lock()
+        # Rollback journal, WAL does not work on network shares
+        self.connection = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS patches ('
+                                    'image TEXT NOT NULL, position INTEGER NOT NULL, '
+                                    'x INTEGER NOT NULL, y INTEGER NOT NULL, label TEXT NOT NULL, '
+                                    'PRIMARY KEY (image, position))')
+        self.patches = {}
+        self.unexported = set()
+
+    def load(self):
+        # Bulk load, {image: [{'x', 'y', 'label'}]} in the order they were added
+        self.patches = {}
+        with self.lock:
+            cursor = self.connection.execute('SELECT image, x, y, label FROM patches ORDER BY image, position')
+            for image, x, y, label in cursor:
+                self.patches.setdefault(image, []).append({'x': x, 'y': y, 'label': label})
+        return self.patches
+
+    def contains(self, image):
+        return image in self.patches
+
+    def get(self, image):
+        return self.patches.get(image, [])
+
+    def put(self, image, rows):
+        '''
+        Updates the in memory copy, commit() writes it to the database (can run on a worker).
+        Returns the rows to commit, None when they are the ones already stored.
+        '''
+        rows = [{'x': int(row['x']), 'y': int(row['y']), 'label': row['label']} for row in rows]
+        if image in self.patches and rows == self.patches[image]:
+            return None
+        self.patches[image] = rows
+        self.unexported.add(image)
+        return rows
+
+    def commit(self, image, rows):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM patches WHERE image = ?', (image,))
+            self.connection.executemany('INSERT INTO patches (image, position, x, y, label) VALUES (?, ?, ?, ?, ?)',
+                                        [(image, position, row['x'], row['y'], row['label']) for position, row in enumerate(rows)])
+
+    def importCSVs(self, csv_paths):
+        '''
+        Imports the per image csv files of {image: csv path} for images not in the store yet,
+        returns the number of images imported.
+        '''
+        imported = {}
+        for image, csv_path in csv_paths.items():
+            if image in self.patches:
+                continue
+            try:
+                with open(csv_path, 'r', newline='') as fh:
+                    rows = [row for row in DictReader(fh)]
+            except (IOError, UnicodeDecodeError) as e:
+                logging.warning('Could not import the patches file {}: {}'.format(csv_path, e))
+                continue
+            try:
+                imported[image] = [{'x': int(row['x']), 'y': int(row['y']), 'label': row['label']} for row in rows]
+            except (KeyError, ValueError) as e:
+                logging.warning('Error parsing the patches file {}: {}'.format(csv_path, e))
+        with self.lock, self.connection:
+            for image, rows in imported.items():
+                self.connection.executemany('INSERT OR REPLACE INTO patches (image, position, x, y, label) VALUES (?, ?, ?, ?, ?)',
+                                            [(image, position, row['x'], row['y'], row['label']) for position, row in enumerate(rows)])
+        self.patches.update(imported)
+        return len(imported)
+
+    def takeUnexported(self):
+        # Snapshot of the images changed since the last export, [(image, rows)]
+        unexported = [(image, list(self.patches.get(image, []))) for image in sorted(self.unexported)]
+        self.unexported = set()
+        return unexported
+
+    def markUnexported(self, images):
+        self.unexported.update(images)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def exportCSV(rows, csv_path):
+    # Same layout the tool used to write per image
+    with open(csv_path, 'w', newline='') as fh:
+        writer = DictWriter(fh, PATCH_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
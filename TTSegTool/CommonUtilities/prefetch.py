@@ -0,0 +1,70 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from CommonUtilities import volumeio
+
+#
+# ImagePrefetcher
+#
+'''
+Decodes the images and segmentations of the upcoming rows on worker threads.
+Only the file reads happen in the pool, prefetch() and take() are meant to be called
+from the main thread which then builds the MRML nodes out of the decoded buffers.
+'''
+class ImagePrefetcher(object):
+
+    def __init__(self, max_workers=2, read=volumeio.readVolume):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='TTSegToolPrefetch')
+        # file path -> DecodedVolume, runs on the workers
+        self.read = read
+        self.pending = OrderedDict() # file path -> future of a DecodedVolume
+
+    def prefetch(self, file_paths):
+        wanted = [str(p) for p in file_paths if p is not None and len(str(p)) > 0]
+        # Drop everything that fell out of the window, so memory stays bounded
+        for path in list(self.pending.keys()):
+            if path not in wanted:
+                self.pending.pop(path).cancel()
+        for path in wanted:
+            if path not in self.pending:
+                self.pending[path] = self.executor.submit(self.read, path)
+
+    def request(self, file_path):
+        # Single decode on top of the prefetch window, e.g. the full resolution of a shown preview
+        path = str(file_path)
+        if path not in self.pending:
+            self.pending[path] = self.executor.submit(self.read, path)
+
+    def isPending(self, file_path):
+        return str(file_path) in self.pending
+
+    def isDone(self, file_path):
+        # True once take() would not block
+        future = self.pending.get(str(file_path))
+        return future is not None and future.done()
+
+    def take(self, file_path):
+        future = self.pending.pop(str(file_path), None)
+        if future is None:
+            return None
+        try:
+            # Blocks only if the decode for this file is still running
+            return future.result()
+        except Exception as e:
+            logging.warning('Prefetch of {} failed, falling back to a regular load: {}'.format(file_path, e))
+            return None
+
+    def discard(self, file_path):
+        future = self.pending.pop(str(file_path), None)
+        if future is not None:
+            future.cancel()
+
+    def clear(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown(wait=False)
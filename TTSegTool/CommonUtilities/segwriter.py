@@ -0,0 +1,88 @@
+import logging
+import queue
+import threading
+import time
+
+from CommonUtilities import nrrdio
+from CommonUtilities import volumeio
+
+#
+# SegmentationWriter
+#
+'''
+Writes labelmap snapshots (volumeio.DecodedVolume) to disk in submission order on a
+single background thread. The queue is bounded so a slow share pushes back on the
+grader instead of piling up snapshots in memory. Results are collected by the main
+thread with takeResults(), nothing in here touches Qt or the MRML scene.
+'''
+class SegmentationWriter(object):
+
+    def __init__(self, max_queued=4, compression=nrrdio.DEFAULT_COMPRESSION, crop=False, timer=None):
+        self.compression = compression # see nrrdio.COMPRESSION_LEVELS
+        self.crop = crop # only the box around the labels is written, see volumeio.cropToContent
+        self.timer = timer # optional timing.SessionTimer, records a span per write
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self.pending = {} # file path -> [latest snapshot, number of queued writes]
+        self.results = [] # (snapshot, error or None) in completion order
+        self.thread = threading.Thread(target=self.run, name='TTSegToolSegmentationWriter', daemon=True)
+        self.thread.start()
+
+    def submit(self, snapshot):
+        key = str(snapshot.file_path)
+        with self.lock:
+            entry = self.pending.setdefault(key, [snapshot, 0])
+            entry[0] = snapshot
+            entry[1] += 1
+        # Blocks when max_queued writes are already waiting
+        self.queue.put(snapshot)
+
+    def pendingSnapshot(self, file_path):
+        # Newest content of a file whose write has not finished yet
+        with self.lock:
+            entry = self.pending.get(str(file_path))
+            return entry[0] if entry is not None else None
+
+    def hasPendingWrites(self):
+        with self.lock:
+            return len(self.pending) > 0
+
+    def takeResults(self):
+        with self.lock:
+            results = self.results
+            self.results = []
+        return results
+
+    def flush(self):
+        self.queue.join()
+
+    def shutdown(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                self.queue.task_done()
+                return
+            error = None
+            try:
+                start = time.perf_counter()
+                volumeio.writeVolume(volumeio.cropToContent(snapshot) if self.crop else snapshot, snapshot.file_path, self.compression)
+                if self.timer is not None:
+                    self.timer.record('segmentation write', (time.perf_counter() - start) * 1000.0, snapshot.name)
+                logging.info('Wrote the segmentation: {}'.format(snapshot.file_path))
+            except Exception as e:
+                error = e
+                logging.error('Error writing the segmentation: {} \n {}'.format(snapshot.file_path, e))
+            with self.lock:
+                key = str(snapshot.file_path)
+                entry = self.pending.get(key)
+                if entry is not None:
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self.pending[key]
+                self.results.append((snapshot, error))
+            self.queue.task_done()
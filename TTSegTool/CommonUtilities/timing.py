@@ -0,0 +1,66 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+#
+# SessionTimer
+#
+'''
+Timing spans around the hot paths of the tool. Every span is appended as one JSON line
+(stage, image, start time, duration in ms, thread) to the per session log, and the last
+max_samples durations of each stage are kept for the p50/p95 summary. Spans can be
+recorded from the background writer threads as well.
+'''
+class SessionTimer(object):
+
+    def __init__(self, log_path=None, max_samples=1000):
+        self.max_samples = max_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.fh = None
+        if log_path is not None:
+            try:
+                self.fh = open(str(log_path), 'a', encoding='utf-8')
+            except IOError as e:
+                logging.warning('Could not open the timing log {}: {}'.format(log_path, e))
+        self.log_path = log_path
+
+    @contextmanager
+    def span(self, stage, image=None):
+        start = time.time()
+        start_counter = time.perf_counter()
+        try:
+            yield
+        finally:
+            # image may be a callable, evaluated when the span ends
+            self.record(stage, (time.perf_counter() - start_counter) * 1000.0, image() if callable(image) else image, start)
+
+    def record(self, stage, duration_ms, image=None, start=None):
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=self.max_samples)).append(duration_ms)
+            if self.fh is not None:
+                self.fh.write(json.dumps({
+                    'stage': stage,
+                    'image': None if image is None else str(image),
+                    'start': round(start if start is not None else time.time(), 3),
+                    'ms': round(duration_ms, 3),
+                    'thread': threading.current_thread().name,
+                }) + '\n')
+                self.fh.flush()
+
+    def summary(self):
+        # [(stage, count, p50 ms, p95 ms)] sorted by stage
+        with self.lock:
+            samples = {stage: np.array(values) for stage, values in self.samples.items()}
+        return [(stage, len(values), float(np.percentile(values, 50)), float(np.percentile(values, 95)))
+                for stage, values in sorted(samples.items()) if len(values) > 0]
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
@@ -1,6 +1,15 @@
 import vtk, ctk, slicer
 import logging
 import os
+import sys
+try:
+    import psutil
+except ImportError:
+    # Optional, currentProcessRSS falls back to the OS specific calls
+    psutil = None
+
+from CommonUtilities import nrrdio
+from CommonUtilities import volumeio
 
 #
 # MRMLUtility
@@ -109,6 +118,165 @@ class MRMLUtility(object):
             logging.info("Saving %s in %s", file_name, case_dir)
             slicer.util.saveNode(node, file_path)
 
+    @staticmethod
+    def createVolumeNodeFromDecoded(decoded, node_name=None, show=True):
+        # Main thread counterpart of volumeio.readVolume, same geometry as slicer.util.loadVolume
+        if node_name is None:
+            node_name = decoded.name
+        node_class = 'vtkMRMLVectorVolumeNode' if decoded.isVector() else 'vtkMRMLScalarVolumeNode'
+        volume_node = slicer.util.addVolumeFromArray(decoded.array, ijkToRAS=decoded.ijk_to_ras, name=node_name, nodeClassName=node_class)
+        if show:
+            slicer.util.setSliceViewerLayers(background=volume_node, fit=True)
+        return volume_node
+
+    @staticmethod
+    def updateVolumeNodeFromDecoded(volume_node, decoded, node_name=None):
+        '''
+        Swaps voxels, geometry and name of an existing volume node, nothing is added to or
+        removed from the scene. Returns False if the node cannot hold the volume (scalar vs
+        RGB), a new node is needed then.
+        '''
+        if volume_node.IsA('vtkMRMLVectorVolumeNode') != decoded.isVector():
+            return False
+        if node_name is None:
+            node_name = decoded.name
+        was_modifying = volume_node.StartModify()
+        volume_node.SetName(node_name)
+        volume_node.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(decoded.ijk_to_ras))
+        slicer.util.updateVolumeFromArray(volume_node, decoded.array)
+        volume_node.EndModify(was_modifying)
+        return True
+
+    @staticmethod
+    def isNodeInScene(node):
+        # False for None and for nodes removed from the scene, e.g. by a scene clear
+        return node is not None and slicer.mrmlScene.IsNodePresent(node)
+
+    @staticmethod
+    def volumeGeometryKey(volume_node):
+        # Dimensions and IJK to RAS of a volume, equal keys mean the same voxel grid
+        if volume_node is None or volume_node.GetImageData() is None:
+            return None
+        ijk_to_ras = vtk.vtkMatrix4x4()
+        volume_node.GetIJKToRASMatrix(ijk_to_ras)
+        return (volume_node.GetImageData().GetDimensions(), tuple(slicer.util.arrayFromVTKMatrix(ijk_to_ras).ravel()))
+
+    @staticmethod
+    def snapshotVolumeNode(volume_node, file_path):
+        # Detached copy of the voxels and geometry, safe to hand over to a writer thread
+        ijk_to_ras = vtk.vtkMatrix4x4()
+        volume_node.GetIJKToRASMatrix(ijk_to_ras)
+        array = slicer.util.arrayFromVolume(volume_node).copy()
+        return volumeio.DecodedVolume(file_path, array, slicer.util.arrayFromVTKMatrix(ijk_to_ras))
+
+    @staticmethod
+    def snapshotSegmentationNode(segmentation_node, file_path=None, reference_volume_node=None):
+        '''
+        Labelmap export of segmentation_node with its .seg.nrrd metadata, None if there is
+        nothing to export. On the voxel grid of reference_volume_node when given.
+        '''
+        # The labelmap, its display node and the color table the export creates all go with the scope
+        with ResourceScope():
+            labelmap_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+            if reference_volume_node is None:
+                slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(segmentation_node, labelmap_node)
+            else:
+                segment_ids = vtk.vtkStringArray()
+                segmentation_node.GetSegmentation().GetSegmentIDs(segment_ids)
+                slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentation_node, segment_ids, labelmap_node,
+                                                                                  reference_volume_node, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
+            if labelmap_node.GetImageData() is None:
+                return None
+            snapshot = MRMLUtility.snapshotVolumeNode(labelmap_node, file_path)
+            snapshot.metadata = MRMLUtility.exportedSegmentMetadata(segmentation_node, labelmap_node, snapshot.array)
+        return snapshot
+
+    @staticmethod
+    def loadSegmentationFile(file_path, node_name=None):
+        # Decoded with volumeio when possible, slicer.util.loadSegmentation for the rest
+        segmentation_node = MRMLUtility.createSegmentationNodeFromDecoded(volumeio.readVolume(file_path), node_name)
+        if segmentation_node is None:
+            properties = {'name': node_name} if node_name is not None else {}
+            segmentation_node = slicer.util.loadSegmentation(str(file_path), properties)
+        return segmentation_node
+
+    @staticmethod
+    def exportedSegmentMetadata(segmentation_node, labelmap_node, labelmap):
+        '''
+        .seg.nrrd keys of a labelmap exported from segmentation_node, so the file keeps the
+        segment names and colors, empty segments included. The export's color table has
+        one entry per segment, named after it, at the segment's label value.
+        '''
+        segmentation = segmentation_node.GetSegmentation()
+        display_node = labelmap_node.GetDisplayNode()
+        color_node = display_node.GetColorNode() if display_node is not None else None
+        segments = []
+        for segment_number in range(segmentation.GetNumberOfSegments()):
+            segment = segmentation.GetNthSegment(segment_number)
+            label = color_node.GetColorIndexByName(segment.GetName()) if color_node is not None else -1
+            if label <= 0:
+                label = segment_number + 1
+            segments.append((segmentation.GetNthSegmentID(segment_number), segment.GetName(), segment.GetColor(), label))
+        return nrrdio.addSegments(nrrdio.NrrdHeader(), labelmap, segments).keyvalues
+
+    @staticmethod
+    def segmentationModifiedTime(segmentation_node):
+        # Latest modification of the segmentation, its segments or their labelmaps. Cheap, no export needed
+        segmentation = segmentation_node.GetSegmentation()
+        representation_name = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+        mtime = segmentation.GetMTime()
+        for segment_number in range(segmentation.GetNumberOfSegments()):
+            segment = segmentation.GetNthSegment(segment_number)
+            mtime = max(mtime, segment.GetMTime())
+            representation = segment.GetRepresentation(representation_name)
+            if representation is not None:
+                mtime = max(mtime, representation.GetMTime())
+        return mtime
+
+    @staticmethod
+    def createSegmentationNodeFromDecoded(decoded, node_name=None, segmentation_node=None):
+        '''
+        Only single layer labelmaps can be imported as is, leave the rest to slicer.util.loadSegmentation.
+        With segmentation_node given its segments are replaced instead of adding a new node.
+        '''
+        if decoded.isVector():
+            return None
+        descriptions = decoded.segmentDescriptions()
+        if descriptions is None or any(d['layer'] != 0 for d in descriptions.values()):
+            return None
+        if node_name is None:
+            node_name = decoded.name
+
+        with ResourceScope() as scope:
+            # The temporary labelmap and whatever comes with it go when the scope closes
+            labelmap_node = slicer.util.addVolumeFromArray(decoded.array, ijkToRAS=decoded.ijk_to_ras,
+                                                           name=node_name + '_labelmap', nodeClassName='vtkMRMLLabelMapVolumeNode')
+            if segmentation_node is None:
+                segmentation_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', node_name)
+                segmentation_node.CreateDefaultDisplayNodes()
+            else:
+                segmentation_node.SetName(node_name)
+                segmentation_node.GetSegmentation().RemoveAllSegments()
+            scope.keep(segmentation_node)
+            slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap_node, segmentation_node)
+
+        # Restore the .seg.nrrd segment names and colors, including empty segments the import skipped
+        segmentation = segmentation_node.GetSegmentation()
+        by_label = {}
+        for segment_number in range(segmentation.GetNumberOfSegments()):
+            segment = segmentation.GetNthSegment(segment_number)
+            by_label[segment.GetLabelValue()] = segment
+        for label, description in sorted(descriptions.items()):
+            segment = by_label.get(label)
+            if segment is None:
+                segment_id = segmentation.AddEmptySegment(description['id'], description['name'], description['color'])
+                segment = segmentation.GetSegment(segment_id)
+                segment.SetLabelValue(label)
+            else:
+                segment.SetName(description['name'])
+                segment.SetColor(*description['color'])
+        return segmentation_node
+
     @staticmethod
     def removeMRMLNodes(nodes):
         for i in range(len(nodes)):
@@ -119,8 +287,172 @@ class MRMLUtility(object):
         if node == -1:
             logging.error('Deleting non-existent node')
             return
-        if slicer.mrmlScene.GetFirstNodeByName(node.GetName()):
+        # By node, not by name: a name lookup can find another node of the same name
+        if node is None or not slicer.mrmlScene.IsNodePresent(node):
+            return
+        attached = []
+        if node.IsA('vtkMRMLDisplayableNode'):
+            attached += [node.GetNthDisplayNode(n) for n in range(node.GetNumberOfDisplayNodes())]
+        if node.IsA('vtkMRMLStorableNode'):
+            attached += [node.GetNthStorageNode(n) for n in range(node.GetNumberOfStorageNodes())]
+        slicer.mrmlScene.RemoveNode(node)
+        for attached_node in attached:
+            if attached_node is not None and slicer.mrmlScene.IsNodePresent(attached_node):
+                slicer.mrmlScene.RemoveNode(attached_node)
+
+    @staticmethod
+    def referencedNodes(node):
+        # Nodes node refers to: display, storage, color, transform nodes...
+        nodes = []
+        for role_number in range(node.GetNumberOfNodeReferenceRoles()):
+            role = node.GetNthNodeReferenceRole(role_number)
+            for n in range(node.GetNumberOfNodeReferences(role)):
+                referenced = node.GetNthNodeReference(role, n)
+                if referenced is not None:
+                    nodes.append(referenced)
+        return nodes
+
+    @staticmethod
+    def sceneNodes():
+        collection = slicer.mrmlScene.GetNodes()
+        return [collection.GetItemAsObject(n) for n in range(collection.GetNumberOfItems())]
+
+
+#
+# ResourceScope
+#
+'''
+Records every node added to the scene while the scope is open, release() removes the ones
+still in the scene. Nodes passed to keep() stay, and so does anything a staying node refers
+to (display, storage and color nodes), e.g. a shared color table first created in the scope.
+Singleton nodes always stay. Nodes are tracked by object, not by name. Used as a context
+manager for temporary nodes, or opened while an image is loaded, closed, and released when the
+next one is shown. Scopes can overlap, a node removed by one is skipped by the others.
+'''
+class ResourceScope(object):
+
+    def __init__(self):
+        self.nodes = [] # in the order they were added
+        self.kept = []
+        self.observer = None
+
+    def open(self):
+        if self.observer is None:
+            self.observer = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+        return self
+
+    def close(self):
+        if self.observer is not None:
+            slicer.mrmlScene.RemoveObserver(self.observer)
+            self.observer = None
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeAdded(self, caller, event, node):
+        self.nodes.append(node)
+
+    def keep(self, *nodes):
+        self.kept.extend(node for node in nodes if node is not None)
+
+    def release(self):
+        # Stops recording and removes the recorded nodes, returns how many were removed
+        self.close()
+        scene = slicer.mrmlScene
+        removable = {}
+        for node in self.nodes:
+            if scene.IsNodePresent(node) and not node.GetSingletonTag():
+                removable[node.GetID()] = node
+        kept_ids = set(node.GetID() for node in self.kept)
+        self.nodes = []
+        self.kept = []
+        # Everything reachable from a node that stays, stays too
+        staying = [node for node in MRMLUtility.sceneNodes() if node.GetID() not in removable or node.GetID() in kept_ids]
+        while len(staying) > 0:
+            for referenced in MRMLUtility.referencedNodes(staying.pop()):
+                if removable.pop(referenced.GetID(), None) is not None:
+                    staying.append(referenced)
+        for node in reversed(list(removable.values())):
+            if scene.IsNodePresent(node):
+                scene.RemoveNode(node)
+        return len(removable)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def currentProcessRSS():
+    # Resident memory of this process in bytes, None where it cannot be read
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in ['PeakWorkingSetSize', 'WorkingSetSize',
+                        'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                        'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize
+    try:
+        with open('/proc/self/statm', 'r') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+#
+# SceneResourceMonitor
+#
+'''
+Scene node count and process RSS sampled after each navigation. The first warmup samples
+set the baseline (caches filling up, nodes created once), afterwards every further growth of
+node_limit nodes or rss_limit_mb over the baseline is logged as a warning. Memory the caller
+accounts for (e.g. the decoded volume cache, bounded on its own) is left out of the RSS.
+'''
+class SceneResourceMonitor(object):
+
+    def __init__(self, warmup=5, node_limit=20, rss_limit_mb=256):
+        self.warmup = warmup
+        self.node_limit = node_limit
+        self.rss_limit = rss_limit_mb * 1024 * 1024
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.baseline_nodes = None
+        self.baseline_rss = None
+        self.next_node_warning = None
+        self.next_rss_warning = None
 
-            slicer.mrmlScene.RemoveNode(node)
+    def sample(self, label, accounted_bytes=0):
+        node_count = slicer.mrmlScene.GetNumberOfNodes()
+        rss = currentProcessRSS()
+        unaccounted = rss - accounted_bytes if rss is not None else None
+        self.samples += 1
+        logging.info('Resources after {}: {} scene nodes, RSS {}'.format(
+            label, node_count, '{:.0f} MB'.format(rss / 1048576.0) if rss is not None else 'unknown'))
+        if self.samples <= self.warmup:
+            self.baseline_nodes = node_count
+            self.baseline_rss = unaccounted
+            self.next_node_warning = node_count + self.node_limit
+            self.next_rss_warning = unaccounted + self.rss_limit if unaccounted is not None else None
+            return node_count, rss
+        if node_count >= self.next_node_warning:
+            logging.warning('The scene grew to {} nodes, {} more than after warm up ({})'.format(
+                node_count, node_count - self.baseline_nodes, label))
+            self.next_node_warning = node_count + self.node_limit
+        if unaccounted is not None and self.next_rss_warning is not None and unaccounted >= self.next_rss_warning:
+            logging.warning('Memory grew by {:.0f} MB since warm up, not counting caches ({})'.format(
+                (unaccounted - self.baseline_rss) / 1048576.0, label))
+            self.next_rss_warning = unaccounted + self.rss_limit
+        return node_count, rss
 
 
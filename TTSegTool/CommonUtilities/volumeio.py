@@ -0,0 +1,265 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import SimpleITK as sitk
+try:
+    from PIL import Image
+except ImportError:
+    # Optional, without Pillow photos are only shown once fully decoded
+    Image = None
+
+from CommonUtilities import nrrdio
+
+# ITK reads everything in LPS, Slicer works in RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+# Formats readPreview can decode at reduced resolution
+PREVIEW_SUFFIXES = ['.jpg', '.jpeg']
+
+#
+# DecodedVolume
+#
+'''
+Voxels and geometry of an image or a labelmap file, decoded without touching the MRML scene.
+Everything in here is safe to run on a worker thread, the MRML nodes are built from
+these buffers on the main thread (see utility.MRMLUtility.createVolumeNodeFromDecoded).
+'''
+class DecodedVolume(object):
+
+    def __init__(self, file_path, array, ijk_to_ras, metadata=None, mtime_ns=None):
+        self.file_path = Path(file_path) if file_path is not None else None
+        # Slicer array layout: (k, j, i) for scalars, (k, j, i, components) for RGB
+        self.array = array
+        self.ijk_to_ras = ijk_to_ras
+        self.metadata = metadata if metadata is not None else {}
+        # Modification time of the file when it was read, used to detect stale buffers
+        self.mtime_ns = mtime_ns
+
+    @property
+    def name(self):
+        # Same naming as the rest of the tool, everything up to the first dot
+        return self.file_path.name.split('.')[0]
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def isVector(self):
+        return self.array.ndim == 4
+
+    def numberOfSegments(self):
+        # What slicer.util.loadSegmentation would end up with: the header segments or one per label
+        descriptions = self.segmentDescriptions()
+        if descriptions:
+            return len(descriptions)
+        if self.array.dtype.kind == 'u':
+            return int(np.count_nonzero(np.bincount(self.array.ravel())[1:]))
+        return int(np.count_nonzero(np.unique(self.array)))
+
+    def digest(self):
+        # Content hash of voxels and geometry, the labelmap export can shift the extent
+        content = hashlib.blake2b(digest_size=16)
+        content.update(str(self.array.shape).encode())
+        content.update(str(self.array.dtype).encode())
+        content.update(self.ijk_to_ras.tobytes())
+        content.update(np.ascontiguousarray(self.array).data)
+        return content.hexdigest()
+
+    def segmentDescriptions(self):
+        # Segment name/color/label value stored in a .seg.nrrd header, keyed by label value
+        descriptions = {}
+        segment_number = 0
+        while 'Segment{}_ID'.format(segment_number) in self.metadata:
+            prefix = 'Segment{}_'.format(segment_number)
+            try:
+                label = int(self.metadata.get(prefix + 'LabelValue', segment_number + 1))
+                layer = int(self.metadata.get(prefix + 'Layer', 0))
+                color = [float(c) for c in self.metadata.get(prefix + 'Color', '0.5 0.5 0.5').split()]
+            except ValueError as e:
+                logging.warning('Could not parse segment {} in {}: {}'.format(segment_number, self.file_path, e))
+                return None
+            descriptions[label] = {
+                'id': self.metadata[prefix + 'ID'],
+                'name': self.metadata.get(prefix + 'Name', self.metadata[prefix + 'ID']),
+                'color': color,
+                'layer': layer,
+            }
+            segment_number += 1
+        return descriptions
+
+
+def ijkToRASFromImage(image):
+    dimension = image.GetDimension()
+    direction = np.eye(3)
+    direction[:dimension, :dimension] = np.array(image.GetDirection()).reshape(dimension, dimension)
+    spacing = np.ones(3)
+    spacing[:dimension] = image.GetSpacing()
+    origin = np.zeros(3)
+    origin[:dimension] = image.GetOrigin()
+
+    ijk_to_ras = np.eye(4)
+    ijk_to_ras[:3, :3] = LPS_TO_RAS.dot(direction).dot(np.diag(spacing))
+    ijk_to_ras[:3, 3] = LPS_TO_RAS.dot(origin)
+    return ijk_to_ras
+
+
+def readImageGeometry(file_path):
+    # Header only read, returns the Slicer array shape and the IJK to RAS matrix
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(file_path))
+    reader.ReadImageInformation()
+    size = list(reader.GetSize()) + [1] * (3 - reader.GetDimension())
+    image = sitk.Image([1] * reader.GetDimension(), sitk.sitkUInt8)
+    image.SetOrigin(reader.GetOrigin())
+    image.SetSpacing(reader.GetSpacing())
+    image.SetDirection(reader.GetDirection())
+    return (size[2], size[1], size[0]), ijkToRASFromImage(image)
+
+
+def resampleToReferenceGeometry(decoded, shape, ijk_to_ras):
+    '''
+    Pastes a labelmap into the voxel grid of a reference image, like exporting with
+    EXTENT_REFERENCE_GEOMETRY. Both grids need the same axes and spacing, which is
+    always the case for segmentations drawn on the photos, only the extent differs.
+    '''
+    if decoded.isVector():
+        raise ValueError('Multi layer segmentations are not supported: {}'.format(decoded.file_path))
+    if not np.allclose(decoded.ijk_to_ras[:3, :3], ijk_to_ras[:3, :3]):
+        raise ValueError('Segmentation {} is not aligned with its reference image'.format(decoded.file_path))
+    # Position of the labelmap's first voxel in the reference IJK grid
+    offset_ijk = np.linalg.solve(ijk_to_ras[:3, :3], decoded.ijk_to_ras[:3, 3] - ijk_to_ras[:3, 3])
+    offset = np.round(offset_ijk[::-1]).astype(int) # (k, j, i) like the arrays
+    if not np.allclose(offset[::-1], offset_ijk, atol=1e-3):
+        raise ValueError('Segmentation {} is not on the reference voxel grid'.format(decoded.file_path))
+
+    array = np.zeros(shape, dtype=decoded.array.dtype)
+    target = []
+    source = []
+    for axis in range(3):
+        start = max(offset[axis], 0)
+        stop = min(offset[axis] + decoded.array.shape[axis], shape[axis])
+        if stop <= start:
+            # No overlap, empty labelmap
+            return DecodedVolume(decoded.file_path, array, ijk_to_ras.copy(), decoded.metadata, decoded.mtime_ns)
+        target.append(slice(start, stop))
+        source.append(slice(start - offset[axis], stop - offset[axis]))
+    array[tuple(target)] = decoded.array[tuple(source)]
+    return DecodedVolume(decoded.file_path, array, ijk_to_ras.copy(), decoded.metadata, decoded.mtime_ns)
+
+
+def cropToContent(decoded):
+    '''
+    Smallest box of a labelmap holding all its labels, with the origin moved so every voxel
+    keeps its position. The .seg.nrrd reference image extent offset records where the box
+    starts, like in the files Slicer writes, segment extents stay in the uncropped grid.
+    resampleToReferenceGeometry pastes it back into the image's voxel grid.
+    '''
+    if decoded.isVector():
+        return decoded
+    inside = decoded.array != 0
+    start = []
+    stop = []
+    for axis in range(3):
+        present = np.flatnonzero(inside.any(axis=tuple(a for a in range(3) if a != axis)))
+        if len(present) == 0:
+            # Nothing labeled, a single voxel still carries the geometry
+            present = [0]
+        start.append(int(present[0]))
+        stop.append(int(present[-1]) + 1)
+    if start == [0, 0, 0] and stop == list(decoded.array.shape):
+        return decoded
+    # A copy, a view would keep the whole labelmap alive
+    array = decoded.array[tuple(slice(b, e) for b, e in zip(start, stop))].copy()
+    offset = start[::-1] # i, j, k
+    ijk_to_ras = decoded.ijk_to_ras.copy()
+    ijk_to_ras[:3, 3] += ijk_to_ras[:3, :3].dot(offset)
+    metadata = OrderedDict(decoded.metadata)
+    if 'Segmentation_ReferenceImageExtentOffset' in metadata:
+        reference = [int(v) for v in metadata['Segmentation_ReferenceImageExtentOffset'].split()]
+        metadata['Segmentation_ReferenceImageExtentOffset'] = ' '.join(str(r + o) for r, o in zip(reference, offset))
+    return DecodedVolume(decoded.file_path, array, ijk_to_ras, metadata, decoded.mtime_ns)
+
+
+def readVolume(file_path, local_path=None, mtime_ns=None):
+    '''
+    local_path is a copy of file_path to decode instead (local disk cache), mtime_ns is then
+    the modification time of file_path the copy was made from. The result refers to file_path.
+    '''
+    if local_path is None:
+        # Stat before reading, a write racing with the read then shows up as a stale entry
+        mtime_ns = os.stat(str(file_path)).st_mtime_ns
+        local_path = file_path
+    # SimpleITK's zlib inflates gzip payloads faster than nrrdio.readNrrd (see NrrdBenchmark.py)
+    image = sitk.ReadImage(str(local_path))
+    array = sitk.GetArrayFromImage(image)
+    if image.GetDimension() == 2:
+        # 2D photos are single slice volumes for Slicer
+        array = array[np.newaxis, ...]
+    metadata = {key: image.GetMetaData(key) for key in image.GetMetaDataKeys()}
+    return DecodedVolume(file_path, array, ijkToRASFromImage(image), metadata, mtime_ns)
+
+
+def readPreview(file_path, max_size=640, local_path=None):
+    '''
+    Quick reduced resolution decode of a JPEG photo, for showing something while the full
+    decode runs. JPEGs decode at 1/2, 1/4 or 1/8 scale for a fraction of the cost (Pillow
+    draft mode), the result is upsampled back onto the full resolution voxel grid so the
+    preview has exactly the shape and geometry of readVolume's result. Returns None when
+    there is no fast path for the file. No mtime_ns is set, previews never get cached.
+    local_path is a copy of file_path to decode instead, like for readVolume.
+    '''
+    if Image is None or Path(file_path).suffix.lower() not in PREVIEW_SUFFIXES:
+        return None
+    if local_path is None:
+        local_path = file_path
+    shape, ijk_to_ras = readImageGeometry(local_path)
+    rows, columns = shape[1], shape[2]
+    with Image.open(str(local_path)) as image:
+        if image.mode not in ('L', 'RGB') or image.size != (columns, rows):
+            return None
+        scale = max(image.size) / float(max_size)
+        if scale < 2:
+            # Would decode at full resolution anyway
+            return None
+        image.draft(image.mode, (int(columns / scale), int(rows / scale)))
+        preview = np.asarray(image)
+    # Nearest neighbour, every full resolution voxel takes the preview voxel covering it
+    row_index = np.arange(rows) * preview.shape[0] // rows
+    column_index = np.arange(columns) * preview.shape[1] // columns
+    array = preview.take(row_index, axis=0).take(column_index, axis=1)
+    return DecodedVolume(file_path, array[np.newaxis, ...], ijk_to_ras)
+
+
+def segmentationMetadata(metadata):
+    # The .seg.nrrd keys of a header, what is worth writing back
+    return OrderedDict((key, value) for key, value in metadata.items() if key.startswith('Segment'))
+
+
+def writeVolume(decoded, file_path, compression=nrrdio.DEFAULT_COMPRESSION):
+    '''
+    compression is one of nrrdio.COMPRESSION_LEVELS. Scalar volumes go to NRRD files
+    through nrrdio, with the segment metadata of decoded, the rest (and the voxel types
+    nrrdio does not write) through SimpleITK.
+    '''
+    if nrrdio.isNrrdPath(file_path) and not decoded.isVector():
+        try:
+            nrrdio.writeNrrd(file_path, decoded.array, decoded.ijk_to_ras, segmentationMetadata(decoded.metadata), compression)
+            return
+        except nrrdio.UnsupportedNrrdError as e:
+            logging.info('Writing {} through SimpleITK: {}'.format(file_path, e))
+    if compression not in nrrdio.COMPRESSION_LEVELS:
+        raise ValueError('Unknown compression {}, use one of {}'.format(compression, list(nrrdio.COMPRESSION_LEVELS)))
+    image = sitk.GetImageFromArray(decoded.array, isVector=decoded.isVector())
+    ijk_to_lps = LPS_TO_RAS.dot(decoded.ijk_to_ras[:3, :3])
+    spacing = np.linalg.norm(ijk_to_lps, axis=0)
+    image.SetSpacing(spacing.tolist())
+    image.SetDirection((ijk_to_lps / spacing).flatten().tolist())
+    image.SetOrigin(LPS_TO_RAS.dot(decoded.ijk_to_ras[:3, 3]).tolist())
+
+    # Write next to the target and rename, readers never see a half written file
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name('.~' + file_path.name)
+    sitk.WriteImage(image, str(tmp_path), compression != 'raw')
+    os.replace(str(tmp_path), str(file_path))
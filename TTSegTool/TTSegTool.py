@@ -2,11 +2,27 @@ import os
 import qt
 import unittest
 import logging
-from csv import DictReader, DictWriter
+from csv import DictReader
 from pathlib import Path
 import numpy as np
 
 from CommonUtilities import utility
+from CommonUtilities import prefetch
+from CommonUtilities import cache
+from CommonUtilities import nrrdio
+from CommonUtilities import volumeio
+from CommonUtilities import segwriter
+from CommonUtilities import eyelid
+from CommonUtilities import fileindex
+from CommonUtilities import mastertable
+from CommonUtilities import gradingstate
+from CommonUtilities import journal
+from CommonUtilities import mastercsv
+from CommonUtilities import autosave
+from CommonUtilities import patchstore
+from CommonUtilities import batching
+from CommonUtilities import timing
+from CommonUtilities import diskcache
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
@@ -127,6 +143,14 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def exit(self):
       status = self.saveCurrentState(writeToMaster=True)
+      self.autosave.flush()
+      self.autosave.waitForWrites()
+      # Make sure every queued segmentation hit the disk before closing
+      self.segmentation_writer.flush()
+      status = self.checkSegmentationWrites() and status
+      if not status:
+        # Slicer stays open, the grader can keep working and try again
+        return status
       if self.patchEditModeOn:
         self.switchPatchEditMode()
       if self.segmentEditModeOn:
@@ -134,6 +158,14 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       if self.effectFactorySingleton:
         self.effectFactorySingleton.disconnect('effectRegistered(QString)', self.editorEffectRegistered)
       self.removeMarkupObservers()
+      self.prefetcher.shutdown()
+      if self.local_cache is not None:
+        self.local_cache.close()
+      self.segmentationWriteTimer.stop()
+      if self.journal is not None:
+        self.journal.close()
+        self.journal = None
+      self.timings.close()
       return status
 
     #----------------------------------------------------------------------------------------
@@ -169,10 +201,10 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       writeStatus = True
       if self.image_list is not None and len(self.image_list) > 0 and self.current_ind in range(len(self.image_list)):
         self.updateMasterDictAndTable()
-        self.saveCurrentImagePatchInfo()
-        if self.save_segmentation_flag:
-          self.saveCurrentSegmentation()
-        self.saveCurrentRowToMaster()
+        self.scheduleAutosave()
+        # Snapshot this row's patches, segmentation and fields now, the writes do not hold up
+        # the navigation. The master csv is left to the autosave timer (and to exit/Save)
+        self.autosave.flush(['patches', 'segmentation', 'row'])
         if writeToMaster:
             # Need this for final save out. This might be cheesy, and probably shoudl be done for all above
             writeStatus = writeStatus & self.writeFinalMasterCSV()
@@ -198,8 +230,9 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ui.imageNavigationScrollBar.valueChanged.connect(self.onImageIndexChanged)
       self.ui.findPrevUngradedButton.clicked.connect(self.onFindPrevUngradedClicked)
       self.ui.findUngradedButton.clicked.connect(self.onFindUngradedClicked)
-      self.ui.imageDetailsTable.itemClicked.connect(self.onImageDetailsRowClicked)
-      self.ui.imageDetailsTable.itemSelectionChanged.connect(self.onImageDetailsItemSelected)
+      self.ui.imageDetailsTable.setModel(self.imageDetailsModel)
+      self.ui.imageDetailsTable.clicked.connect(self.onImageDetailsRowClicked)
+      self.ui.imageDetailsTable.selectionModel().selectionChanged.connect(self.onImageDetailsItemSelected)
 
       self.ui.pushZoomInButton.clicked.connect(lambda: self.adjustZoom(0.9))
       self.ui.pushZoomOutButton.clicked.connect(lambda: self.adjustZoom(1.1))
@@ -222,6 +255,9 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       # segmentation management
       self.ui.showSegmentationCheckBox.stateChanged.connect(self.changeSegmentationVisibility)
       self.ui.startSegmentEditModeButton.clicked.connect(self.switchSegmentEditMode)
+      # Timings panel
+      self.ui.refreshTimingsButton.clicked.connect(self.updateTimingsTable)
+      self.ui.timingsCollapsibleButton.contentsCollapsed.connect(lambda collapsed: self.updateTimingsTable() if not collapsed else None)
       self.addMarkupObservers()
 
     #------------------------------------------------------------------------------
@@ -292,8 +328,11 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         print("Starting segment mode on")
         self.ui.startSegmentEditModeButton.setStyleSheet("QPushButton {background-color: rgb(214, 0, 0)}")
         self.ui.startSegmentEditModeButton.setText("   STOP SEGMENTATION EDIT MODE   ")
-        self.save_segmentation_flag = True
+        self.captureSegmentationBaseline()
+        if self.segmentation_node is not None:
+          self.addObserver(self.segmentation_node.GetSegmentation(), slicer.vtkSegmentation.SegmentModified, self.onSegmentationModified)
       else:
+        self.removeObservers(self.onSegmentationModified)
         self.ui.startSegmentEditModeButton.setStyleSheet("QPushButton {background-color: rgb(85, 170, 0)}")
         self.ui.startSegmentEditModeButton.setText("   START SEGMENTATION EDIT MODE   ")
         print("Switching segment mode off")
@@ -380,6 +419,7 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 break
             if inimage:
               self.ui.imagePatchesTableWidget.item(movingMarkupIndex, 0).setText("{},{}".format(point_Ijk[0], point_Ijk[1]))
+              self.scheduleAutosave()
           self.movingMarkupInd = -1
 
     #------------------------------------------------------------------------------
@@ -462,8 +502,11 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not segmentationNode:
           segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
           self.segmentation_node = segmentationNode
-        self.editor.setSegmentationNode(segmentationNode)
-        self.editor.setMasterVolumeNode(self.image_node)
+        # Setting the same nodes again would still rebuild the editor
+        if self.editor.segmentationNode() != segmentationNode:
+          self.editor.setSegmentationNode(segmentationNode)
+        if self.editor.masterVolumeNode() != self.image_node:
+          self.editor.setMasterVolumeNode(self.image_node)
 
     #------------------------------------------------------------------------------
     def selectParameterNode(self):
@@ -492,29 +535,108 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.temp_path = None
       self.image_node = None # holds the current image
       self.segmentation_node = None # holds the current segmentation
+      self.segmentation_reference_geometry = None # image grid last set as the segmentation's reference geometry
+      self.image_scope = None # nodes added to the scene while the current image was loaded
+      # Scene node count and memory after each navigation, warns when they keep growing
+      self.resource_monitor = utility.SceneResourceMonitor(
+        node_limit=int(qt.QSettings().value('TTSegTool/NodeGrowthWarning', 20)),
+        rss_limit_mb=int(qt.QSettings().value('TTSegTool/MemoryGrowthWarningMB', 256)))
+      # Keep one image node and one segmentation node and swap their contents per image
+      self.persistent_nodes = str(qt.QSettings().value('TTSegTool/PersistentNodes', 'true')).lower() == 'true'
       self.interactor = None
       self.crosshairNode = None
       self.user_name = None
-      self.tmp_csv_file_name = None
+      self.patch_update_batch = None # open while the patches table and markups change in bulk
+      self.patch_store = None # patches of every image, one database per user
+      self.patch_paths = {} # image key -> per image patches csv the store is exported to
+      self.journal = None # edits since the last master csv write, replayed after a crash
+      self.current_row_baseline = None # journaled fields of the current row when it was shown
       self.patchEditorObserver = None
       self.markupsObservers = None
       self.patcheEditShortcut = None
       self.patchEditModeOn = False
       self.segmentEditModeOn = False
-      self.save_segmentation_flag = False
+      self.segmentation_baseline = None # modified time and content digest of the segmentation as loaded/saved
+      self.segmentation_needs_save = False # set when the tool itself changed the labels, e.g. eyelid creation
       self.parameterSetNode = None # holds the current segment editor
       self.editor = None # holds the segment editor UI widget
       self.effectFactorySingleton = None
+      # Local copies of the server files for the upcoming rows, the share's latency and outages then do not block the grader
+      self.local_cache = None
+      local_cache_size_mb = int(qt.QSettings().value('TTSegTool/LocalCacheSizeMB', 20480))
+      local_cache_dir = qt.QSettings().value('TTSegTool/LocalCacheDir', str(Path.home() / '.TTSegTool' / 'cache'))
+      self.local_cache_lookahead = int(qt.QSettings().value('TTSegTool/LocalCacheLookahead', 20)) # rows copied ahead
+      if local_cache_size_mb > 0:
+        try:
+          self.local_cache = diskcache.LocalFileCache(local_cache_dir, local_cache_size_mb * 1024 * 1024)
+        except OSError as e:
+          logging.warning('Could not open the local cache {}, reading from the server only: {}'.format(local_cache_dir, e))
+      self.prefetch_count = 2 # number of upcoming rows decoded in the background
+      self.prefetcher = prefetch.ImagePrefetcher(read=self.readVolume)
+      # Photos not decoded yet are first shown from a reduced resolution decode, the full one is swapped in when ready
+      self.progressive_preview = str(qt.QSettings().value('TTSegTool/ProgressivePreview', 'true')).lower() == 'true'
+      self.preview_max_size = int(qt.QSettings().value('TTSegTool/PreviewMaxSize', 640))
+      self.preview_image_path = None # image shown as a preview, waiting for its full resolution decode
+      self.previewTimer = qt.QTimer()
+      self.previewTimer.setInterval(50)
+      self.previewTimer.connect('timeout()', self.swapInFullResolutionImage)
+      # Recently visited images and segmentations stay decoded in memory up to this budget
+      cache_size_mb = int(qt.QSettings().value('TTSegTool/VolumeCacheSizeMB', 1024))
+      self.volume_cache = cache.DecodedVolumeCache(cache_size_mb * 1024 * 1024)
+      # Stage latencies, logged per session once a master csv is loaded
+      self.timings = timing.SessionTimer()
+      # Segmentations are written in the background, the timer reports the outcome back
+      # raw, fast or full gzip, see nrrdio.COMPRESSION_LEVELS. Fast writes about three times quicker than full for ~10% more bytes
+      # Opt-in, cropped files hold only the box around the labels, they are pasted back into the image grid
+      # on load. Off by default, other readers of the .seg.nrrd files expect the full image extent
+      crop_segmentations = str(qt.QSettings().value('TTSegTool/CropSegmentations', 'false')).lower() == 'true'
+      self.segmentation_writer = segwriter.SegmentationWriter(
+        compression=qt.QSettings().value('TTSegTool/SegmentationCompression', nrrdio.DEFAULT_COMPRESSION), crop=crop_segmentations, timer=self.timings)
+      self.segmentationWriteTimer = qt.QTimer()
+      self.segmentationWriteTimer.setInterval(500)
+      self.segmentationWriteTimer.connect('timeout()', self.checkSegmentationWrites)
+      self.segmentationWriteTimer.start()
+      # Existence, size and mtime of the files referenced by the master csv
+      self.file_index = fileindex.DatasetFileIndex()
+      # Backs imageDetailsTable, rows are the dicts of image_list
+      self.imageDetailsModel = mastertable.MasterTableModel(self.checkboxKeys)
+      self.imageDetailsModel.connect('dataChanged(QModelIndex,QModelIndex)', self.onImageDetailsDataChanged)
+      # Packed checkbox flags of image_list, for counting and finding ungraded rows
+      self.grading_state = gradingstate.GradingState(self.checkboxKeys)
+      # Serialized master csv rows, only rows changed since the last save are serialized again
+      self.master_writer = mastercsv.MasterCSVWriter()
+      # Edits are saved in the background once the grader pauses, at the latest after the max delay
+      autosave_delay_ms = int(qt.QSettings().value('TTSegTool/AutosaveDelayMs', 2000))
+      autosave_max_delay_ms = int(qt.QSettings().value('TTSegTool/AutosaveMaxDelayMs', 10000))
+      self.autosave = autosave.AutosaveScheduler(autosave_delay_ms, autosave_max_delay_ms)
 
       self.initData()
       self.updateUI()
 
   #------------------------------------------------------------------------------  
     def initData(self):
+      # Writes of the previous list finish first, their callbacks refer to its rows
+      self.autosave.waitForWrites()
+      self.autosave.clear()
       self.image_list=[]
       self.current_ind = -1
-      self.num_graded = set()
       self.movingMarkupInd = -1
+      if self.journal is not None:
+        self.journal.close()
+        self.journal = None
+      if self.patch_store is not None:
+        self.patch_store.close()
+        self.patch_store = None
+      self.patch_paths = {}
+      self.current_row_baseline = None
+      self.preview_image_path = None
+      self.previewTimer.stop()
+      self.prefetcher.clear()
+      self.volume_cache.clear()
+      self.file_index.clear()
+      self.grading_state.reset(self.image_list)
+      self.master_writer.reset(0)
+      self.imageDetailsModel.setRows(self.image_list, [])
 
       fid = slicer.modules.markups.logic().GetActiveListID()
       if len(fid) > 0:
@@ -523,8 +645,13 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           fidNode.RemoveNthControlPoint(0)
       if self.image_node is not None:
         utility.MRMLUtility.removeMRMLNode(self.image_node)
+        self.image_node = None
       if self.segmentation_node is not None:
         utility.MRMLUtility.removeMRMLNode(self.segmentation_node)
+        self.segmentation_node = None
+      self.segmentation_reference_geometry = None
+      self.releaseImageScope()
+      self.resource_monitor.reset()
       # self.updateNavigationUI()
 
   ##### UI Updates ###########
@@ -554,7 +681,7 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
       if self.current_ind >= 0 and self.current_ind < max:
         detailsText = "::: Image {}/{} ::: ID ::: {} ::: Eye ::: {} ||| ::: Graded: {}/{} :::".format(
-                      ind, max, self.image_list[self.current_ind]['cid'], self.image_list[self.current_ind]['eye'], len(self.num_graded), max
+                      ind, max, self.image_list[self.current_ind]['cid'], self.image_list[self.current_ind]['eye'], self.grading_state.count('graded'), max
                       )
       else:
         detailsText = "Image list empty"
@@ -639,32 +766,90 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           logging.debug('Clicked out of frame, returning')
           return
 
-      row_id = self.ui.imagePatchesTableWidget.rowCount
-      self.ui.imagePatchesTableWidget.insertRow(row_id)
-      item1 = qt.QTableWidgetItem("{},{}".format(ijk[0], ijk[1]))
-      self.ui.imagePatchesTableWidget.setItem(row_id, 0, item1)
+      with self.patchUpdates():
+        row_id = self.ui.imagePatchesTableWidget.rowCount
+        self.ui.imagePatchesTableWidget.insertRow(row_id)
+        item1 = qt.QTableWidgetItem("{},{}".format(ijk[0], ijk[1]))
+        self.ui.imagePatchesTableWidget.setItem(row_id, 0, item1)
 
-      label_id = None
-      if label is None:
-        label = self.ui.patchLabelComboBox.currentText
-      else:
-        all_labels = [self.ui.patchLabelComboBox.itemText(i) for i in range(self.ui.patchLabelComboBox.count)]
-        if label not in all_labels:
-          logging.info('During adding row to patch table at row: {}, label: {} is marked unknown'.format(row_id, label))
-          label = "Unknown"
-        label_id = all_labels.index(label)
-
-      item2 = qt.QTableWidgetItem("{}".format(label))
-      self.ui.imagePatchesTableWidget.setItem(row_id, 1, item2)
-      self.ui.imagePatchesTableWidget.selectRow(row_id)
-
-      # Combo box is set after the row selection is done to get the correct 
-      # current row while updating the fiducial labels. (callback on index change for combo box)
-      if label_id is not None:
-        self.ui.patchLabelComboBox.setCurrentIndex(label_id)
+        label_id = None
+        if label is None:
+          label = self.ui.patchLabelComboBox.currentText
+        else:
+          all_labels = [self.ui.patchLabelComboBox.itemText(i) for i in range(self.ui.patchLabelComboBox.count)]
+          if label not in all_labels:
+            logging.info('During adding row to patch table at row: {}, label: {} is marked unknown'.format(row_id, label))
+            label = "Unknown"
+          label_id = all_labels.index(label)
+
+        item2 = qt.QTableWidgetItem("{}".format(label))
+        self.ui.imagePatchesTableWidget.setItem(row_id, 1, item2)
+        self.ui.imagePatchesTableWidget.selectRow(row_id)
+
+        # Combo box is set after the row selection is done to get the correct 
+        # current row while updating the fiducial labels. (callback on index change for combo box)
+        if label_id is not None:
+          self.ui.patchLabelComboBox.setCurrentIndex(label_id)
+        # The selection signal is held back by the batch
+        self.updateFiducialSelection(row_id)
 
       return row_id
 
+  #------------------------------------------------------------------------------
+    def addPatchRowsInBulk(self, rows):
+      # Same result as addPatchRow + addFiducial per row, with one table fill and one markups modification
+      if self.image_node is None or self.image_node.GetImageData() is None:
+        return
+      dims = self.image_node.GetImageData().GetDimensions()
+      ijk = np.array([[int(row['x']), int(row['y']), 0] for row in rows], dtype=float).reshape(-1, 3)
+      inside = np.all((ijk >= 0) & (ijk < np.array(dims)), axis=1)
+      if not np.all(inside):
+        logging.debug('Skipping {} patches outside of the frame'.format(np.count_nonzero(~inside)))
+      ijk = ijk[inside]
+      all_labels = [self.ui.patchLabelComboBox.itemText(i) for i in range(self.ui.patchLabelComboBox.count)]
+      labels = [row['label'] if row['label'] in all_labels else "Unknown" for row, keep in zip(rows, inside) if keep]
+      if len(labels) == 0:
+        return
+
+      # Voxel to physical coordinates for all points at once
+      volumeIjkToRas = vtk.vtkMatrix4x4()
+      self.image_node.GetIJKToRASMatrix(volumeIjkToRas)
+      ijk_to_ras = slicer.util.arrayFromVTKMatrix(volumeIjkToRas)
+      ras = np.hstack([ijk, np.ones((len(ijk), 1))]) @ ijk_to_ras.T
+      ras = ras[:, :3]
+      if self.image_node.GetParentTransformNode() is not None:
+        # If volume node is transformed, apply that transform to get volume's RAS coordinates
+        transformVolumeRasToRas = vtk.vtkGeneralTransform()
+        slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(self.image_node.GetParentTransformNode(), None, transformVolumeRasToRas)
+        ras = np.array([transformVolumeRasToRas.TransformPoint(point) for point in ras])
+
+      table = self.ui.imagePatchesTableWidget
+      with self.patchUpdates():
+        first_row = table.rowCount
+        table.setRowCount(first_row + len(labels))
+        for offset, (point, label) in enumerate(zip(ijk, labels)):
+          item1 = qt.QTableWidgetItem("{},{}".format(int(point[0]), int(point[1])))
+          table.setItem(first_row + offset, 0, item1)
+          item2 = qt.QTableWidgetItem("{}".format(label))
+          table.setItem(first_row + offset, 1, item2)
+
+        fid = slicer.modules.markups.logic().GetActiveListID()
+        if fid == '':
+          fid = slicer.modules.markups.logic().AddNewFiducialNode()
+        fidNode = slicer.util.getNode(fid)
+        wasModifying = fidNode.StartModify()
+        points = np.vstack([slicer.util.arrayFromMarkupsControlPoints(fidNode), ras]) if fidNode.GetNumberOfControlPoints() > 0 else ras
+        slicer.util.updateMarkupsControlPointsFromArray(fidNode, points)
+        for offset, label in enumerate(labels):
+          fidNode.SetNthControlPointLabel(first_row + offset, label)
+          fidNode.SetNthControlPointSelected(first_row + offset, False)
+        fidNode.EndModify(wasModifying)
+
+        # Leave the last patch selected, as adding them one by one did
+        last_row = table.rowCount - 1
+        table.selectRow(last_row)
+        self.updateFiducialSelection(last_row)
+
   #------------------------------------------------------------------------------
     def updatePatchesTable(self, ijk=None, ras=None, clearTable = False):
       if len(self.image_list) == 0 or \
@@ -674,21 +859,40 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         return
       
       if clearTable:  
-        self.ui.imagePatchesTableWidget.clearContents()
-        self.ui.imagePatchesTableWidget.setRowCount(0)
-        fid = slicer.modules.markups.logic().GetActiveListID()
-        if len(fid) > 0:
-          fidNode = slicer.util.getNode(fid)
-          fidNode.RemoveAllControlPoints()
+        with self.patchUpdates():
+          self.ui.imagePatchesTableWidget.clearContents()
+          self.ui.imagePatchesTableWidget.setRowCount(0)
+          fid = slicer.modules.markups.logic().GetActiveListID()
+          if len(fid) > 0:
+            fidNode = slicer.util.getNode(fid)
+            fidNode.RemoveAllControlPoints()
         return
       
-      row_id = None
-      if ijk is not None:
-        row_id = self.addPatchRow(ijk)
-      # Create the fiducial
-      if ras is not None and row_id is not None :
-        self.addFiducial(row_id, ras)
-        self.updateFiducialSelection(row_id)
+      with self.patchUpdates():
+        row_id = None
+        if ijk is not None:
+          row_id = self.addPatchRow(ijk)
+        # Create the fiducial
+        if ras is not None and row_id is not None :
+          self.addFiducial(row_id, ras)
+          self.updateFiducialSelection(row_id)
+
+  #------------------------------------------------------------------------------
+    def patchUpdates(self):
+      '''
+      Batch for changes to the patches table, the label combo box and the markups: their
+      signals and observers are held back and updateMasterDictAndTable/updateFiducialSelection
+      run once when the outermost batch closes.
+      '''
+      if self.patch_update_batch is None:
+        nodes = []
+        fid = slicer.modules.markups.logic().GetActiveListID()
+        if len(fid) > 0:
+          nodes.append(slicer.util.getNode(fid))
+        def closed():
+          self.patch_update_batch = None
+        self.patch_update_batch = batching.UpdateBatch([self.ui.imagePatchesTableWidget, self.ui.patchLabelComboBox], nodes, on_close=closed)
+      return self.patch_update_batch
 
   #
   # -----------------------
@@ -718,17 +922,19 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       
       row = self.ui.imagePatchesTableWidget.currentRow()
       logging.info('Removing image patch at position: {}'.format(row))
-      self.ui.imagePatchesTableWidget.removeRow(row)
+      with self.patchUpdates():
+        self.ui.imagePatchesTableWidget.removeRow(row)
 
-      fid = slicer.modules.markups.logic().GetActiveListID()
-      if len(fid) > 0:
-        fidNode = slicer.util.getNode(fid)
-        if row in range(fidNode.GetNumberOfFiducials()):
-          fidNode.RemoveNthControlPoint(row)
-      if self.ui.imagePatchesTableWidget.rowCount > 0:
-        self.ui.imagePatchesTableWidget.selectRow( self.ui.imagePatchesTableWidget.rowCount - 1)
-      # print('Before updating master: {}'.format(self.ui.imagePatchesTableWidget.rowCount))
-      self.updateMasterDictAndTable()
+        fid = slicer.modules.markups.logic().GetActiveListID()
+        if len(fid) > 0:
+          fidNode = slicer.util.getNode(fid)
+          if row in range(fidNode.GetNumberOfFiducials()):
+            fidNode.RemoveNthControlPoint(row)
+        if self.ui.imagePatchesTableWidget.rowCount > 0:
+          self.ui.imagePatchesTableWidget.selectRow( self.ui.imagePatchesTableWidget.rowCount - 1)
+          self.updateFiducialSelection(self.ui.imagePatchesTableWidget.rowCount - 1)
+        # print('Before updating master: {}'.format(self.ui.imagePatchesTableWidget.rowCount))
+        self.updateMasterDictAndTable()
 
     #------------------------------------------------------------------------------
     #------------------------------------------------------------------------------
@@ -862,6 +1068,16 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       progress = qt.QProgressDialog("Loading Master CSV", "Abort Load", 0, len(image_list), self.parent)
       progress.setWindowModality(qt.Qt.WindowModal)
 
+      # List every referenced directory once instead of stating each row on the share
+      referenced_paths = []
+      for row in image_list:
+        for key in ['image path', 'segmentation path']:
+          if len(row.get(key) or '') > 0:
+            referenced_paths.append(self.path_to_server / row[key].lstrip("\\").replace("\\", "/"))
+        if len(row.get('patches path') or '') > 0:
+          referenced_paths.append(self.path_to_server / row['patches path'].replace("\\","/"))
+      self.file_index.scan(referenced_paths, directories=[new_output_dir])
+
       for row_id, row in enumerate(image_list):
         progress.setValue(row_id)
         if progress.wasCanceled:
@@ -874,12 +1090,9 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         row['image path'] = self.path_to_server / row['image path'].lstrip("\\").replace("\\", "/")
         row['segmentation path'] = self.path_to_server / row['segmentation path'].lstrip("\\").replace("\\","/") if len(row['segmentation path']) >0 else ''
         create_new = False
-        try_to_read_patches = False
         if len(row['patches path']) > 0:
           row['patches path'] = self.path_to_server / row['patches path'].replace("\\","/")
-          if row['patches path'].exists():
-            try_to_read_patches = False
-          else:
+          if not self.file_index.exists(row['patches path']):
             create_new = True
         else:
           create_new = True
@@ -887,7 +1100,6 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if create_new:
           image_name = (row['image path'].name).split('.')[0]
           row['patches path'] = new_output_dir / (image_name + '.csv')
-          try_to_read_patches = True
         try:
           # row['tt present'] = int(row['tt present'])
           # row['tt sev'] = int(row['tt sev'])
@@ -912,18 +1124,6 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           logging.error('Error either converting keys to in or adding other keys')
           self.image_list = []
           break
-        if try_to_read_patches and row['patches path'].exists():
-          patch_rows = self.readCSV(row['patches path'])
-          if len(patch_rows) == 0:
-            logging.warning("Error reading pre-existing patches file: {}".format(row['patches path']))
-          # row['n samples'] = len(patch_rows)
-          # ["TT", "Probable TT", "Healthy", "Epilation", "Unknown"]
-          # row['n tt'] = len( [l for l in patch_rows if l['label'] == 'TT'] )
-          # row['n probtt'] = len( [l for l in patch_rows if l['label'] == 'Probable TT'] )
-          # row['n epi'] = len( [l for l in patch_rows if l['label'] == 'Epilation'] )
-          # row['n probepi'] = len( [l for l in patch_rows if l['label'] == 'Probable Epilation'] )
-          # row['n healthy'] = len( [l for l in patch_rows if l['label'] == 'Healthy'] )
-          # row['n none'] = len( [l for l in patch_rows if l['label'] == 'Unknown'] )
         self.image_list.append(row)
       progress.setValue(len(image_list))
       logging.debug('Number of images read: {}'.format(len(self.image_list)))
@@ -935,18 +1135,57 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.temp_path = self.path_to_image_details.parent / ('_tmp_' + self.user_name)
         if not self.temp_path.is_dir():
             self.temp_path.mkdir(parents=True)
+        self.startTimingLog()
+        self.restoreSessionJournal()
+        self.openPatchStore(new_output_dir)
+
+  #------------------------------------------------------------------------------
+    def startTimingLog(self):
+      from datetime import datetime
+      log_name = 'timings_{}_{}.jsonl'.format(self.user_name, datetime.now().strftime("%Y%m%d_%H%M%S"))
+      self.timings.close()
+      self.timings = timing.SessionTimer(self.temp_path / log_name)
+      self.segmentation_writer.timer = self.timings
+      logging.info('Timing log: {}'.format(self.temp_path / log_name))
+
+  #------------------------------------------------------------------------------
+    def currentImageId(self):
+      if self.path_to_server is None or self.current_ind not in range(len(self.image_list)):
+        return None
+      return self.imageKey(self.image_list[self.current_ind])
+
+    def timeSpan(self, stage):
+      # The image is looked up when the span ends, so navigation is logged with the new image
+      return self.timings.span(stage, self.currentImageId)
+
+  #------------------------------------------------------------------------------
+    def updateTimingsTable(self):
+      summary = self.timings.summary()
+      table = self.ui.timingsTableWidget
+      table.setRowCount(len(summary))
+      for row_id, (stage, count, p50, p95) in enumerate(summary):
+        for column, text in enumerate([stage, str(count), '{:.1f}'.format(p50), '{:.1f}'.format(p95)]):
+          item = qt.QTableWidgetItem(text)
+          if column > 0:
+            item.setTextAlignment(qt.Qt.AlignRight | qt.Qt.AlignVCenter)
+          table.setItem(row_id, column, item)
+      table.resizeColumnsToContents()
+
+  #------------------------------------------------------------------------------
+    def imageKey(self, row):
+      # Identifies a row across sessions: its image path relative to the server
+      return row['image path'].relative_to(self.path_to_server).as_posix()
 
-        csv_file_name = self.path_to_image_details.name
-        from datetime import datetime
-        curDTObj = datetime.now()
-        datetimeStr = curDTObj.strftime("%Y%m%d_%H%M%S")
-        csv_file_name = csv_file_name.replace('.csv', '_{}_{}.csv'.format(self.ui.usernameLineEdit.text, datetimeStr))
-        self.tmp_csv_file_name = self.temp_path / csv_file_name
-        fieldnames = self.image_list[0].keys()
-        logging.debug('TEMP FILE NAME IS: {}'.format(self.tmp_csv_file_name))
-        with open(self.tmp_csv_file_name, 'w', newline='') as fh:
-          writer = DictWriter(fh, fieldnames = fieldnames)
-          writer.writeheader()
+  #------------------------------------------------------------------------------
+    def openPatchStore(self, patches_dir):
+      self.patch_store = patchstore.PatchStore(patches_dir / 'patches.sqlite')
+      self.patch_store.load()
+      self.patch_paths = {self.imageKey(row): row['patches path'] for row in self.image_list}
+      # Per image csv files of earlier sessions (or other tools) are imported once
+      existing = {image: path for image, path in self.patch_paths.items() if self.file_index.exists(path)}
+      imported = self.patch_store.importCSVs(existing)
+      logging.info('Patch store {}: {} images with patches, {} imported from csv files'.format(
+        self.patch_store.db_path, len(self.patch_store.patches), imported))
 
   #------------------------------------------------------------------------------
     def fillMasterTable(self):
@@ -960,28 +1199,14 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       all_other = [key for key in self.image_list[0].keys() if key not in keys]
       keys.extend(all_other)
       self.ui.imageDetailsTable.enabled = 1
-      for key in keys:
-        self.ui.imageDetailsTable.setColumnCount(len(keys))
-        self.ui.imageDetailsTable.setHorizontalHeaderLabels(keys)
-        self.ui.imageDetailsTable.horizontalHeader().setVisible(True)
-
-      self.num_graded = set()
-      for row in self.image_list:
-        row_id = self.ui.imageDetailsTable.rowCount
-        self.ui.imageDetailsTable.insertRow(row_id)
-        if row['graded'] == 1:
-          self.num_graded.add(row_id)
-        for ind, key in enumerate(keys): # Get in particular oder
-          if key in self.checkboxKeys:
-            checkbox = qt.QTableWidgetItem()
-            checkstate = qt.Qt.Unchecked if row[key]==0 else qt.Qt.Checked
-            checkbox.setCheckState(checkstate)
-            checkbox.setTextAlignment(qt.Qt.AlignCenter)
-            self.ui.imageDetailsTable.setItem(row_id, ind, checkbox)
-          else:
-            item = qt.QTableWidgetItem("{}".format(row[key]))
-            item.setTextAlignment(qt.Qt.AlignCenter)
-            self.ui.imageDetailsTable.setItem(row_id, ind, item)
+      self.ui.imageDetailsTable.horizontalHeader().setVisible(True)
+
+      self.grading_state.reset(self.image_list)
+      self.master_writer.reset(len(self.image_list), self.image_list[0].keys())
+      # The view only queries the rows that scroll into view
+      self.imageDetailsModel.setRows(self.image_list, keys)
+      # Size the columns from the first rows only, not from the whole list
+      self.ui.imageDetailsTable.horizontalHeader().setResizeContentsPrecision(100)
       self.ui.imageDetailsTable.resizeColumnsToContents()
 
     #------------------------------------------------------------------------------
@@ -997,30 +1222,164 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         print('take 2')
         return
 
-      if self.current_ind in range(len(self.image_list)):
-        print('Saving current state, new index is: {}'.format(new_ind))
-        self.saveCurrentState()
+      # Opened after the no-op returns, they would only add ~0 ms samples
+      with self.timeSpan('navigation'):
+        if self.current_ind in range(len(self.image_list)):
+          print('Saving current state, new index is: {}'.format(new_ind))
+          self.saveCurrentState()
 
-      self.current_ind = new_ind
+        self.current_ind = new_ind
 
-      if self.current_ind not in range(len(self.image_list)):
-        logging.debug('The new image index is out of range, nothing to do.')
-        print('take 4')
+        if self.current_ind not in range(len(self.image_list)):
+          logging.debug('The new image index is out of range, nothing to do.')
+          print('take 4')
+          return
+        self.current_row_baseline = self.journalFields(self.image_list[self.current_ind])
+
+        self.updateNavigationUI()
+        # Turn off the patch edit and segment edit modes
+        if self.patchEditModeOn:
+          self.switchPatchEditMode()
+        if self.segmentEditModeOn:
+          self.switchSegmentEditMode()
+
+        # Whatever the previous image left in the scene goes, except the nodes kept across images
+        self.releaseImageScope()
+        self.image_scope = utility.ResourceScope().open()
+        if self.current_ind >=0 and len(self.image_list) > 0:
+          self.showImageAtCurrentInd()
+          self.loadCurrentSegmentation()
+        self.updatePatchesTable(clearTable=True)
+        self.loadExistingPatches()
+        # Only what loading the image added, nodes the user creates while working on it stay
+        self.image_scope.close()
+        self.prefetchNeighbouringImages()
+        print('Done with this index****')
+      # Decoded volumes are bounded by the cache budget, they do not count as growth
+      self.resource_monitor.sample(self.currentImageId(), accounted_bytes=self.volume_cache.total_bytes)
+
+    def releaseImageScope(self):
+      if self.image_scope is None:
         return
+      fid = slicer.modules.markups.logic().GetActiveListID()
+      # The segment editor node is a singleton, the scope never removes those
+      self.image_scope.keep(self.image_node, self.segmentation_node, slicer.mrmlScene.GetNodeByID(fid) if len(fid) > 0 else None)
+      removed = self.image_scope.release()
+      if removed > 0:
+        logging.info('Removed {} nodes left from the previous image'.format(removed))
+      self.image_scope = None
 
-      self.updateNavigationUI()
-      # Turn off the patch edit and segment edit modes
-      if self.patchEditModeOn:
-        self.switchPatchEditMode()
-      if self.segmentEditModeOn:
-        self.switchSegmentEditMode()
+    #------------------------------------------------------------------------------
+    #------------------------------------------------------------------------------
+    def prefetchNeighbouringImages(self):
+      # Decode the next few rows and the previous one while the grader works on this one
+      if self.image_list is None or self.current_ind not in range(len(self.image_list)):
+        return
+      neighbours = list(range(self.current_ind + 1, self.current_ind + 1 + self.prefetch_count))
+      neighbours.append(self.current_ind - 1)
+      file_paths = []
+      if self.preview_image_path is not None:
+        # Still decoding the full resolution of the shown preview
+        file_paths.append(self.preview_image_path)
+      for ind in neighbours:
+        if ind in range(len(self.image_list)):
+          file_paths.append(self.image_list[ind]['image path'])
+          file_paths.append(self.image_list[ind]['segmentation path'])
+      self.prefetcher.prefetch([p for p in file_paths if not self.volume_cache.contains(p)])
+      if self.local_cache is not None:
+        # Further ahead the files are only copied to local disk, in list order
+        upcoming = self.image_list[self.current_ind:self.current_ind + self.local_cache_lookahead]
+        self.local_cache.pull([row[key] for row in upcoming for key in ['image path', 'segmentation path']])
+
+    #------------------------------------------------------------------------------
+    #------------------------------------------------------------------------------
+    def getDecodedVolume(self, file_path):
+      # Unwritten segmentation snapshots first, they are newer than the file on disk
+      decoded = self.segmentation_writer.pendingSnapshot(file_path)
+      if decoded is not None:
+        return decoded
+      # Memory cache, then whatever the prefetcher has, then a plain read
+      decoded = self.volume_cache.get(file_path)
+      if decoded is None:
+        decoded = self.prefetcher.take(file_path)
+        mtime_ns = self.volume_cache.fileModifiedTime(file_path)
+        info = self.file_index.stat(file_path)
+        if info is None or info.mtime_ns != mtime_ns:
+          # Changed on the server since it was indexed, so is the local copy, readVolume then reads from the server
+          self.file_index.refresh(file_path)
+        if decoded is not None and decoded.mtime_ns != mtime_ns:
+          # The file was rewritten while it was being prefetched
+          decoded = None
+      if decoded is None:
+        try:
+          decoded = self.readVolume(file_path)
+        except Exception as e:
+          logging.warning('Could not decode {}: {}'.format(file_path, e))
+          return None
+      self.volume_cache.put(decoded)
+      return decoded
+
+    #------------------------------------------------------------------------------
+    def localCopy(self, file_path):
+      # Fresh local copy of a server file or None, freshness is checked against the file index
+      if self.local_cache is None:
+        return None
+      return self.local_cache.localPath(file_path, self.file_index.stat(file_path))
 
-      if self.current_ind >=0 and len(self.image_list) > 0:
-        self.showImageAtCurrentInd()
-        self.loadCurrentSegmentation()
-      self.updatePatchesTable(clearTable=True)
-      self.loadExistingPatches()
-      print('Done with this index****')
+    #------------------------------------------------------------------------------
+    def readVolume(self, file_path):
+      # Decodes the local copy when there is a fresh one, also runs on the prefetch workers
+      if self.local_cache is not None:
+        info = self.file_index.stat(file_path)
+        local_path = self.local_cache.localPath(file_path, info)
+        if local_path is not None:
+          try:
+            return volumeio.readVolume(file_path, local_path, info.mtime_ns)
+          except Exception as e:
+            logging.warning('Could not decode the local copy of {}, reading from the server: {}'.format(file_path, e))
+      return volumeio.readVolume(file_path)
+
+    #------------------------------------------------------------------------------
+    def isDecodedVolumeReady(self, file_path):
+      # True if getDecodedVolume would return without decoding the file
+      return self.segmentation_writer.pendingSnapshot(file_path) is not None or \
+        self.volume_cache.contains(file_path) or self.prefetcher.isDone(file_path)
+
+    #------------------------------------------------------------------------------
+    def readImagePreview(self, file_path):
+      try:
+        return volumeio.readPreview(file_path, self.preview_max_size, self.localCopy(file_path))
+      except Exception as e:
+        logging.warning('Could not decode a preview of {}: {}'.format(file_path, e))
+        return None
+
+    #------------------------------------------------------------------------------
+    def swapInFullResolutionImage(self):
+      # Called from previewTimer until the full resolution decode of the shown preview is done
+      if self.preview_image_path is None or self.image_node is None or \
+        self.current_ind not in range(len(self.image_list)) or \
+          self.image_list[self.current_ind]['image path'] != self.preview_image_path:
+        self.preview_image_path = None
+        self.previewTimer.stop()
+        return
+      if not self.prefetcher.isDone(self.preview_image_path):
+        if not self.prefetcher.isPending(self.preview_image_path):
+          self.prefetcher.request(self.preview_image_path)
+        return
+
+      with self.timeSpan('image swap'):
+        imgpath = self.preview_image_path
+        self.preview_image_path = None
+        self.previewTimer.stop()
+        decoded = self.getDecodedVolume(imgpath)
+        if decoded is None:
+          logging.warning('Full resolution decode of {} failed, keeping the preview'.format(imgpath))
+          return
+        if decoded.array.shape != slicer.util.arrayFromVolume(self.image_node).shape:
+          logging.warning('Full resolution {} does not match its preview, keeping the preview'.format(imgpath))
+          return
+        # Same voxel grid, so patches, the segmentation reference geometry and the views stay as they are
+        slicer.util.updateVolumeFromArray(self.image_node, decoded.array)
 
     #------------------------------------------------------------------------------
     #------------------------------------------------------------------------------  
@@ -1066,14 +1425,13 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     #------------------------------------------------------------------------------
     #------------------------------------------------------------------------------
-    def onImageDetailsRowClicked(self, item):
+    def onImageDetailsRowClicked(self, index):
       if self.image_list is None or len(self.image_list) == 0 or\
         self.current_ind not in range(len(self.image_list)):
         logging.debug('Row change has no effect, no image details were found')
         return
 
-      row = item.row()
-      col = item.column()
+      row = index.row()
       if row == self.current_ind:
         self.ui.imageDetailsTable.selectRow(row)
       self.ui.imageNavigationScrollBar.setValue(row+1)
@@ -1087,14 +1445,53 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.current_ind not in range(len(self.image_list)):
         logging.debug('Row change has no effect, no image details were found')
         return
-      item = self.ui.imageDetailsTable.currentItem()
-      row = item.row()
-      col = item.column()
+      index = self.ui.imageDetailsTable.currentIndex()
+      if not index.isValid():
+        return
+      row = index.row()
       if row == self.current_ind:
         self.ui.imageDetailsTable.selectRow(row)
       self.ui.imageNavigationScrollBar.setValue(row+1)
 
 
+  #------------------------------------------------------------------------------
+  #------------------------------------------------------------------------------
+    def onImageDetailsDataChanged(self, top_left, bottom_right):
+      # Keeps the grading flags in sync with checkbox edits and rows changed in code
+      for row_id in range(top_left.row(), bottom_right.row() + 1):
+        if row_id in range(len(self.image_list)):
+          self.grading_state.updateRow(row_id, self.image_list[row_id])
+          if row_id == self.current_ind:
+            # The current row is compared with its baseline and journaled when saved, the
+            # view is also refreshed on every navigation without anything being edited
+            continue
+          self.markMasterRowDirty(row_id)
+          if self.journal is not None:
+            fields = self.journalFields(self.image_list[row_id])
+            self.journal.record(fields['image path'], {key: fields[key] for key in self.imageDetailsModel.checkbox_keys + self.imageDetailsModel.editable_keys if key in fields})
+      if top_left.row() <= self.current_ind <= bottom_right.row():
+        self.scheduleAutosave()
+
+  #------------------------------------------------------------------------------
+  #------------------------------------------------------------------------------
+    def scheduleAutosave(self):
+      # Everything of the current row, taken together when the autosave flushes
+      if self.current_ind not in range(len(self.image_list)):
+        return
+      self.autosave.markDirty('patches', self.saveCurrentImagePatchInfo)
+      self.autosave.markDirty('segmentation', self.saveCurrentSegmentationIfModified)
+      self.autosave.markDirty('row', self.saveCurrentRowToMaster)
+
+  #------------------------------------------------------------------------------
+    def markMasterRowDirty(self, row_id):
+      # Only rows that actually changed get the master csv rewritten
+      self.master_writer.markDirty(row_id)
+      self.autosave.markDirty('master', self.saveMasterCSVInBackground)
+
+  #------------------------------------------------------------------------------
+    def onSegmentationModified(self, caller, event):
+      self.autosave.markDirty('segmentation', self.saveCurrentSegmentationIfModified)
+
   ### Data processing ######
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------  
@@ -1124,25 +1521,15 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         return
       first_ind = self.current_ind
       if 'graded' in self.image_list[first_ind].keys():
-        if forward:
-          for ind in range(first_ind+1, len(self.image_list)):
-            if self.image_list[ind]['graded'] == 0:
-              first_ind = ind
-              break
-            else:
-              if ind == len(self.image_list)-1:
-                slicer.util.infoDisplay("Reached the last image, All graded from {}!!".format(self.current_ind))
-                first_ind = ind
-        else:
-          # Find the first previous ungraded image
-          for ind in range(first_ind - 1, -1, -1):
-            if self.image_list[ind]['graded'] == 0:
-              first_ind = ind
-              break
-            else:
-              if ind == 0:
-                slicer.util.infoDisplay("Reached the first image, All graded  from {}!!".format(self.current_ind))
-                first_ind = ind
+        ind = self.grading_state.findNext(first_ind, {'graded': 0}, forward=forward)
+        if ind is not None:
+          first_ind = ind
+        elif forward and first_ind < len(self.image_list) - 1:
+          slicer.util.infoDisplay("Reached the last image, All graded from {}!!".format(self.current_ind))
+          first_ind = len(self.image_list) - 1
+        elif not forward and first_ind > 0:
+          slicer.util.infoDisplay("Reached the first image, All graded  from {}!!".format(self.current_ind))
+          first_ind = 0
       return first_ind
 
   #------------------------------------------------------------------------------
@@ -1155,8 +1542,7 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         found_at_least_one = False
         for row in self.image_list:
           image_path = row['image path']
-          seg_path_exists = row['segmentation path'].exists() if len(str(row['segmentation path'])) > 0 else True
-          if image_path.exists():
+          if self.file_index.exists(image_path):
             found_at_least_one = True
             break
 
@@ -1192,67 +1578,122 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------  
     def loadCurrentSegmentation(self):
-      if len(self.image_list) == 0 or self.path_to_image_details is None: 
-        logging.warning('Show image at current IND: Need to chose an image list and path to the images - make sure those are in')
-        return
-      if self.current_ind not in range(len(self.image_list)):
-        logging.warning("Wrong image index: {}".format(self.current_ind))
+      with self.timeSpan('segmentation load'):
+        if len(self.image_list) == 0 or self.path_to_image_details is None: 
+          logging.warning('Show image at current IND: Need to chose an image list and path to the images - make sure those are in')
+          return
+        if self.current_ind not in range(len(self.image_list)):
+          logging.warning("Wrong image index: {}".format(self.current_ind))
       
-      imgpath = self.image_list[self.current_ind]['segmentation path']
-      if len(str(imgpath)) == 0:
-        logging.info("Segmentation does not exist")
-        return
-      if len(str(imgpath))> 0 and not imgpath.exists():
-        slicer.util.infoDisplay("Could not load segmenation: {}, does not exist".format(imgpath))
-        self.segmentation_node = None
-        return
-
-      try:
-        if self.segmentation_node is not None:
-          utility.MRMLUtility.removeMRMLNode(self.segmentation_node)
-          self.segmentation_node = None
-          # utility.MRMLUtility.removeMRMLNode(self.segmentation_editor_node)
+        imgpath = self.image_list[self.current_ind]['segmentation path']
+        if len(str(imgpath)) == 0:
+          logging.info("Segmentation does not exist")
+          if self.persistent_nodes and utility.MRMLUtility.isNodeInScene(self.segmentation_node):
+            # The kept node would still show the previous image's segments
+            self.segmentation_node.GetSegmentation().RemoveAllSegments()
+            self.segmentation_baseline = None
+            self.segmentation_needs_save = False
+          return
+        if len(str(imgpath))> 0 and not imgpath.exists():
+          slicer.util.infoDisplay("Could not load segmenation: {}, does not exist".format(imgpath))
+          self.discardSegmentationNode()
+          return
 
-        self.segmentation_node = slicer.util.loadSegmentation(str(imgpath))
-        if self.segmentation_node is None:
-          logging.error('Failed to load segmentation IN THE MIDDLE: {}'.format(imgpath))
-          raise Exception('Error loading segmentation IN THE MIDDLE {}'.format(imgpath))
+        try:
+          self.segmentation_baseline = None
+          self.segmentation_needs_save = False
+          decoded = self.getDecodedVolume(imgpath)
+          if decoded is not None and self.image_node is not None:
+            decoded = self.toImageGeometry(decoded)
+          reused_node = None
+          if self.persistent_nodes and utility.MRMLUtility.isNodeInScene(self.segmentation_node):
+            reused_node = self.segmentation_node
+          elif self.segmentation_node is not None:
+            utility.MRMLUtility.removeMRMLNode(self.segmentation_node)
+            self.segmentation_node = None
+            self.segmentation_reference_geometry = None
+            # utility.MRMLUtility.removeMRMLNode(self.segmentation_editor_node)
+
+          new_node = None
+          if decoded is not None:
+            # Segments are swapped in place when reusing the node
+            new_node = utility.MRMLUtility.createSegmentationNodeFromDecoded(decoded, segmentation_node=reused_node)
+          if new_node is None:
+            if reused_node is not None:
+              utility.MRMLUtility.removeMRMLNode(reused_node)
+              self.segmentation_reference_geometry = None
+            new_node = slicer.util.loadSegmentation(str(self.localCopy(imgpath) or imgpath), {'name': imgpath.name.split('.')[0]})
+          self.segmentation_node = new_node
+          if self.segmentation_node is None:
+            logging.error('Failed to load segmentation IN THE MIDDLE: {}'.format(imgpath))
+            raise Exception('Error loading segmentation IN THE MIDDLE {}'.format(imgpath))
         
-        if self.image_node is not None:
-          self.segmentation_node.SetReferenceImageGeometryParameterFromVolumeNode(self.image_node)
-
-        dn = self.segmentation_node.GetDisplayNode()
-        dn.SetVisibility2DOutline(0)
-        dn.SetVisibility2DFill(1)
-        visibility = self.ui.showSegmentationCheckBox.isChecked()
-        dn.SetVisibility(visibility)
+          if self.image_node is not None:
+            self.updateSegmentationReferenceGeometry()
 
-        # Deal with segment names:
-        current_segmentation = self.segmentation_node.GetSegmentation()
-        number_of_segments = current_segmentation.GetNumberOfSegments()
+          dn = self.segmentation_node.GetDisplayNode()
+          dn.SetVisibility2DOutline(0)
+          dn.SetVisibility2DFill(1)
+          visibility = self.ui.showSegmentationCheckBox.isChecked()
+          dn.SetVisibility(visibility)
 
-        labels = [current_segmentation.GetNthSegment(segment_number).GetLabelValue() for segment_number in range(number_of_segments)]
-        if 3 not in labels:
-          # most probably eyelid is not there, create it
-          self.createEyelidSegment()
-          slicer.util.delayDisplay('Creating eyelid segment', autoCloseMsec=5000)
+          # Deal with segment names:
           current_segmentation = self.segmentation_node.GetSegmentation()
           number_of_segments = current_segmentation.GetNumberOfSegments()
-        elif number_of_segments == 3:
-          # Would need to create the entropion segment
-          self.createEntropionSegment()
-        else:
-          self.setSegmentationLabelNames()
 
-        if self.ui is not None and self.editor is not None:
-          self.selectParameterNode()
-          self.updateEditorSources()
+          labels = [current_segmentation.GetNthSegment(segment_number).GetLabelValue() for segment_number in range(number_of_segments)]
+          if 3 not in labels:
+            # most probably eyelid is not there, create it
+            self.createEyelidSegment()
+            slicer.util.delayDisplay('Creating eyelid segment', autoCloseMsec=5000)
+            current_segmentation = self.segmentation_node.GetSegmentation()
+            number_of_segments = current_segmentation.GetNumberOfSegments()
+          elif number_of_segments == 3:
+            # Would need to create the entropion segment
+            self.createEntropionSegment()
+          else:
+            self.setSegmentationLabelNames()
+
           if self.ui is not None and self.editor is not None:
-            self.editor.setEnabled(self.segmentEditModeOn)
-      except Exception as e:
-        slicer.util.errorDisplay("Couldn't load segmentation: {}\n ERROR: {}".format(imgpath, e))
-        logging.error('Failed to load segmentation: {}\n ERROR: {}'.format(imgpath, e))
-        self.segmentation_node = None
+            self.selectParameterNode()
+            self.updateEditorSources()
+            if self.ui is not None and self.editor is not None:
+              self.editor.setEnabled(self.segmentEditModeOn)
+        except Exception as e:
+          slicer.util.errorDisplay("Couldn't load segmentation: {}\n ERROR: {}".format(imgpath, e))
+          logging.error('Failed to load segmentation: {}\n ERROR: {}'.format(imgpath, e))
+          self.discardSegmentationNode()
+
+    def discardSegmentationNode(self):
+      # A kept node left in the scene would still show the previous image's segments
+      if self.segmentation_node is not None:
+        utility.MRMLUtility.removeMRMLNode(self.segmentation_node)
+      self.segmentation_node = None
+      self.segmentation_reference_geometry = None
+      self.segmentation_baseline = None
+      self.segmentation_needs_save = False
+
+    def toImageGeometry(self, decoded):
+      # Segmentations saved cropped (or exported on a smaller extent) back on the full image grid
+      geometry = utility.MRMLUtility.volumeGeometryKey(self.image_node)
+      if geometry is None or decoded.isVector():
+        return decoded
+      shape = tuple(geometry[0][::-1])
+      ijk_to_ras = np.array(geometry[1]).reshape(4, 4)
+      if decoded.array.shape == shape and np.allclose(decoded.ijk_to_ras, ijk_to_ras):
+        return decoded
+      try:
+        return volumeio.resampleToReferenceGeometry(decoded, shape, ijk_to_ras)
+      except ValueError as e:
+        logging.warning('Loading the segmentation on its own grid: {}'.format(e))
+        return decoded
+
+    def updateSegmentationReferenceGeometry(self):
+      # Only when the image grid changed, a kept segmentation node already has the right one
+      geometry = utility.MRMLUtility.volumeGeometryKey(self.image_node)
+      if geometry != self.segmentation_reference_geometry:
+        self.segmentation_node.SetReferenceImageGeometryParameterFromVolumeNode(self.image_node)
+        self.segmentation_reference_geometry = geometry
 
     def createEntropionSegment(self):
       if self.segmentation_node is None or self.image_node is None:
@@ -1269,86 +1710,80 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       current_segmentation.GetSegmentIDs(segmentIds)
       segmentIds.InsertNextValue('EyelidMargin')
       self.segmentation_node.GetSegmentation().AddEmptySegment('EyelidMargin')
+      # An empty segment does not change the saved labelmap, nothing to write here
       self.setSegmentationLabelNames()
-      
-      # Save this label to image
-      old_state = self.save_segmentation_flag
-      self.save_segmentation_flag = True
-      self.saveCurrentSegmentation()
-      self.save_segmentation_flag = old_state
 
     def createEyelidSegment(self):
-      if self.segmentation_node is None or self.image_node is None:
-        return
+      with self.timeSpan('eyelid creation'):
+        if self.segmentation_node is None or self.image_node is None:
+          return
 
-      current_segmentation = self.segmentation_node.GetSegmentation()
-      number_of_segments = current_segmentation.GetNumberOfSegments()
-      if number_of_segments > 2:
-        # Most probably has an eyelid already, return
-        return
+        current_segmentation = self.segmentation_node.GetSegmentation()
+        number_of_segments = current_segmentation.GetNumberOfSegments()
+        if number_of_segments > 2:
+          # Most probably has an eyelid already, return
+          return
 
-      # Export segment as vtkImageData (via temporary labelmap volume node)
-      segmentIds = vtk.vtkStringArray()
-      current_segmentation.GetSegmentIDs(segmentIds)
-      labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(self.segmentation_node, segmentIds, labelmapVolumeNode, self.image_node, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY )
-      # Manipulate the mask values to add the third label
-      mask = slicer.util.arrayFromVolume(labelmapVolumeNode)
-      newmask = mask.copy()
-      newmask[newmask > 0] = mask.max() + 1
-      clone = slicer.modules.volumes.logic().CloneVolume(labelmapVolumeNode, "CloneLabelMap")
-      slicer.util.updateVolumeFromArray(clone, newmask)
-      segmentImageData = clone.GetImageData()
-      kernelSize = [20, 200, 1]
-      erodeDilate = vtk.vtkImageDilateErode3D()
-      erodeDilate.SetInputData(segmentImageData)
-      erodeDilate.SetDilateValue(mask.max() + 1)
-      erodeDilate.SetErodeValue(0)
-      erodeDilate.SetKernelSize(*kernelSize)
-      erodeDilate.Update()
-      segmentImageData.DeepCopy(erodeDilate.GetOutput())
-      newmask = slicer.util.arrayFromVolume(clone)
-      # Combine both the masks together to add the new labelmap.
-      newmask[mask > 0] = 0
-      newmask = newmask + mask
-      slicer.util.updateVolumeFromArray(clone, newmask)
-      segmentIds.InsertNextValue('EyeLid')
-      segmentIds.InsertNextValue('EyelidMargin')
-      self.segmentation_node.GetSegmentation().AddEmptySegment('EyeLid')
-      self.segmentation_node.GetSegmentation().AddEmptySegment('EyelidMargin')
-      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(clone, self.segmentation_node, segmentIds)
-      self.setSegmentationLabelNames()
-      
-      # Save this label to image
-      old_state = self.save_segmentation_flag
-      self.save_segmentation_flag = True
-      self.saveCurrentSegmentation()
-      self.save_segmentation_flag = old_state
+        # Export segment as vtkImageData (via temporary labelmap volume node)
+        segmentIds = vtk.vtkStringArray()
+        current_segmentation.GetSegmentIDs(segmentIds)
+        with utility.ResourceScope():
+          labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+          slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(self.segmentation_node, segmentIds, labelmapVolumeNode, self.image_node, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY )
+          # Add the third label around the existing ones, in place on the exported labelmap
+          mask = slicer.util.arrayFromVolume(labelmapVolumeNode)
+          eyelid.createEyelidLabelmap(mask, out=mask)
+          slicer.util.arrayFromVolumeModified(labelmapVolumeNode)
+          segmentIds.InsertNextValue('EyeLid')
+          segmentIds.InsertNextValue('EyelidMargin')
+          self.segmentation_node.GetSegmentation().AddEmptySegment('EyeLid')
+          self.segmentation_node.GetSegmentation().AddEmptySegment('EyelidMargin')
+          slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, self.segmentation_node, segmentIds)
+        self.setSegmentationLabelNames()
       
-      slicer.mrmlScene.RemoveNode(labelmapVolumeNode.GetDisplayNode().GetColorNode())
-      slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-      slicer.mrmlScene.RemoveNode(clone.GetDisplayNode().GetColorNode())
-      slicer.mrmlScene.RemoveNode(clone)
+        # New labels, written with the next save
+        self.segmentation_needs_save = True
 
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------  
     def showImageAtCurrentInd(self):
-      logging.info('In showImageAtCurrentInd')
-      if len(self.image_list) == 0 or self.path_to_image_details is None:
-        slicer.util.errorDisplay('Show image at current IND: Need to chose an image list - make sure those are in')
-        return
-      if self.current_ind not in range(len(self.image_list)):
-        slicer.util.warningDisplay("Wrong image index: {}".format(self.current_ind))
+      with self.timeSpan('image load'):
+        logging.info('In showImageAtCurrentInd')
+        if len(self.image_list) == 0 or self.path_to_image_details is None:
+          slicer.util.errorDisplay('Show image at current IND: Need to chose an image list - make sure those are in')
+          return
+        if self.current_ind not in range(len(self.image_list)):
+          slicer.util.warningDisplay("Wrong image index: {}".format(self.current_ind))
 
-      imgpath =  self.image_list[self.current_ind]['image path']
-      try:
-        if self.image_node is not None:
-          utility.MRMLUtility.removeMRMLNode(self.image_node)
-        #utility.MRMLUtility.loadMRMLNode('image_node', self.path_to_server, self.image_list[self.current_ind] + '.jpg', 'VolumeFile') 
-        self.image_node = slicer.util.loadVolume(str(imgpath), {'singleFile':True})
-        slicer.util.resetSliceViews()
-      except Exception as e:
-        slicer.util.errorDisplay("Couldn't load imagepath: {}\n ERROR: {}".format(imgpath, e))
+        imgpath =  self.image_list[self.current_ind]['image path']
+        try:
+          #utility.MRMLUtility.loadMRMLNode('image_node', self.path_to_server, self.image_list[self.current_ind] + '.jpg', 'VolumeFile') 
+          self.preview_image_path = None
+          decoded = None
+          if self.progressive_preview and not self.isDecodedVolumeReady(imgpath):
+            # The full resolution decode starts in the background right away, previewTimer swaps it in
+            self.prefetcher.request(imgpath)
+            decoded = self.readImagePreview(imgpath)
+          if decoded is not None:
+            self.preview_image_path = imgpath
+            self.previewTimer.start()
+          else:
+            decoded = self.getDecodedVolume(imgpath)
+          if decoded is not None and self.persistent_nodes and utility.MRMLUtility.isNodeInScene(self.image_node) and \
+            utility.MRMLUtility.updateVolumeNodeFromDecoded(self.image_node, decoded):
+            # Same node as for the previous image, nothing added to or removed from the scene
+            pass
+          elif decoded is not None:
+            if self.image_node is not None:
+              utility.MRMLUtility.removeMRMLNode(self.image_node)
+            self.image_node = utility.MRMLUtility.createVolumeNodeFromDecoded(decoded)
+          else:
+            if self.image_node is not None:
+              utility.MRMLUtility.removeMRMLNode(self.image_node)
+            self.image_node = slicer.util.loadVolume(str(self.localCopy(imgpath) or imgpath), {'singleFile':True, 'name': imgpath.name.split('.')[0]})
+          slicer.util.resetSliceViews()
+        except Exception as e:
+          slicer.util.errorDisplay("Couldn't load imagepath: {}\n ERROR: {}".format(imgpath, e))
 
     #------------------------------------------------------------------------------
     def readCSV(self, file_path):
@@ -1371,180 +1806,301 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------  
     def loadExistingPatches(self):
-      if len(self.image_list) == 0 or \
-        self.path_to_server is None or \
-          self.current_ind < 0 or self.current_ind >= len(self.image_list):
-        logging.info('Cannot load existincg patch info: Select a valid csv file and point to a correct folder with images')
-        return
+      with self.timeSpan('patch load'):
+        if len(self.image_list) == 0 or \
+          self.path_to_server is None or \
+            self.current_ind < 0 or self.current_ind >= len(self.image_list):
+          logging.info('Cannot load existincg patch info: Select a valid csv file and point to a correct folder with images')
+          return
 
-      if self.ui.imagePatchesTableWidget is None:
-        logging.warning('Image Patches table is None, returning from loadExistingPatches')
-        return
+        if self.ui.imagePatchesTableWidget is None:
+          logging.warning('Image Patches table is None, returning from loadExistingPatches')
+          return
 
-      csv_file_path = self.getCurrentPatchFilePath()
-      if csv_file_path is None:
-        logging.warining('Error getting the name of the patches file, returning')
-        return
+        if self.patch_store is None:
+          logging.warning('Patch store is not open, returning from loadExistingPatches')
+          return
 
-      if csv_file_path.exists():
-        logging.info('Attempting to read existing patches file')
-        try:
-          rows = self.readCSV(csv_file_path)
-          if len(rows) > 0:
-            for row in rows:
-              ijk = None
-              ijk = [int(row['x']), int(row['y']), 0]
-              # Adding row to the table will also update the combo box
-              row_id = self.addPatchRow(ijk, label=row['label'])
-              logging.debug('Added row: {}, ijk: {}, label: {}'.format(row_id, ijk, row['label']))
-              logging.debug('Combobox label: {}, table label: {}'.format(self.ui.patchLabelComboBox.currentText,  self.ui.imagePatchesTableWidget.item(row_id, 1).text()))
-              if row_id is not None:
-                # Get physical coordinates from voxel coordinates
-                volumeIjkToRas = vtk.vtkMatrix4x4()
-                self.image_node.GetIJKToRASMatrix(volumeIjkToRas)
-                point_VolumeRas = [0, 0, 0, 1]
-                volumeIjkToRas.MultiplyPoint(np.append(ijk,1.0), point_VolumeRas)
-                # If volume node is transformed, apply that transform to get volume's RAS coordinates
-                transformVolumeRasToRas = vtk.vtkGeneralTransform()
-                slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(self.image_node.GetParentTransformNode(), None, transformVolumeRasToRas)
-                point_Ras = transformVolumeRasToRas.TransformPoint(point_VolumeRas[0:3])
-                self.addFiducial(row_id=row_id, ras=point_Ras)
-                logging.debug('After adding fiducial: ')
-                logging.debug('Combobox label: {}, table label: {}'.format(self.ui.patchLabelComboBox.currentText,  self.ui.imagePatchesTableWidget.item(row_id, 1).text()))
-                self.updateFiducialSelection(row_id)
-          else:
-            raise IOError('Error reading the patches file')
-        except IOError as e:
-          logging.warning("Couldn't read the patches file {}, clearing the widget table: \n {}".format(csv_file_path, e))
-          self.updatePatchesTable(clearTable=True)
-        except Exception as e:
-          logging.warning("Error loading existing path file {}, error: \n {} ".format(csv_file_path, e))
-          self.updatePatchesTable(clearTable=True)
+        image = self.imageKey(self.image_list[self.current_ind])
+        if self.patch_store.contains(image):
+          logging.info('Loading existing patches')
+          try:
+            rows = self.patch_store.get(image)
+            if len(rows) > 0:
+              self.addPatchRowsInBulk(rows)
+          except Exception as e:
+            logging.warning("Error loading existing patches of {}, error: \n {} ".format(image, e))
+            self.updatePatchesTable(clearTable=True)
 
   #------------------------------------------------------------------------------
+  #------------------------------------------------------------------------------
+    def masterCSVBackupPath(self):
+      csv_file_name = self.path_to_image_details.name
+      # Create a temporary file by user name as a backup.
+      csv_file_name = csv_file_name.replace('.csv', '_{}.csv'.format(self.user_name))
+      if self.temp_path:
+        return self.temp_path / csv_file_name
+      return self.path_to_image_details.parent / csv_file_name
+
   #------------------------------------------------------------------------------
     def writeFinalMasterCSV(self):
-      if len(self.image_list) > 0 and self.path_to_server is not None:
-        csv_file_name = self.path_to_image_details.name
-        # Create a temporary file by user name as a backup.
-        csv_file_name = csv_file_name.replace('.csv', '_{}.csv'.format(self.user_name))
-        if self.temp_path:
-          path = self.temp_path / csv_file_name
-          print(path)
-        else:
-          path = self.path_to_image_details.parent / csv_file_name
+      with self.timeSpan('master write'):
+        if len(self.image_list) > 0 and self.path_to_server is not None:
+          path = self.masterCSVBackupPath()
           print(path)
-        try:
-          with open(path, 'w', newline='') as fh:
-            fieldnames = self.image_list[0].keys()
-            writer = DictWriter(fh, fieldnames=fieldnames)
-            writer.writeheader()
-            for listrow in self.image_list:
-              row = listrow.copy()
-              row['image path'] = row['image path'].relative_to(self.path_to_server)
-              row['segmentation path'] = row['segmentation path'].relative_to(self.path_to_server) if len(str(row['segmentation path']))>0 else ''
-              if row['patches path'].exists():
-                row['patches path'] = row['patches path'].relative_to(self.path_to_server)
-              else:
-                row['patches path'] = ''
-              writer.writerow(row)
-          from shutil import copyfile
-          copyfile(path, self.path_to_image_details)
-          return True
-        except IOError as e:
-          logging.error('ERROR Writing out the master csv file.\n {}'.format(e))
-          slicer.util.errorDisplay('ERROR Writing out the master csv file.\n {}'.format(e))
-          return False
-        except KeyError as e:
-          logging.error('ERROR durign key parsing.\n {}'.format(e))
-          slicer.util.errorDisplay('Error during key parsing for the final write')
-          return False
+          try:
+            # Let background writes (patch files) land first, the csv refers to them
+            self.autosave.waitForWrites()
+            logging.debug('Serializing {} changed master rows'.format(self.master_writer.numDirty()))
+            text = self.master_writer.serialize(self.image_list, self.masterCSVRow)
+            exports = self.takePatchExports()
+            try:
+              self.exportPatchCSVs(exports)
+              self.patchCSVsExported(exports, None)
+            except IOError as e:
+              self.patchCSVsExported(exports, e)
+              raise
+            # Both are replaced atomically, a crash never leaves a truncated master file
+            mastercsv.atomicWrite(path, text)
+            mastercsv.atomicWrite(self.path_to_image_details, text)
+            self.autosave.discard('master')
+            if self.journal is not None:
+              self.journal.truncate()
+            return True
+          except IOError as e:
+            logging.error('ERROR Writing out the master csv file.\n {}'.format(e))
+            slicer.util.errorDisplay('ERROR Writing out the master csv file.\n {}'.format(e))
+            return False
+          except KeyError as e:
+            logging.error('ERROR durign key parsing.\n {}'.format(e))
+            slicer.util.errorDisplay('Error during key parsing for the final write')
+            return False
 
-    def saveCurrentSegmentation(self):
-      if len(self.image_list) == 0 or \
-        self.path_to_server is None or \
-          self.current_ind not in range(len(self.image_list)):
-        logging.warning('Cannot save current patch info: Select a valid csv file and point to a correct folder with images')
+  #------------------------------------------------------------------------------
+    def saveMasterCSVInBackground(self):
+      if len(self.image_list) == 0 or self.path_to_server is None:
         return
-
-      if not self.save_segmentation_flag:
-        logging.info('Segmentation save has not been set yet. Returning')
+      try:
+        text = self.master_writer.serialize(self.image_list, self.masterCSVRow)
+      except KeyError as e:
+        logging.error('ERROR durign key parsing.\n {}'.format(e))
         return
+      paths = [self.masterCSVBackupPath(), self.path_to_image_details]
+      exports = self.takePatchExports()
+      session_journal = self.journal
+      journal_records = session_journal.records if session_journal is not None else 0
+      timings = self.timings
+      def write():
+        with timings.span('master write (background)'):
+          self.exportPatchCSVs(exports)
+          for path in paths:
+            mastercsv.atomicWrite(path, text)
+      def done(error):
+        self.patchCSVsExported(exports, error)
+        if error is not None:
+          slicer.util.errorDisplay('ERROR Writing out the master csv file.\n {}'.format(error))
+          return
+        slicer.util.showStatusMessage('Saved {}'.format(self.path_to_image_details.name), 3000)
+        # Only drop the journal if nothing was journaled after this snapshot
+        if session_journal is not None and session_journal is self.journal and session_journal.records == journal_records:
+          session_journal.truncate()
+      self.autosave.submit('master', write, done)
 
-      if self.image_node is None or self.segmentation_node is None:
-        logging.warning('Nothing to save')
-        self.save_segmentation_flag = False
-        return
-      if not self.segment_out_dir_path: 
-        logging.warning('Segmentation output path not set, returning')
-        self.save_segmentation_flag = False
+  #------------------------------------------------------------------------------
+    def takePatchExports(self):
+      # [(rows, csv path)] of the images whose patches changed since the last export
+      if self.patch_store is None:
+        return []
+      return [(rows, self.patch_paths[image]) for image, rows in self.patch_store.takeUnexported() if image in self.patch_paths]
+
+    @staticmethod
+    def exportPatchCSVs(exports):
+      # Keeps the per image csv layout up to date for the tools reading it, runs on the writer thread
+      for rows, csv_path in exports:
+        patchstore.exportCSV(rows, csv_path)
+
+    def patchCSVsExported(self, exports, error):
+      if error is not None and self.patch_store is not None:
+        # Export them again with the next save
+        images = {path: image for image, path in self.patch_paths.items()}
+        self.patch_store.markUnexported([images[csv_path] for rows, csv_path in exports if csv_path in images])
+      for rows, csv_path in exports:
+        self.file_index.refresh(csv_path)
+
+  #------------------------------------------------------------------------------
+    def masterCSVRow(self, listrow):
+      row = listrow.copy()
+      row['image path'] = row['image path'].relative_to(self.path_to_server)
+      row['segmentation path'] = row['segmentation path'].relative_to(self.path_to_server) if len(str(row['segmentation path']))>0 else ''
+      has_patches = self.patch_store is not None and len(self.patch_store.get(self.imageKey(listrow))) > 0
+      # Patches in the store are exported together with the master csv
+      if has_patches or self.file_index.exists(row['patches path']):
+        row['patches path'] = row['patches path'].relative_to(self.path_to_server)
+      else:
+        row['patches path'] = ''
+      return row
+
+    def exportSegmentationSnapshot(self, file_path=None):
+      with self.timeSpan('segmentation export'):
+        if self.segmentation_node is None:
+          return None
+        # Written with the segment names and colors, without going through saveNode
+        return utility.MRMLUtility.snapshotSegmentationNode(self.segmentation_node, file_path)
+
+    #------------------------------------------------------------------------------
+    def captureSegmentationBaseline(self):
+      # Remember what the segmentation looked like before any editing, once per load/save
+      if self.segmentation_node is None or self.segmentation_baseline is not None:
         return
+      snapshot = self.exportSegmentationSnapshot()
+      self.segmentation_baseline = {
+        'mtime': utility.MRMLUtility.segmentationModifiedTime(self.segmentation_node),
+        'digest': snapshot.digest() if snapshot is not None else None,
+      }
 
-      labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(self.segmentation_node, labelmapVolumeNode)
-      out_segmentation_path = self.getCurrentSegmentationFilePath()
-      if not self.segment_out_dir_path.is_dir():
-        self.segment_out_dir_path.mkdir(parents=True)
+    #------------------------------------------------------------------------------
+    def segmentationMayBeModified(self):
+      if self.segmentation_node is None:
+        return False
+      if self.segmentation_needs_save:
+        return True
+      if self.segmentation_baseline is None:
+        # Never went into segment edit mode, so nothing could have been painted
+        return False
+      return utility.MRMLUtility.segmentationModifiedTime(self.segmentation_node) != self.segmentation_baseline['mtime']
 
-      if not out_segmentation_path:
-        out_segmentation_path = self.segment_out_dir_path / self.image_node.GetName()+".nrrd"
-        self.image_list[self.current_ind]['segmentation path'] = out_segmentation_path
-      else:
-        expected_out_path = self.segment_out_dir_path / out_segmentation_path.name
-        if expected_out_path != out_segmentation_path:
-          out_segmentation_path = expected_out_path
+    #------------------------------------------------------------------------------
+    def saveCurrentSegmentationIfModified(self):
+      if self.segmentationMayBeModified():
+        self.saveCurrentSegmentation()
+
+    #------------------------------------------------------------------------------
+    def saveCurrentSegmentation(self):
+      with self.timeSpan('segmentation save'):
+        if len(self.image_list) == 0 or \
+          self.path_to_server is None or \
+            self.current_ind not in range(len(self.image_list)):
+          logging.warning('Cannot save current patch info: Select a valid csv file and point to a correct folder with images')
+          return
+
+        if not self.segmentationMayBeModified():
+          logging.info('Segmentation was not modified. Returning')
+          return
+
+        if self.image_node is None or self.segmentation_node is None:
+          logging.warning('Nothing to save')
+          return
+        if not self.segment_out_dir_path: 
+          logging.warning('Segmentation output path not set, returning')
+          return
+
+        snapshot = self.exportSegmentationSnapshot()
+        if snapshot is None:
+          logging.warning('Segmentation export is empty, nothing to save')
+          return
+        digest = snapshot.digest()
+        if not self.segmentation_needs_save and digest == self.segmentation_baseline['digest']:
+          # Touched but painted back to the same labels
+          logging.info('Segmentation content unchanged, skipping the save')
+          self.segmentation_baseline['mtime'] = utility.MRMLUtility.segmentationModifiedTime(self.segmentation_node)
+          return
+
+        out_segmentation_path = self.getCurrentSegmentationFilePath()
+        if not self.segment_out_dir_path.is_dir():
+          self.segment_out_dir_path.mkdir(parents=True)
+
+        if not out_segmentation_path:
+          out_segmentation_path = self.segment_out_dir_path / (self.image_node.GetName()+".nrrd")
           self.image_list[self.current_ind]['segmentation path'] = out_segmentation_path
-          self.updateMasterDictAndTable()
+          self.markMasterRowDirty(self.current_ind)
+        else:
+          expected_out_path = self.segment_out_dir_path / out_segmentation_path.name
+          if expected_out_path != out_segmentation_path:
+            out_segmentation_path = expected_out_path
+            self.image_list[self.current_ind]['segmentation path'] = out_segmentation_path
+            self.updateMasterDictAndTable()
+
+        # Anything decoded from this file before the write is stale now
+        self.prefetcher.discard(out_segmentation_path)
+        self.volume_cache.discard(out_segmentation_path)
+        snapshot.file_path = Path(out_segmentation_path)
+        self.segmentation_writer.submit(snapshot)
+        # What was just queued is the new reference for further edits
+        self.segmentation_needs_save = False
+        self.segmentation_baseline = {
+          'mtime': utility.MRMLUtility.segmentationModifiedTime(self.segmentation_node),
+          'digest': digest,
+        }
+        # slicer.util.delayDisplay("Segmentation saved to {}".format(out_segmentation_path))
 
-      slicer.util.saveNode(labelmapVolumeNode, str(out_segmentation_path))
-      slicer.mrmlScene.RemoveNode(labelmapVolumeNode.GetDisplayNode().GetColorNode())
-      slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-      self.save_segmentation_flag = False
-      # slicer.util.delayDisplay("Segmentation saved to {}".format(out_segmentation_path))
+  #------------------------------------------------------------------------------
+  #------------------------------------------------------------------------------
+    def checkSegmentationWrites(self):
+      # Called from the timer on the main thread, returns False if any write failed
+      all_written = True
+      for snapshot, error in self.segmentation_writer.takeResults():
+        if error is not None:
+          all_written = False
+          slicer.util.errorDisplay("Couldn't save segmentation: {}\n ERROR: {}".format(snapshot.file_path, error))
+        else:
+          slicer.util.showStatusMessage('Saved segmentation {}'.format(snapshot.file_path.name), 3000)
+          self.file_index.refresh(snapshot.file_path)
+          # What was just written is exactly what a reload would decode
+          snapshot.mtime_ns = self.volume_cache.fileModifiedTime(snapshot.file_path)
+          self.volume_cache.put(snapshot)
+      return all_written
 
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------  
     def saveCurrentImagePatchInfo(self):
-      if len(self.image_list) == 0 or \
-        self.path_to_server is None or \
-          self.current_ind not in range(len(self.image_list)):
-        logging.warning('Cannot save current patch info: Select a valid csv file and point to a correct folder with images')
-        return
+      with self.timeSpan('patch save'):
+        if len(self.image_list) == 0 or \
+          self.path_to_server is None or \
+            self.current_ind not in range(len(self.image_list)):
+          logging.warning('Cannot save current patch info: Select a valid csv file and point to a correct folder with images')
+          return
 
-      if self.ui.imagePatchesTableWidget is None:
-        logging.warning('Image Patches table is None, returning from saveCurrentImagePatchInfo')
-        return
+        if self.ui.imagePatchesTableWidget is None:
+          logging.warning('Image Patches table is None, returning from saveCurrentImagePatchInfo')
+          return
 
-      csv_file_rows = []
-      numrows = self.ui.imagePatchesTableWidget.rowCount
-      try:
-        for row in range(numrows):
-          csv_row = {}
-          text = self.ui.imagePatchesTableWidget.item(row, 0).text()
-          csv_row['x'] = text.split(',')[0]
-          csv_row['y'] = text.split(',')[1]
-          csv_row['label'] = self.ui.imagePatchesTableWidget.item(row, 1).text()
-          csv_file_rows.append(csv_row)
-      except Exception as e:
-        logging.error('Error parsing the table widget: \n {}'.format(e))
-        return
+        csv_file_rows = []
+        numrows = self.ui.imagePatchesTableWidget.rowCount
+        try:
+          for row in range(numrows):
+            csv_row = {}
+            text = self.ui.imagePatchesTableWidget.item(row, 0).text()
+            csv_row['x'] = text.split(',')[0]
+            csv_row['y'] = text.split(',')[1]
+            csv_row['label'] = self.ui.imagePatchesTableWidget.item(row, 1).text()
+            csv_file_rows.append(csv_row)
+        except Exception as e:
+          logging.error('Error parsing the table widget: \n {}'.format(e))
+          return
       
-      if len(csv_file_rows) == 0:
-        logging.info('No rows were parsed from the Patches Table, nothing to save: returning')
-        return
+        if len(csv_file_rows) == 0:
+          logging.info('No rows were parsed from the Patches Table, nothing to save: returning')
+          return
 
-      csv_file_path = self.getCurrentPatchFilePath()
-      if csv_file_path is None:
-        logging.warining('Error getting the name of the patches file, returning')
-        return
-      try:
-        with open(csv_file_path, 'w', newline='') as fh:
-          writer = DictWriter(fh, csv_file_rows[0].keys())
-          writer.writeheader()
-          writer.writerows(csv_file_rows)
-        logging.info('Wrote the patches file: {}'.format(csv_file_path))
-      except IOError as e:
-        logging.error('Error writing the csv file: {} \n  {}'.format(csv_file_path, e))
+        if self.patch_store is None:
+          logging.warning('Patch store is not open, returning from saveCurrentImagePatchInfo')
+          return
+        image = self.imageKey(self.image_list[self.current_ind])
+        rows = self.patch_store.put(image, csv_file_rows)
+        if rows is None:
+          logging.debug('Patches of {} unchanged, nothing to save'.format(image))
+          return
+        # The patches path column depends on the image having patches, the per image csv is
+        # exported with the next master csv save
+        self.markMasterRowDirty(self.current_ind)
+        def done(error):
+          if error is None:
+            logging.info('Saved the patches of {}'.format(image))
+        timings = self.timings
+        def write():
+          with timings.span('patch store write', image):
+            self.patch_store.commit(image, rows)
+        self.autosave.submit(('patches', image), write, done)
 
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------
@@ -1553,6 +2109,9 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         or self.current_ind not in range(len(self.image_list)):
         logging.debug('Nothing to update for master table, returning')
         return
+      if self.patch_update_batch is not None:
+        self.patch_update_batch.defer('master', self.updateMasterDictAndTable)
+        return
       print(self.image_list[self.current_ind])
       # self.image_list[self.current_ind]['n samples'] = self.ui.imagePatchesTableWidget.rowCount
       labelColumn = [ self.ui.imagePatchesTableWidget.item(row, 1).text() for row in range(self.ui.imagePatchesTableWidget.rowCount)]
@@ -1563,50 +2122,78 @@ class TTSegToolWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       # self.image_list[self.current_ind]['n healthy'] = len( [row for row in labelColumn if row == 'Healthy'] )
       # self.image_list[self.current_ind]['n none'] = len( [row for row in labelColumn if row == 'Unknown'] )
 
-      # Get the checkbox state.
-      # checkchangeskeys = ['tt present', 'tt sev', 'n lashes touching', 'epilation sev']
-      checkchangeskeys = []
-      for columnid in range(self.ui.imageDetailsTable.columnCount):
-        # Save the current state of the table
-        headerlabel = self.ui.imageDetailsTable.horizontalHeaderItem(columnid).text()
-        if headerlabel in self.checkboxKeys:
-          state = self.ui.imageDetailsTable.item(self.current_ind, columnid).checkState()
-          self.image_list[self.current_ind][headerlabel] = 0 if state==qt.Qt.Unchecked else 1
-        elif headerlabel in checkchangeskeys:
-          self.image_list[self.current_ind][headerlabel] = int(self.ui.imageDetailsTable.item(self.current_ind, columnid).text())
-        elif headerlabel.startswith('n ') or headerlabel == 'segmentation path':
-          self.ui.imageDetailsTable.item(self.current_ind, columnid).setText('{}'.format(self.image_list[self.current_ind][headerlabel]))
-        elif headerlabel == 'comments':
-          self.image_list[self.current_ind][headerlabel] = self.ui.imageDetailsTable.item(self.current_ind, columnid).text()
-      if self.image_list[self.current_ind]['graded'] == 1:
-        self.num_graded.add(self.current_ind)
-      else:
-        if self.current_ind in self.num_graded:
-          self.num_graded.remove(self.current_ind)
+      # Checkbox and comment edits already went into image_list through the table model,
+      # only the view needs to pick up the columns changed here (e.g. segmentation path)
+      self.imageDetailsModel.rowChanged(self.current_ind)
       print(self.image_list[self.current_ind])
 
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------
     def saveCurrentRowToMaster(self):
-      if self.tmp_csv_file_name is not None and \
-        len(self.image_list) > 0 and \
+      if len(self.image_list) > 0 and \
         self.current_ind in range(len(self.image_list)):
-        fieldnames = self.image_list[self.current_ind].keys()
-        writeheader = False
-        if not self.tmp_csv_file_name.exists():
-          writeheader = True
+        fields = self.journalFields(self.image_list[self.current_ind])
+        baseline = self.current_row_baseline or {}
+        changed = {key: value for key, value in fields.items() if baseline.get(key) != value}
+        if len(changed) == 0:
+          return
+        self.markMasterRowDirty(self.current_ind)
+        self.current_row_baseline = fields
+        if self.journal is None:
+          return
         try:
-          with open(self.tmp_csv_file_name, 'a+', newline='') as fh:
-            writer = DictWriter(fh, fieldnames = fieldnames)
-            if writeheader:
-              writer.writeheader()
-            writer.writerow(self.image_list[self.current_ind])
+          self.journal.record(fields['image path'], changed)
         except Exception as e:
-          logging.warning('Error writing the row {} to csv {}'.format(self.current_ind, self.tmp_csv_file_name))
+          logging.warning('Error journaling the row {} to {}: {}'.format(self.current_ind, self.journal.journal_path, e))
+
+  #------------------------------------------------------------------------------
+  #------------------------------------------------------------------------------
+    def journalFields(self, row):
+      # Row as stored in the master csv, paths relative to the server
+      fields = {}
+      for key, value in row.items():
+        if isinstance(value, Path):
+          try:
+            value = value.relative_to(self.path_to_server).as_posix()
+          except ValueError:
+            value = value.as_posix()
+        fields[key] = value
+      return fields
+
+  #------------------------------------------------------------------------------
+  #------------------------------------------------------------------------------
+    def restoreSessionJournal(self):
+      # Replays the edits of a session that ended before writing the master csv, then keeps journaling to it
+      journal_path = self.temp_path / self.path_to_image_details.name.replace('.csv', '_{}.journal'.format(self.user_name))
+      try:
+        changes = journal.replayJournal(journal_path)
+      except IOError as e:
+        logging.error('Could not read the session journal {}: {}'.format(journal_path, e))
+        changes = {}
+      if len(changes) > 0:
+        path_keys = ['image path', 'segmentation path', 'patches path']
+        restored = 0
+        for row in self.image_list:
+          image_key = row['image path'].relative_to(self.path_to_server).as_posix()
+          if image_key not in changes:
+            continue
+          for key, value in changes[image_key].items():
+            if key in path_keys:
+              value = self.path_to_server / value if len(value) > 0 else ''
+            elif key in self.checkboxKeys:
+              value = int(value)
+            row[key] = value
+          restored += 1
+        logging.info('Restored {} rows from the session journal {}'.format(restored, journal_path))
+        slicer.util.showStatusMessage('Restored {} rows from the previous session'.format(restored), 5000)
+      self.journal = journal.SessionJournal(journal_path)
 
   #------------------------------------------------------------------------------
   #------------------------------------------------------------------------------  
     def updateFiducialSelection(self, row):
+      if self.patch_update_batch is not None:
+        self.patch_update_batch.defer('selection', lambda: self.updateFiducialSelection(row))
+        return
       if row not in range(self.ui.imagePatchesTableWidget.rowCount):
         return
 
@@ -1738,48 +2325,53 @@ class TTSegToolTest(ScriptedLoadableModuleTest):
       self.test_TTSegTool1()
 
     def test_TTSegTool1(self):
-      """ Ideally you should have several levels of tests.  At the lowest level
-      tests should exercise the functionality of the logic with different inputs
-      (both valid and invalid).  At higher levels your tests should emulate the
-      way the user would interact with your code and confirm that it still works
-      the way you intended.
-      One of the most important features of the tests is that it should alert other
-      developers when their changes will have an impact on the behavior of your
-      module.  For example, if a developer removes a feature that you depend on,
-      your test should break so they know that the feature is needed.
+      """ Grading loop on a small synthetic dataset (Testing/Python/SyntheticDataset.py):
+      load the master csv, go through the images adding a patch and ticking graded on each,
+      write the master csv and check what landed on disk.
       """
 
       self.delayDisplay("Starting the test")
 
-      # Get/create input data
-
-      import SampleData
-      registerSampleData()
-      inputVolume = SampleData.downloadSample('TTSegTool1')
-      self.delayDisplay('Loaded test data set')
-
-      inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-      self.assertEqual(inputScalarRange[0], 0)
-      self.assertEqual(inputScalarRange[1], 695)
-
-      outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-      threshold = 100
+      import shutil
+      import sys
+      import tempfile
+      sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'Testing', 'Python'))
+      import SyntheticDataset
+      import NavigationBenchmark
 
-      # Test the module logic
-
-      logic = TTSegToolLogic()
-
-      # Test algorithm with non-inverted threshold
-      logic.process(inputVolume, outputVolume, threshold, True)
-      outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-      self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-      self.assertEqual(outputScalarRange[1], threshold)
-
-      # Test algorithm with inverted threshold
-      logic.process(inputVolume, outputVolume, threshold, False)
-      outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-      self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-      self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+      num_images = 4
+      server_path = Path(tempfile.mkdtemp(prefix='TTSegToolTest_'))
+      widget = NavigationBenchmark.moduleWidget()
+      try:
+        master_path = SyntheticDataset.generateDataset(server_path, num_images, rows=120, columns=160, graded_fraction=0.0, seed=1)
+        self.delayDisplay('Generated the test data set')
+
+        with NavigationBenchmark.quietDialogs() as errors:
+          NavigationBenchmark.loadDataset(widget, master_path, server_path, 'test')
+          self.assertEqual(len(widget.image_list), num_images)
+          self.assertEqual(widget.current_ind, 0)
+          for ind in range(num_images):
+            widget.changeCurrentImageInd(ind)
+            self.assertEqual(widget.current_ind, ind)
+            self.assertIsNotNone(widget.image_node)
+            NavigationBenchmark.addPatch(widget, (10 + ind, 20, 0))
+            NavigationBenchmark.setChecked(widget, ind, 'graded')
+          self.assertEqual(widget.grading_state.count('graded'), num_images)
+          # Leaving the last image saves it
+          widget.changeCurrentImageInd(0)
+          self.assertTrue(widget.writeFinalMasterCSV())
+        self.assertEqual(errors, [])
+
+        rows = widget.readCSV(master_path)
+        self.assertEqual(len(rows), num_images)
+        for ind, row in enumerate(rows):
+          self.assertEqual(int(row['graded']), 1)
+          patches = widget.readCSV(server_path / row['patches path'])
+          self.assertEqual((patches[-1]['x'], patches[-1]['y']), (str(10 + ind), '20'))
+      finally:
+        # Closes the patch store and the journal before their files are removed
+        widget.initData()
+        shutil.rmtree(server_path, ignore_errors=True)
 
       self.delayDisplay('Test passed')
 
@@ -0,0 +1,80 @@
+'''
+Compares the NumPy eyelid synthesis (CommonUtilities/eyelid.py) with the former
+vtkImageDilateErode3D implementation on full resolution eye photo sized labelmaps.
+Checks that both give identical labels and reports the timings.
+
+    PythonSlicer EyelidSynthesisBenchmark.py --sizes 3000x4000 4000x6000 --repeats 3
+'''
+from argparse import ArgumentParser
+from pathlib import Path
+import sys
+import time
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from CommonUtilities import eyelid
+
+
+def vtkEyelidLabelmap(mask, kernel_size=eyelid.EYELID_KERNEL_SIZE):
+    # Former implementation, without the MRML nodes around it
+    newmask = mask.copy()
+    newmask[newmask > 0] = mask.max() + 1
+    image = vtk.vtkImageData()
+    image.SetDimensions(mask.shape[2], mask.shape[1], mask.shape[0])
+    scalars = numpy_support.numpy_to_vtk(newmask.ravel(), deep=True, array_type=numpy_support.get_vtk_array_type(newmask.dtype))
+    image.GetPointData().SetScalars(scalars)
+    erodeDilate = vtk.vtkImageDilateErode3D()
+    erodeDilate.SetInputData(image)
+    erodeDilate.SetDilateValue(mask.max() + 1)
+    erodeDilate.SetErodeValue(0)
+    erodeDilate.SetKernelSize(*kernel_size)
+    erodeDilate.Update()
+    newmask = numpy_support.vtk_to_numpy(erodeDilate.GetOutput().GetPointData().GetScalars()).reshape(mask.shape).copy()
+    newmask[mask > 0] = 0
+    return newmask + mask
+
+
+def syntheticEyeMask(rows, columns):
+    # Eyeball (1) with the cornea (2) inside it, roughly where they sit on a photo
+    mask = np.zeros((1, rows, columns), dtype=np.uint8)
+    j, i = np.ogrid[:rows, :columns]
+    eyeball = ((j - rows * 0.55) / (rows * 0.2)) ** 2 + ((i - columns * 0.5) / (columns * 0.3)) ** 2 <= 1.0
+    cornea = ((j - rows * 0.55) / (rows * 0.12)) ** 2 + ((i - columns * 0.5) / (columns * 0.08)) ** 2 <= 1.0
+    mask[0][eyeball] = 1
+    mask[0][cornea] = 2
+    return mask
+
+
+def timeIt(function, mask, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(mask)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main(sizes, repeats, skip_vtk):
+    print('{:>12} {:>10} {:>10} {:>8}'.format('size', 'vtk (s)', 'numpy (s)', 'speedup'))
+    for size in sizes:
+        rows, columns = [int(v) for v in size.split('x')]
+        mask = syntheticEyeMask(rows, columns)
+        numpy_result, numpy_time = timeIt(eyelid.createEyelidLabelmap, mask, repeats)
+        if skip_vtk:
+            print('{:>12} {:>10} {:>10.3f} {:>8}'.format(size, '-', numpy_time, '-'))
+            continue
+        vtk_result, vtk_time = timeIt(vtkEyelidLabelmap, mask, 1)
+        if not np.array_equal(vtk_result, numpy_result):
+            raise AssertionError('Eyelid labels differ for {}: {} pixels'.format(size, np.count_nonzero(vtk_result != numpy_result)))
+        print('{:>12} {:>10.3f} {:>10.3f} {:>7.0f}x'.format(size, vtk_time, numpy_time, vtk_time / numpy_time))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', default=['2000x3000', '3000x4000'], help='Labelmap sizes as ROWSxCOLUMNS')
+    parser.add_argument('--repeats', type=int, default=3, help='Best of this many runs for the NumPy version')
+    parser.add_argument('--skip_vtk', action='store_true', help='Only time the NumPy version')
+    args = parser.parse_args()
+    main(args.sizes, args.repeats, args.skip_vtk)
@@ -0,0 +1,206 @@
+'''
+Times the grading loop end to end in Slicer on a synthetic dataset (SyntheticDataset.py):
+loadData on the master csv, stepping through the images with changeCurrentImageInd while
+adding patches and ticking graded, then writeFinalMasterCSV. Reports images per second and
+the p50/p95 of every timed stage, and compares them with a stored baseline.
+
+    Slicer --no-main-window --python-script NavigationBenchmark.py --num_images 200 --steps 200 --baseline navigation_baseline.json
+    Slicer --no-main-window --python-script NavigationBenchmark.py --baseline navigation_baseline.json --save_baseline
+'''
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import vtk, qt, slicer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import SyntheticDataset
+
+# Lower is better for all of them except images_per_s
+HIGHER_IS_BETTER = ['images_per_s']
+
+
+@contextmanager
+def quietDialogs():
+    '''
+    Message boxes would block a headless run, they go to the log instead. Yields the list
+    of messages passed to errorDisplay.
+    '''
+    errors = []
+    names = ['infoDisplay', 'warningDisplay', 'errorDisplay', 'delayDisplay']
+    saved = {name: getattr(slicer.util, name) for name in names}
+    def logged(level, keep=None):
+        def display(text, *args, **kwargs):
+            logging.log(level, text)
+            if keep is not None:
+                keep.append(text)
+        return display
+    slicer.util.infoDisplay = logged(logging.INFO)
+    slicer.util.delayDisplay = logged(logging.INFO)
+    slicer.util.warningDisplay = logged(logging.WARNING)
+    slicer.util.errorDisplay = logged(logging.ERROR, errors)
+    try:
+        yield errors
+    finally:
+        for name, function in saved.items():
+            setattr(slicer.util, name, function)
+
+
+def moduleWidget():
+    # Creates the widget when the module was never shown (no main window)
+    slicer.modules.ttsegtool.widgetRepresentation()
+    return slicer.modules.TTSegToolWidget
+
+
+def loadDataset(widget, master_path, server_path, user_name):
+    widget.path_to_image_details = Path(master_path)
+    widget.path_to_server = Path(server_path)
+    widget.ui.usernameLineEdit.text = user_name
+    widget.loadData()
+
+
+def addPatch(widget, ijk):
+    # Same as a click on the Red view in patch edit mode (onClick)
+    ijk_to_ras = vtk.vtkMatrix4x4()
+    widget.image_node.GetIJKToRASMatrix(ijk_to_ras)
+    ras = ijk_to_ras.MultiplyPoint([ijk[0], ijk[1], ijk[2], 1])
+    widget.updatePatchesTable(ijk=list(ijk), ras=ras[:3])
+    widget.updateMasterDictAndTable()
+
+
+def setChecked(widget, row, key, checked=True):
+    # Same as ticking the checkbox in the master table
+    model = widget.imageDetailsModel
+    model.setData(model.index(row, model.keys.index(key)), qt.Qt.Checked if checked else qt.Qt.Unchecked, qt.Qt.CheckStateRole)
+
+
+def percentiles(values):
+    return float(np.percentile(values, 50)), float(np.percentile(values, 95))
+
+
+def runBenchmark(widget, master_path, server_path, steps, patches_per_image, seed=0):
+    rng = np.random.default_rng(seed)
+    results = {}
+    start = time.perf_counter()
+    loadDataset(widget, master_path, server_path, 'benchmark')
+    results['load_data_s'] = time.perf_counter() - start
+    num_images = len(widget.image_list)
+    if num_images == 0:
+        raise RuntimeError('No images loaded from {}'.format(master_path))
+
+    latencies = []
+    start_nodes = slicer.mrmlScene.GetNumberOfNodes()
+    start = time.perf_counter()
+    for step in range(steps):
+        # Starts at 1, loadData already shows the first image
+        ind = (step + 1) % num_images
+        step_start = time.perf_counter()
+        widget.changeCurrentImageInd(ind)
+        latencies.append((time.perf_counter() - step_start) * 1000.0)
+        dims = widget.image_node.GetImageData().GetDimensions()
+        for _ in range(patches_per_image):
+            addPatch(widget, (int(rng.integers(0, dims[0])), int(rng.integers(0, dims[1])), 0))
+        setChecked(widget, ind, 'graded')
+        # Lets the autosave and write timers run, like the event loop between clicks
+        slicer.app.processEvents()
+    results['navigation_s'] = time.perf_counter() - start
+    results['images_per_s'] = steps / results['navigation_s']
+    results['navigation_p50_ms'], results['navigation_p95_ms'] = percentiles(latencies)
+    # Nodes left behind per image, should stay at 0
+    results['scene_node_growth'] = float(slicer.mrmlScene.GetNumberOfNodes() - start_nodes)
+
+    start = time.perf_counter()
+    if not widget.writeFinalMasterCSV():
+        raise RuntimeError('Writing the master csv failed')
+    widget.autosave.waitForWrites()
+    widget.segmentation_writer.flush()
+    if not widget.checkSegmentationWrites():
+        raise RuntimeError('Writing the segmentations failed')
+    results['final_write_s'] = time.perf_counter() - start
+
+    for stage, count, p50, p95 in widget.timings.summary():
+        results['{}_p50_ms'.format(stage.replace(' ', '_'))] = p50
+        results['{}_p95_ms'.format(stage.replace(' ', '_'))] = p95
+    return results
+
+
+def compareWithBaseline(results, baseline, tolerance):
+    # Returns the metrics more than tolerance worse than the baseline
+    regressions = []
+    print('{:>32} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'current', 'ratio'))
+    for metric in sorted(results):
+        if metric not in baseline:
+            print('{:>32} {:>12} {:>12.3f}'.format(metric, '-', results[metric]))
+            continue
+        old, new = baseline[metric], results[metric]
+        ratio = new / old if old > 0 else (1.0 if new <= old else float('inf'))
+        worse = ratio < 1.0 - tolerance if metric in HIGHER_IS_BETTER else ratio > 1.0 + tolerance
+        print('{:>32} {:>12.3f} {:>12.3f} {:>7.2f}x{}'.format(metric, old, new, ratio, '  REGRESSION' if worse else ''))
+        if worse:
+            regressions.append(metric)
+    return regressions
+
+
+def main(args):
+    settings = {'num_images': args.num_images, 'size': args.size, 'steps': args.steps,
+                'patches_per_image': args.patches_per_image, 'seed': args.seed}
+    output_dir = Path(args.output_dir) if args.output_dir else Path(tempfile.mkdtemp(prefix='tt_benchmark_'))
+    rows, columns = [int(v) for v in args.size.split('x')]
+    master_path = SyntheticDataset.generateDataset(output_dir, args.num_images, rows, columns, seed=args.seed)
+
+    with quietDialogs() as errors:
+        results = runBenchmark(moduleWidget(), master_path, output_dir, args.steps, args.patches_per_image, args.seed)
+    if len(errors) > 0:
+        raise RuntimeError('The tool reported errors: {}'.format(errors))
+
+    status = 0
+    baseline_path = Path(args.baseline) if args.baseline else None
+    if args.save_baseline:
+        with open(baseline_path, 'w') as fh:
+            json.dump({'settings': settings, 'results': results}, fh, indent=2, sort_keys=True)
+        print('Saved the baseline to {}'.format(baseline_path))
+    if baseline_path is not None and baseline_path.exists() and not args.save_baseline:
+        with open(baseline_path, 'r') as fh:
+            baseline = json.load(fh)
+        if baseline['settings'] != settings:
+            logging.warning('Baseline settings {} differ from this run {}'.format(baseline['settings'], settings))
+        regressions = compareWithBaseline(results, baseline['results'], args.tolerance)
+        if len(regressions) > 0:
+            print('Regressions: {}'.format(', '.join(regressions)))
+            status = 1
+    else:
+        for metric in sorted(results):
+            print('{:>32} {:>12.3f}'.format(metric, results[metric]))
+
+    if not args.output_dir and not args.keep:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return status
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=100)
+    parser.add_argument('--size', default='1200x1600', help='Photo size as ROWSxCOLUMNS')
+    parser.add_argument('--steps', type=int, default=100, help='Number of changeCurrentImageInd steps')
+    parser.add_argument('--patches_per_image', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_dir', help='Dataset directory, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary dataset')
+    parser.add_argument('--baseline', help='Baseline json to compare with (or to save to)')
+    parser.add_argument('--save_baseline', action='store_true', help='Store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slow down before failing')
+    args = parser.parse_args()
+    if args.save_baseline and not args.baseline:
+        parser.error('--save_baseline needs --baseline')
+    try:
+        status = main(args)
+    except Exception as e:
+        logging.error('Benchmark failed: {}'.format(e))
+        status = 2
+    slicer.util.exit(status)
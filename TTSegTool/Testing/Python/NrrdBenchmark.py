@@ -0,0 +1,110 @@
+'''
+Write latency, read latency and file size of the segmentation label maps for each
+compression setting of nrrdio (raw, fast and full gzip) and for the cropped storage,
+next to SimpleITK's NRRD writer the tool used before. Every file is read back with
+SimpleITK and with nrrdio. Label maps come from SyntheticDataset, written to --output_dir
+(use a directory on the share to include its latency).
+
+    python NrrdBenchmark.py --size 1200x1600 --count 20 --output_dir P:/scratch/nrrd_benchmark
+'''
+from argparse import ArgumentParser
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+import SyntheticDataset
+from CommonUtilities import nrrdio
+from CommonUtilities import volumeio
+
+
+def syntheticSegmentations(count, rows, columns, seed):
+    # Label maps with their .seg.nrrd metadata, like the snapshots the tool saves
+    rng = np.random.default_rng(seed)
+    ijk_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0])
+    segmentations = []
+    for _ in range(count):
+        labelmap = SyntheticDataset.syntheticLabelmap(rows, columns, SyntheticDataset.eyeGeometry(rows, columns, rng), int(rng.integers(2, 5)))
+        metadata = nrrdio.addSegmentationHeader(nrrdio.NrrdHeader(), labelmap, SyntheticDataset.SEGMENT_LABEL_NAMES,
+                                                SyntheticDataset.SEGMENT_LABEL_COLORS).keyvalues
+        segmentations.append(volumeio.DecodedVolume(None, labelmap, ijk_to_ras, metadata))
+    return segmentations
+
+
+def writeWithSimpleITK(decoded, file_path):
+    # What volumeio.writeVolume did before nrrdio, SimpleITK at its default gzip level
+    # Identity LPS directions, the diag(-1, -1, 1) IJK to RAS of the synthetic label maps
+    image = sitk.GetImageFromArray(decoded.array)
+    sitk.WriteImage(image, str(file_path), True)
+
+
+def readWithSimpleITK(file_path):
+    return sitk.GetArrayFromImage(sitk.ReadImage(str(file_path)))
+
+
+def timeCalls(function, arguments):
+    durations = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        durations.append((time.perf_counter() - start) * 1000.0)
+    return durations
+
+
+def runBenchmark(segmentations, output_dir):
+    writers = [('simpleitk', writeWithSimpleITK)]
+    for compression in nrrdio.COMPRESSION_LEVELS:
+        writers.append(('nrrdio ' + compression, lambda decoded, file_path, compression=compression: volumeio.writeVolume(decoded, file_path, compression)))
+    for compression in ['raw', 'fast']:
+        # Bounding box storage, the crop is part of the write time
+        writers.append(('cropped ' + compression, lambda decoded, file_path, compression=compression:
+                        volumeio.writeVolume(volumeio.cropToContent(decoded), file_path, compression)))
+
+    results = []
+    for name, write in writers:
+        paths = [output_dir / '{}_{:04d}.seg.nrrd'.format(name.replace(' ', '_'), n) for n in range(len(segmentations))]
+        write_ms = timeCalls(write, zip(segmentations, paths))
+        sitk_read_ms = timeCalls(readWithSimpleITK, [(p,) for p in paths])
+        nrrdio_read_ms = timeCalls(nrrdio.readNrrd, [(p,) for p in paths])
+        for decoded, file_path in zip(segmentations, paths):
+            header, array = nrrdio.readNrrd(file_path)
+            restored = volumeio.resampleToReferenceGeometry(volumeio.DecodedVolume(file_path, array, nrrdio.ijkToRAS(header)),
+                                                            decoded.array.shape, decoded.ijk_to_ras)
+            if not np.array_equal(restored.array, decoded.array) or not np.array_equal(readWithSimpleITK(file_path), array):
+                raise RuntimeError('{} did not read back what was written'.format(file_path))
+        sizes = [p.stat().st_size for p in paths]
+        results.append((name, np.percentile(write_ms, 50), np.percentile(write_ms, 95),
+                        np.percentile(sitk_read_ms, 50), np.percentile(nrrdio_read_ms, 50), np.mean(sizes)))
+    return results
+
+
+def main(args):
+    rows, columns = [int(v) for v in args.size.split('x')]
+    output_dir = Path(args.output_dir) if args.output_dir else Path(tempfile.mkdtemp(prefix='tt_nrrd_benchmark_'))
+    output_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        results = runBenchmark(syntheticSegmentations(args.count, rows, columns, args.seed), output_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    raw_size = dict((result[0], result[-1]) for result in results)['nrrdio raw']
+    print('{} label maps of {}x{}, read times with SimpleITK and with nrrdio'.format(args.count, rows, columns))
+    print('{:>14} {:>13} {:>13} {:>13} {:>13} {:>10} {:>7}'.format('writer', 'write p50 ms', 'write p95 ms', 'sitk read ms', 'nrrdio read', 'KB', 'ratio'))
+    for name, write_p50, write_p95, sitk_read_p50, nrrdio_read_p50, size in results:
+        print('{:>14} {:>13.2f} {:>13.2f} {:>13.2f} {:>13.2f} {:>10.1f} {:>6.1f}x'.format(
+            name, write_p50, write_p95, sitk_read_p50, nrrdio_read_p50, size / 1024.0, raw_size / size))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--size', default='1200x1600', help='Label map size as ROWSxCOLUMNS')
+    parser.add_argument('--count', type=int, default=20, help='Number of label maps written per setting')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_dir', help='Directory to write to, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the written files')
+    main(parser.parse_args())
@@ -0,0 +1,136 @@
+'''
+Generates a synthetic TT grading dataset: eye photos, .seg.nrrd segmentations with 2 to 4
+labels, per image patch csv files and a master csv in the layout loadData/createMasterDict
+expects (paths relative to the server directory, which is the output directory here).
+
+    PythonSlicer SyntheticDataset.py --output_dir /tmp/tt_synthetic --num_images 200 --size 1200x1600
+'''
+from argparse import ArgumentParser
+from csv import DictWriter
+from pathlib import Path
+import sys
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from CommonUtilities import nrrdio
+from CommonUtilities import volumeio
+
+# Same as CommonUtilities/EntropionSegPreProcess.py, which needs Slicer to import
+SEGMENT_LABEL_NAMES = {1:'EyeBall', 2:'Cornea', 3:'EyeLid', 4:'Entropion'}
+SEGMENT_LABEL_COLORS = {1:(0.5, 0.68, 0.5), 2:(0.5, 0, 0), 3:(0.5, 0.45, 0), 4:(0.9, 0.5, 0.5)}
+PATCH_LABELS = ["TT", "Probable TT", "Healthy", "Epilation", "Probable Epilation", "Unknown"]
+MASTER_FIELDS = ['cid', 'eye', 'image path', 'segmentation path', 'patches path', 'graded', 'blurry', 'eye-angle-wrong', 'comments']
+
+
+def eyeGeometry(rows, columns, rng):
+    # Center and radii of the eyeball and the cornea, jittered per image
+    center = (rows * rng.uniform(0.45, 0.6), columns * rng.uniform(0.42, 0.58))
+    eyeball = (rows * rng.uniform(0.15, 0.22), columns * rng.uniform(0.25, 0.33))
+    cornea = (eyeball[0] * rng.uniform(0.55, 0.7), eyeball[1] * rng.uniform(0.25, 0.32))
+    return center, eyeball, cornea
+
+
+def ellipse(rows, columns, center, radii):
+    j, i = np.ogrid[:rows, :columns]
+    return ((j - center[0]) / radii[0]) ** 2 + ((i - center[1]) / radii[1]) ** 2 <= 1.0
+
+
+def syntheticLabelmap(rows, columns, geometry, num_labels):
+    # (1, rows, columns) labelmap: eyeball, cornea, then optionally eyelid and entropion
+    center, eyeball, cornea = geometry
+    labelmap = np.zeros((1, rows, columns), dtype=np.uint8)
+    eyeball_mask = ellipse(rows, columns, center, eyeball)
+    labelmap[0][eyeball_mask] = 1
+    labelmap[0][ellipse(rows, columns, center, cornea)] = 2
+    if num_labels >= 3:
+        # Band over the upper half of the eyeball
+        lid = ellipse(rows, columns, (center[0] - eyeball[0] * 0.2, center[1]), (eyeball[0] * 1.1, eyeball[1] * 1.08))
+        lid &= ~eyeball_mask
+        lid[int(center[0]):, :] = False
+        labelmap[0][lid] = 3
+    if num_labels >= 4:
+        # Small blob where the lid margin meets the eyeball
+        blob_center = (center[0] - eyeball[0] * 0.95, center[1] + eyeball[1] * 0.3)
+        labelmap[0][ellipse(rows, columns, blob_center, (eyeball[0] * 0.08, eyeball[1] * 0.1))] = 4
+    return labelmap
+
+
+def syntheticPhoto(rows, columns, labelmap, rng):
+    # RGB photo roughly matching the labels, with sensor noise so JPEG sizes are realistic
+    colors = np.array([[190, 140, 120], [235, 230, 225], [70, 50, 40], [150, 100, 90], [200, 90, 90]], dtype=np.float32)
+    photo = colors[labelmap[0]]
+    photo += rng.normal(0, 8, size=photo.shape).astype(np.float32)
+    return np.clip(photo, 0, 255).astype(np.uint8)
+
+
+def writeSegmentation(labelmap, ijk_to_ras, file_path):
+    # Labelmap with the .seg.nrrd metadata, the way the tool saves segmentations
+    metadata = nrrdio.addSegmentationHeader(nrrdio.NrrdHeader(), labelmap, SEGMENT_LABEL_NAMES, SEGMENT_LABEL_COLORS).keyvalues
+    volumeio.writeVolume(volumeio.DecodedVolume(file_path, labelmap, ijk_to_ras, metadata), file_path)
+
+
+def writePatches(file_path, rows, columns, num_patches, rng):
+    with open(file_path, 'w', newline='') as fh:
+        writer = DictWriter(fh, ['x', 'y', 'label'])
+        writer.writeheader()
+        for _ in range(num_patches):
+            writer.writerow({'x': int(rng.integers(0, columns)), 'y': int(rng.integers(0, rows)),
+                             'label': PATCH_LABELS[int(rng.integers(0, len(PATCH_LABELS)))]})
+
+
+def generateDataset(output_dir, num_images, rows=600, columns=800, graded_fraction=0.3,
+                    segmented_fraction=0.8, patches_fraction=0.5, seed=0, master_name='master.csv'):
+    '''
+    Writes the dataset under output_dir and returns the path of the master csv. Rows without
+    a segmentation or patches file have an empty path, like rows not graded yet.
+    '''
+    output_dir = Path(output_dir)
+    rng = np.random.default_rng(seed)
+    for sub_dir in ['images', 'segmentations', 'patches']:
+        (output_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+
+    master_rows = []
+    for image_id in range(num_images):
+        cid = 'S{:05d}'.format(image_id // 2)
+        eye = 'right' if image_id % 2 == 0 else 'left'
+        name = '{}_{}'.format(cid, eye)
+        image_path = Path('images') / (name + '.jpg')
+        labelmap = syntheticLabelmap(rows, columns, eyeGeometry(rows, columns, rng), int(rng.integers(2, 5)))
+        photo = sitk.GetImageFromArray(syntheticPhoto(rows, columns, labelmap, rng), isVector=True)
+        sitk.WriteImage(photo, str(output_dir / image_path))
+
+        row = {'cid': cid, 'eye': eye, 'image path': image_path.as_posix(), 'segmentation path': '', 'patches path': '',
+               'graded': 0, 'blurry': int(rng.random() < 0.05), 'eye-angle-wrong': int(rng.random() < 0.05), 'comments': 'None'}
+        if rng.random() < segmented_fraction:
+            # Same geometry as the photo as Slicer reads it
+            _, ijk_to_ras = volumeio.readImageGeometry(output_dir / image_path)
+            segmentation_path = Path('segmentations') / (name + '.seg.nrrd')
+            writeSegmentation(labelmap, ijk_to_ras, output_dir / segmentation_path)
+            row['segmentation path'] = segmentation_path.as_posix()
+        if rng.random() < patches_fraction:
+            patches_path = Path('patches') / (name + '.csv')
+            writePatches(output_dir / patches_path, rows, columns, int(rng.integers(1, 6)), rng)
+            row['patches path'] = patches_path.as_posix()
+        row['graded'] = int(len(row['segmentation path']) > 0 and rng.random() < graded_fraction)
+        master_rows.append(row)
+
+    master_path = output_dir / master_name
+    with open(master_path, 'w', newline='') as fh:
+        writer = DictWriter(fh, MASTER_FIELDS)
+        writer.writeheader()
+        writer.writerows(master_rows)
+    return master_path
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--output_dir', required=True, help='Directory to write the dataset to, it is the server path')
+    parser.add_argument('--num_images', type=int, default=100)
+    parser.add_argument('--size', default='600x800', help='Photo size as ROWSxCOLUMNS')
+    parser.add_argument('--graded_fraction', type=float, default=0.3, help='Fraction of segmented rows marked graded')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rows, columns = [int(v) for v in args.size.split('x')]
+    master_path = generateDataset(args.output_dir, args.num_images, rows, columns, args.graded_fraction, seed=args.seed)
+    print('Wrote {} images, master csv: {}'.format(args.num_images, master_path))